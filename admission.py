@@ -0,0 +1,215 @@
+"""
+Control de admisión para las vistas que estampan PDFs.
+
+Cada clase de endpoint tiene un Limiter con un máximo de peticiones en curso y
+una cola de espera acotada. Una petición que encuentra todos los huecos
+ocupados espera en la cola hasta ADMISSION_QUEUE_TIMEOUT segundos; si la cola
+también está llena, o se agota la espera, se responde enseguida con 503 y
+`Retry-After` en lugar de acumular trabajo hasta agotar la CPU o la memoria.
+
+Clases configuradas (concurrencia 0 = sin límite):
+
+- upload: /upload (ADMISSION_UPLOAD_CONCURRENCY, ADMISSION_UPLOAD_QUEUE)
+- stamp: /download_qr y /download_blank_with_qr (ADMISSION_STAMP_CONCURRENCY,
+  ADMISSION_STAMP_QUEUE)
+- batch: /api/batch (ADMISSION_BATCH_CONCURRENCY, ADMISSION_BATCH_QUEUE); cada
+  lote procesa además BATCH_WORKERS certificados a la vez
+"""
+import functools
+import logging
+import os
+import threading
+import time
+
+from flask import Response, request
+
+import metrics
+
+logger = logging.getLogger('backblaze_uploader.admission')
+
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '10'))  # segundos
+ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', '5'))  # segundos
+
+ADMISSION_IN_FLIGHT = metrics.gauge(
+    'geotop_admission_in_flight', 'Peticiones en curso por clase de endpoint', ['endpoint'])
+ADMISSION_QUEUE_DEPTH = metrics.gauge(
+    'geotop_admission_queue_depth', 'Peticiones esperando turno por clase de endpoint', ['endpoint'])
+ADMISSION_REJECTED = metrics.counter(
+    'geotop_admission_rejected_total', 'Peticiones rechazadas con 503 por clase de endpoint y motivo',
+    ['endpoint', 'reason'])
+ADMISSION_WAIT = metrics.histogram(
+    'geotop_admission_wait_seconds', 'Tiempo de espera en la cola antes de ser admitida', ['endpoint'])
+
+
+class Limiter:
+    """
+    Semáforo con cola de espera acotada. `acquire()` devuelve None si la
+    petición fue admitida o el motivo del rechazo ('queue_full', 'timeout').
+    """
+
+    def __init__(self, name, concurrency, queue_size, timeout):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        if self.concurrency <= 0:
+            return None
+        start = time.perf_counter()
+        with self._condition:
+            if self.in_flight < self.concurrency and self.waiting == 0:
+                self.in_flight += 1
+                ADMISSION_WAIT.observe(0, endpoint=self.name)
+                return None
+            if self.waiting >= self.queue_size:
+                return 'queue_full'
+            self.waiting += 1
+            try:
+                admitted = self._condition.wait_for(lambda: self.in_flight < self.concurrency, self.timeout)
+                if not admitted:
+                    return 'timeout'
+                self.in_flight += 1
+            finally:
+                self.waiting -= 1
+        ADMISSION_WAIT.observe(time.perf_counter() - start, endpoint=self.name)
+        return None
+
+    def release(self):
+        if self.concurrency <= 0:
+            return
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+
+# (concurrencia, cola) por defecto de cada clase
+_DEFAULTS = {'upload': (2, 4), 'stamp': (2, 8), 'batch': (1, 2)}
+
+
+def _limiter(name):
+    prefix = f'ADMISSION_{name.upper()}'
+    concurrency, queue_size = _DEFAULTS[name]
+    return Limiter(name,
+                   int(os.getenv(f'{prefix}_CONCURRENCY', str(concurrency))),
+                   int(os.getenv(f'{prefix}_QUEUE', str(queue_size))),
+                   ADMISSION_QUEUE_TIMEOUT)
+
+
+LIMITERS = {name: _limiter(name) for name in _DEFAULTS}
+
+ADMISSION_IN_FLIGHT.set_function(lambda: {(name, ): limiter.in_flight for name, limiter in LIMITERS.items()})
+ADMISSION_QUEUE_DEPTH.set_function(lambda: {(name, ): limiter.waiting for name, limiter in LIMITERS.items()})
+
+
+def busy_response():
+    response = Response('El servidor está ocupado procesando otros PDFs. Inténtalo de nuevo en unos segundos.',
+                        status=503, mimetype='text/plain')
+    response.headers['Retry-After'] = str(ADMISSION_RETRY_AFTER)
+    return response
+
+
+def _reject(limiter, reason):
+    ADMISSION_REJECTED.inc(endpoint=limiter.name, reason=reason)
+    logger.warning("Petición rechazada por saturación (%s, %s): %s en curso, %s en cola",
+                   limiter.name, reason, limiter.in_flight, limiter.waiting)
+
+
+def admit(name):
+    """
+    Toma un hueco de `name` para un trabajo que sigue después de la vista.
+    Devuelve False si la petición debe rechazarse con busy_response(); si no,
+    el hueco se devuelve con release() o al cerrar releasing().
+    """
+    limiter = LIMITERS[name]
+    reason = limiter.acquire()
+    if reason is not None:
+        _reject(limiter, reason)
+        return False
+    return True
+
+
+def release(name):
+    LIMITERS[name].release()
+
+
+class _ReleasingIterator:
+
+    def __init__(self, name, chunks):
+        self.name = name
+        self._chunks = chunks
+        self._iterator = iter(chunks)
+        self._released = False
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            self.close()
+            raise
+
+    def close(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        try:
+            close = getattr(self._chunks, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            release(self.name)
+
+
+def releasing(name, chunks):
+    """
+    Iterable que entrega `chunks` y devuelve el hueco de `name` (ya tomado con
+    admit()) una sola vez: al agotarse o en `close()`, que el servidor WSGI
+    llama también si la conexión se cierra antes del primer fragmento (un
+    generador sin empezar no ejecutaría su `finally`).
+    """
+    return _ReleasingIterator(name, chunks)
+
+
+def streaming(name, chunks):
+    """
+    Para respuestas generadas mientras se envían: toma un hueco de `name` y
+    devuelve un generador que lo libera al terminar (o al cerrarse la
+    conexión). Devuelve None si la petición debe rechazarse con busy_response().
+    """
+    if not admit(name):
+        return None
+    return releasing(name, chunks)
+
+
+def limited(name, read_body=False):
+    """
+    Decorador de vista: ejecuta la vista solo si el Limiter `name` la admite;
+    si no, devuelve 503 con Retry-After. Con `read_body` se recibe antes el
+    cuerpo multipart (acotado por MAX_CONTENT_LENGTH), para que un cliente que
+    sube despacio no ocupe un hueco sin trabajo de CPU.
+    """
+    limiter = LIMITERS[name]
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if read_body:
+                request.files  # fuerza la lectura del cuerpo
+            reason = limiter.acquire()
+            if reason is not None:
+                _reject(limiter, reason)
+                return busy_response()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                limiter.release()
+        return wrapper
+    return decorator
@@ -1,33 +1,43 @@
-from math import fabs
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, send_file, g, Response, jsonify, abort, has_request_context, stream_with_context
 import os
 import uuid
 import logging
 import re
-import boto3
-from botocore.client import Config
+import socket
+import threading
+import functools
+import base64
+import binascii
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-import qrcode
-from PyPDF2 import PdfReader, PdfWriter
-from PyPDF2.errors import PdfReadError
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter, A4
 from io import BytesIO
 import time
 from dotenv import load_dotenv
+import metrics
+import mapped
+import pdfcache
+import pdfstream
+import artifacts
+import admission
+import hashing
+import bucketdb
+import export
+import pdfcheck
+import delivery
+import qrencode
+from log_config import setup_logging, LOG_SAMPLE_RATE
+import profiling
+
+# NOTA: boto3, PyPDF2, reportlab, qrcode y Pillow se importan dentro de las
+# funciones que los usan para que el arranque en frío (Render free) sea rápido.
+# El hook de warmup los precarga en segundo plano una vez abierto el puerto.
 
 # Cargar variables de entorno desde .env
 load_dotenv()
 
-# Configurar el registro
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('backblaze_uploader.log'),
-        logging.StreamHandler()
-    ]
-)
+# Configurar el registro (cola asíncrona con rotación, ver log_config.py)
+setup_logging()
 logger = logging.getLogger('backblaze_uploader')
 
 app = Flask(__name__, static_folder='static')
@@ -44,7 +54,7 @@ B2_REGION = os.getenv('B2_REGION')
 required_env_vars = ['B2_ACCESS_KEY_ID', 'B2_SECRET_ACCESS_KEY', 'B2_BUCKET_NAME', 'B2_ENDPOINT', 'B2_REGION']
 for var in required_env_vars:
     if not os.getenv(var):
-        logger.error(f"Variable de entorno requerida no encontrada: {var}")
+        logger.error("Variable de entorno requerida no encontrada: %s", var)
         raise ValueError(f"Variable de entorno requerida no encontrada: {var}")
 
 # Configuración de carpetas
@@ -53,15 +63,100 @@ if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB máximo
+MAX_UPLOAD_MB = int(os.getenv('MAX_UPLOAD_MB', '16'))
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_MB * 1024 * 1024
+# El API por lotes recibe varios certificados en una sola petición
+BATCH_MAX_MB = int(os.getenv('BATCH_MAX_MB', '200'))
+
+# Calcula el SHA-256 de cada archivo y revisa que sea un PDF mientras se recibe
+# (ver hashing.py y pdfcheck.py); el API por lotes admite un cuerpo mayor
+class AppRequest(pdfcheck.PdfUploadRequest):
+    @property
+    def max_content_length(self):
+        if self.path == '/api/batch':
+            return BATCH_MAX_MB * 1024 * 1024
+        return super().max_content_length
+
+app.request_class = AppRequest
+
+# Combinación de PDFs: 'stream' escribe el resultado de forma incremental con
+# memoria acotada; 'memory' usa PdfWriter con todo el documento en memoria
+MERGE_MODE = os.getenv('MERGE_MODE', 'stream').lower()
+if MERGE_MODE not in ('stream', 'memory'):
+    raise ValueError(f"MERGE_MODE no válido: {MERGE_MODE} (use 'stream' o 'memory')")
+
+# Con MERGE_TRACE_MEMORY=1 el pico de memoria se mide con tracemalloc (exacto
+# pero con coste en todo el proceso); si no, muestreando el RSS
+if os.getenv('MERGE_TRACE_MEMORY', '0') == '1':
+    import tracemalloc
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.start()
+    else:
+        logger.warning("MERGE_TRACE_MEMORY requiere Python 3.9 o posterior; se muestrea el RSS")
+
+# Publicar el uso de disco de uploads/ en /metrics
+metrics.watch_directory(UPLOAD_FOLDER)
+
+# Almacén acotado para los archivos generados (PDF en blanco, PNG de QR)
+ARTIFACTS_FOLDER = os.getenv('ARTIFACTS_FOLDER', os.path.join(UPLOAD_FOLDER, 'artifacts'))
+ARTIFACT_MAX_BYTES = int(os.getenv('ARTIFACT_MAX_MB', '200')) * 1024 * 1024
+ARTIFACT_TTL = float(os.getenv('ARTIFACT_TTL', str(24 * 3600)))  # segundos desde el último acceso
+ORPHAN_MAX_AGE = float(os.getenv('ORPHAN_MAX_AGE', '3600'))  # temporales sueltos en uploads/
+ARTIFACT_JANITOR_INTERVAL = float(os.getenv('ARTIFACT_JANITOR_INTERVAL', '300'))
+
+artifact_store = artifacts.ArtifactStore(ARTIFACTS_FOLDER, ARTIFACT_MAX_BYTES, ARTIFACT_TTL)
 
 # Manejador de error para archivos demasiado grandes
 @app.errorhandler(413)
 def request_entity_too_large(error):
     """Maneja el error cuando el archivo es demasiado grande"""
-    flash('El archivo es demasiado grande. El tamaño máximo permitido es 16MB.', 'error')
+    if request.path.startswith('/api/'):
+        limit = BATCH_MAX_MB if request.path == '/api/batch' else MAX_UPLOAD_MB
+        return jsonify({'error': f'La petición supera el máximo de {limit}MB'}), 413
+    flash(f'El archivo es demasiado grande. El tamaño máximo permitido es {MAX_UPLOAD_MB}MB.', 'error')
     return redirect(url_for('index'))
 
+def record_stage_timing(stage, seconds):
+    """Acumula los tiempos por etapa de la petición en curso para el log."""
+    if has_request_context():
+        timings = g.setdefault('stage_timings', {})
+        timings[stage] = round(timings.get(stage, 0) + seconds * 1000, 1)
+
+metrics.add_stage_listener(record_stage_timing)
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_start = time.perf_counter()
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    metrics.HTTP_BYTES.inc(request.content_length or 0, direction='in')
+
+# Cerrar los mmap de PDFs abiertos durante la petición (ver mapped.py)
+app.teardown_request(mapped.close_request_maps)
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.pop('metrics_start', None)
+    endpoint = request.endpoint or 'desconocido'
+    duration = time.perf_counter() - start if start is not None else 0.0
+    if start is not None:
+        metrics.HTTP_DURATION.observe(duration, endpoint=endpoint)
+    metrics.HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    metrics.HTTP_BYTES.inc(response.content_length or 0, direction='out')
+    response.headers['X-Request-ID'] = g.get('request_id', '')
+    if endpoint != 'static':
+        logger.info("%s %s -> %s en %.1f ms", request.method, request.path, response.status_code, duration * 1000,
+                    extra={'duration_ms': round(duration * 1000, 1), 'status': response.status_code,
+                           'endpoint': endpoint, 'stages': g.get('stage_timings', {})})
+    return response
+
+# Compresión, caché de estáticos y de fragmentos de plantilla (ver delivery.py).
+# Los after_request se ejecutan en orden inverso: estos corren antes que las
+# métricas, que así cuentan los bytes ya comprimidos.
+app.after_request(delivery.compress_response)
+app.after_request(delivery.static_cache_headers)
+app.url_defaults(delivery.static_url_defaults)
+app.jinja_env.add_extension(delivery.FragmentCacheExtension)
+
 # Filtro para restar tiempo de un timestamp
 @app.template_filter('subtract_seconds')
 def subtract_seconds(timestamp, seconds):
@@ -98,27 +193,151 @@ def format_datetime(timestamp):
     except (OSError, ValueError, TypeError):
         return f"Fecha inválida ({timestamp})"
 
+def public_url_for(file_key):
+    """
+    URL pública de un objeto del bucket.
+    """
+    return f"{B2_ENDPOINT}/{B2_BUCKET_NAME}/{file_key}"
+
+def key_from_public_url(url):
+    """
+    Clave del objeto a partir de su URL pública (inverso de public_url_for y de
+    qr_url_for; para un alias devuelve la clave estable).
+    """
+    prefix = f"{B2_ENDPOINT}/{B2_BUCKET_NAME}/"
+    if url.startswith(prefix):
+        return url[len(prefix):]
+    alias_prefix = f"{ALIAS_BASE_URL}/c/"
+    if ALIAS_BASE_URL and url.startswith(alias_prefix):
+        return url[len(alias_prefix):]
+    return None
+
+# Claves inmutables: el nombre del objeto incluye los primeros caracteres del
+# SHA-256 del contenido recibido (certificados/informe.3f2a9b1c4d5e.pdf), así
+# que una clave nunca cambia de contenido y se puede cachear sin caducidad. El
+# QR apunta al alias estable /c/<clave sin hash> de la aplicación, que redirige
+# a la versión más reciente.
+IMMUTABLE_KEYS = os.getenv('IMMUTABLE_KEYS', '0') == '1'
+ALIAS_BASE_URL = (os.getenv('PUBLIC_BASE_URL') or os.getenv('RENDER_EXTERNAL_URL') or '').rstrip('/')
+ALIAS_CACHE_SECONDS = int(os.getenv('ALIAS_CACHE_SECONDS', '300'))
+VERSION_HASH_LENGTH = 12
+VERSIONED_KEY_RE = re.compile(r'^(.*)\.([0-9a-f]{%d})(\.[A-Za-z0-9]+)$' % VERSION_HASH_LENGTH)
+
+# Cabeceras HTTP que se guardan con cada objeto y que B2 (o la CDN) devuelve
+OBJECT_CACHE_CONTROL = os.getenv('OBJECT_CACHE_CONTROL', '')
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+OBJECT_CONTENT_DISPOSITION = os.getenv('OBJECT_CONTENT_DISPOSITION', '').lower()  # '', inline o attachment
+
+if IMMUTABLE_KEYS and not ALIAS_BASE_URL:
+    logger.warning("IMMUTABLE_KEYS activo sin PUBLIC_BASE_URL: los QR apuntarán a la versión concreta del objeto")
+
+def stable_key(file_key):
+    """
+    Clave sin el hash de versión (la misma clave si no lo tiene).
+    """
+    match = VERSIONED_KEY_RE.match(file_key)
+    return match.group(1) + match.group(3) if match else file_key
+
+def versioned_key(file_key, content_hash):
+    """
+    Clave con el hash de versión de `content_hash` (sustituye el que tuviera).
+    """
+    stem, extension = os.path.splitext(stable_key(file_key))
+    return f"{stem}.{content_hash[:VERSION_HASH_LENGTH]}{extension}"
+
+def qr_url_for(file_key):
+    """
+    URL que se codifica en el QR de un objeto: el alias estable si las claves
+    son inmutables y hay URL pública de la aplicación, si no la del objeto.
+    """
+    if IMMUTABLE_KEYS and ALIAS_BASE_URL:
+        return f"{ALIAS_BASE_URL}/c/{stable_key(file_key)}"
+    return public_url_for(file_key)
+
+def object_cache_args(file_key):
+    """
+    Argumentos CacheControl / ContentDisposition para put_object, upload_fileobj
+    y copy_object. Las claves con hash de versión se cachean sin caducidad.
+    """
+    args = {}
+    if IMMUTABLE_KEYS and VERSIONED_KEY_RE.match(file_key):
+        args['CacheControl'] = IMMUTABLE_CACHE_CONTROL
+    elif OBJECT_CACHE_CONTROL:
+        args['CacheControl'] = OBJECT_CACHE_CONTROL
+    if OBJECT_CONTENT_DISPOSITION in ('inline', 'attachment'):
+        filename = os.path.basename(stable_key(file_key))
+        args['ContentDisposition'] = f'{OBJECT_CONTENT_DISPOSITION}; filename="{filename}"'
+    return args
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
 def get_s3_client():
     """
-    Crea y devuelve un cliente S3 para Backblaze B2
+    Devuelve el cliente S3 para Backblaze B2. Se crea una sola vez y se
+    reutiliza (los clientes de boto3 son seguros entre hilos).
     """
+    global _s3_client
+    if _s3_client is not None:
+        return _s3_client
+    with _s3_client_lock:
+        if _s3_client is not None:
+            return _s3_client
+        try:
+            import boto3
+            from botocore.client import Config
+
+            s3_client = boto3.client(
+                's3',
+                endpoint_url=B2_ENDPOINT,
+                aws_access_key_id=B2_ACCESS_KEY_ID,
+                aws_secret_access_key=B2_SECRET_ACCESS_KEY,
+                region_name=B2_REGION,
+                config=Config(signature_version='s3v4')
+            )
+            _s3_client = metrics.instrument_s3_client(s3_client)
+            return _s3_client
+        except Exception as e:
+            logger.error("Error al crear cliente S3: %s", e)
+            return None
+
+BLANK_TEMPLATE_PATH = os.path.join('static', 'blank_template.pdf')
+
+@functools.lru_cache(maxsize=1)
+def load_blank_template():
+    """
+    Lee una sola vez el template del PDF en blanco y devuelve (bytes, page_size).
+    """
+    from PyPDF2 import PdfReader
+    from reportlab.lib.pagesizes import letter
+
+    with open(BLANK_TEMPLATE_PATH, 'rb') as file:
+        data = file.read()
+    page_size = letter  # Valor por defecto
     try:
-        s3_client = boto3.client(
-            's3',
-            endpoint_url=B2_ENDPOINT,
-            aws_access_key_id=B2_ACCESS_KEY_ID,
-            aws_secret_access_key=B2_SECRET_ACCESS_KEY,
-            region_name=B2_REGION,
-            config=Config(signature_version='s3v4')
-        )
-        return s3_client
+        reader = PdfReader(BytesIO(data))
+        if len(reader.pages) > 0:
+            mediabox = reader.pages[0].mediabox
+            page_size = (float(mediabox.width), float(mediabox.height))
     except Exception as e:
-        logger.error(f"Error al crear cliente S3: {str(e)}")
-        return None
+        logger.warning("No se pudieron extraer dimensiones del template, usando Letter: %s", e)
+    return data, page_size
+
 ex = 490
 ey = 667
 qr_size = 53
 # qr_size = 58 
+
+# Metadatos con los que se sube cada PDF estampado: la URL codificada en el QR
+# y su posición "x,y,tamaño". restamp.py los usa para saber qué QR quitar y si
+# el objeto ya está al día.
+QR_URL_METADATA = 'qr-url'
+QR_STAMP_METADATA = 'qr-stamp'
+
+def qr_stamp_geometry():
+    return f"{ex},{ey},{qr_size}"
+
+@metrics.timed('add_qr_to_pdf', is_error=lambda ok: not ok)
 def add_qr_to_pdf(input_pdf_path, output_pdf_path, qr_url, x=ex, y=ey):
     """
     Añade un código QR a un PDF existente en la posición especificada.
@@ -141,70 +360,48 @@ def add_qr_to_pdf(input_pdf_path, output_pdf_path, qr_url, x=ex, y=ey):
         x: Posición X del código QR en el PDF (desde la izquierda) - Solo para OPCIÓN 1
         y: Posición Y del código QR en el PDF (desde abajo) - Solo para OPCIÓN 1
     """
-    qr_img_path = None
+    from PyPDF2 import PdfReader, PdfWriter
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.pagesizes import letter
+
     try:
-        # Generar el código QR
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=0,
-        )
-        qr.add_data(qr_url)
-        qr.make(fit=True)
-        
-        # Crear una imagen QR con fondo transparente
-        qr_img = qr.make_image(fill_color="black", back_color="white")
-        qr_img = qr_img.convert("RGBA")
-        
-        # Hacer que el fondo sea transparente (convertir el blanco a transparente)
-        datas = qr_img.getdata()
-        new_data = []
-        for item in datas:
-            # Si el pixel es blanco (255, 255, 255), hacerlo transparente
-            if item[0] == 255 and item[1] == 255 and item[2] == 255:
-                new_data.append((255, 255, 255, 0))  # RGBA con alpha=0 (transparente)
-            else:
-                new_data.append(item)
-        
-        qr_img.putdata(new_data)
-        
-        # Guardar la imagen temporal
-        qr_img_path = os.path.join(UPLOAD_FOLDER, f"qr_{uuid.uuid4()}.png")
-        qr_img.save(qr_img_path, format="PNG")
-        
-        # Obtener las dimensiones del PDF original para usar el mismo pagesize
-        page_size = letter  # Valor por defecto
-        try:
-            with open(input_pdf_path, 'rb') as file:
-                reader = PdfReader(file)
-                if len(reader.pages) > 0:
-                    page = reader.pages[0]
-                    mediabox = page.mediabox
+        # Generar el código QR con fondo transparente (ver qrencode.py)
+        with metrics.timer('qr_render'):
+            qr_png = qrencode.encoder.png(qr_url, transparent=True)
+        
+        # Leer el PDF original (un lector compartido si el documento está en la caché)
+        with pdfcache.reader_for(input_pdf_path) as (existing_pdf, shared):
+            # Obtener las dimensiones del PDF original para usar el mismo pagesize
+            page_size = letter  # Valor por defecto
+            try:
+                if len(existing_pdf.pages) > 0:
+                    mediabox = existing_pdf.pages[0].mediabox
                     page_width = float(mediabox.width)
                     page_height = float(mediabox.height)
                     page_size = (page_width, page_height)
-                    logger.info(f"Usando dimensiones del PDF original: {page_width} x {page_height} puntos")
-        except Exception as e:
-            logger.warning(f"No se pudieron extraer dimensiones del PDF, us ando Letter: {str(e)}")
-        
-        # Crear un PDF temporal con el código QR usando las mismas dimensiones
-        packet = BytesIO()
-        can = canvas.Canvas(packet, pagesize=page_size)
-        can.drawImage(qr_img_path, ex, ey, qr_size, qr_size, mask='auto')  # mask='auto' para respetar la transparencia
-        can.save()
-        
-        # Mover al inicio del BytesIO
-        packet.seek(0)
-        
-        # Leer el PDF original
-        with open(input_pdf_path, "rb") as input_file:
-            existing_pdf = PdfReader(input_file)
+                    logger.debug("Usando dimensiones del PDF original: %s x %s puntos", page_width, page_height,
+                                 extra={'sample_rate': LOG_SAMPLE_RATE})
+            except Exception as e:
+                logger.warning("No se pudieron extraer dimensiones del PDF, us ando Letter: %s", e)
+            
+            # Crear un PDF temporal con el código QR usando las mismas dimensiones
+            packet = BytesIO()
+            can = canvas.Canvas(packet, pagesize=page_size)
+            can.drawImage(ImageReader(BytesIO(qr_png)), ex, ey, qr_size, qr_size, mask='auto')  # mask='auto' para respetar la transparencia
+            can.save()
+            
+            # Mover al inicio del BytesIO
+            packet.seek(0)
+            
             output = PdfWriter()
             
             # Añadir el código QR a cada página
             for i in range(len(existing_pdf.pages)):
                 page = existing_pdf.pages[i]
+                if shared:
+                    # merge_page modifica la página: no tocar la que guarda la caché
+                    page = pdfcache.copy_page(page)
 
                 # OPCIÓN 1: QR en la primera página (ACTUAL - ACTIVO)
                 # Solo añadir el QR a la primera página
@@ -232,7 +429,7 @@ def add_qr_to_pdf(input_pdf_path, output_pdf_path, qr_url, x=ex, y=ey):
                 #     packet_custom = BytesIO()
                 #     can_custom = canvas.Canvas(packet_custom, pagesize=page_size)  # Usar las mismas dimensiones
                 #     # Cambiar las coordenadas x, y según la posición deseada:
-                #     can_custom.drawImage(qr_img_path, x, y, width=qr_size, height=qr_size, mask='auto')  # Usar tamaño consistente
+                #     can_custom.drawImage(ImageReader(BytesIO(qr_png)), x, y, width=qr_size, height=qr_size, mask='auto')  # Usar tamaño consistente
                 #     can_custom.save()
                 #     packet_custom.seek(0)
                 #     watermark_custom = PdfReader(packet_custom)
@@ -246,88 +443,132 @@ def add_qr_to_pdf(input_pdf_path, output_pdf_path, qr_url, x=ex, y=ey):
         
         return True
     except Exception as e:
-        logger.error(f"Error al añadir QR al PDF: {str(e)}")
+        logger.error("Error al añadir QR al PDF: %s", e)
         return False
-    finally:
-        # Eliminar la imagen temporal del QR
-        if qr_img_path and os.path.exists(qr_img_path):
-            try:
-                os.remove(qr_img_path)
-            except Exception as e:
-                logger.warning(f"No se pudo eliminar la imagen temporal del QR: {str(e)}")
 
+# Reducción opcional de imágenes escaneadas antes del estampado (0 = desactivada)
+IMAGE_MAX_DPI = float(os.getenv('IMAGE_MAX_DPI', '0'))
+IMAGE_JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', '75'))
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', str(os.cpu_count() or 1)))
+
+@metrics.timed('downsample_images', is_error=lambda ok: not ok)
+def downsample_pdf_images(input_pdf_path, output_pdf_path):
+    """
+    Reescala a IMAGE_MAX_DPI las imágenes escaneadas que lo superen y las
+    recodifica como JPEG (ver pdfimages.downsample).
+
+    Returns:
+        bool: True si se generó un archivo más pequeño en output_pdf_path
+    """
+    import pdfimages
+
+    start = time.perf_counter()
+    try:
+        stats = pdfimages.downsample(input_pdf_path, output_pdf_path, IMAGE_MAX_DPI,
+                                     quality=IMAGE_JPEG_QUALITY, workers=IMAGE_WORKERS)
+    except Exception as e:
+        logger.warning("No se pudieron reducir las imágenes de %s: %s", input_pdf_path, e)
+        return False
+
+    if not stats['recompressed']:
+        logger.debug("Sin imágenes por encima de %s DPI en %s (%s revisadas)",
+                     IMAGE_MAX_DPI, input_pdf_path, stats['images'])
+        return False
+
+    logger.info("Imágenes reducidas: %s de %s, %s -> %s bytes en %.2f s",
+                stats['recompressed'], stats['images'], os.path.getsize(input_pdf_path),
+                os.path.getsize(output_pdf_path), time.perf_counter() - start)
+    return True
+
+# Optimización del PDF final antes de subirlo (objetos duplicados, streams sin comprimir)
+PDF_OPTIMIZE = os.getenv('PDF_OPTIMIZE', '1') == '1'
+
+@metrics.timed('optimize_pdf', is_error=lambda ok: not ok)
+def optimize_pdf(input_pdf_path, output_pdf_path):
+    """
+    Reescribe el PDF fusionando objetos idénticos, comprimiendo los streams sin
+    filtro y descartando objetos sin usar (ver pdfstream.optimize).
+
+    Returns:
+        bool: True si se generó un archivo más pequeño en output_pdf_path
+    """
+    try:
+        stats = pdfstream.optimize(input_pdf_path, output_pdf_path)
+    except Exception as e:
+        logger.warning("No se pudo optimizar el PDF %s: %s", input_pdf_path, e)
+        return False
+
+    size_before = os.path.getsize(input_pdf_path)
+    size_after = os.path.getsize(output_pdf_path)
+    if size_after >= size_before:
+        logger.debug("La optimización no reduce el PDF (%s -> %s bytes), se descarta", size_before, size_after)
+        return False
+
+    pdfstream.OPTIMIZE_SAVED_BYTES.inc(size_before - size_after)
+    logger.info("PDF optimizado: %s -> %s bytes (%s objetos fusionados, %s streams comprimidos)",
+                size_before, size_after, stats['deduplicated'], stats['compressed'])
+    return True
+
+# Páginas de cada PDF cuyo texto se indexa para la búsqueda (0 = no indexar)
+SEARCH_INDEX_PAGES = int(os.getenv('SEARCH_INDEX_PAGES', '2'))
+SEARCH_MAX_CHARS = 20000
+
+@metrics.timed('extract_text', is_error=lambda text: text is None)
+def extract_pdf_text(pdf_path, max_pages=SEARCH_INDEX_PAGES):
+    """
+    Extrae el texto de las primeras `max_pages` páginas para el índice de
+    búsqueda, con los espacios normalizados. Devuelve None si no se pudo leer.
+    """
+    from PyPDF2 import PdfReader
+
+    try:
+        # Lector propio: pasar por pdfcache contaría como otra vez que se ve el documento
+        with mapped.open_pdf(pdf_path) as pdf_file:
+            reader = PdfReader(pdf_file)
+            if reader.is_encrypted:
+                reader.decrypt('')
+            parts = [page.extract_text() or '' for page in reader.pages[:max_pages]]
+    except Exception as e:
+        logger.warning("No se pudo extraer el texto de %s: %s", pdf_path, e)
+        return None
+    return ' '.join(' '.join(parts).split())[:SEARCH_MAX_CHARS]
+
+@metrics.timed('create_blank_pdf_with_qr', is_error=lambda ok: not ok)
 def create_blank_pdf_with_qr(qr_url, output_path, original_pdf_path=None):
     """
     Crea un PDF en blanco con un QR usando el template estático.
     Usa el archivo blank_template.pdf de la carpeta static y le estampa el QR
     en la misma posición que se usa en los certificados.
     """
-    qr_img_path = None
+    from PyPDF2 import PdfReader, PdfWriter
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfgen import canvas
+
     try:
-        # Ruta al PDF template estático
-        template_path = os.path.join('static', 'blank_template.pdf')
-        
         # Verificar que el template existe
-        if not os.path.exists(template_path):
-            logger.error(f"No se encontró el template en: {template_path}")
+        if not os.path.exists(BLANK_TEMPLATE_PATH):
+            logger.error("No se encontró el template en: %s", BLANK_TEMPLATE_PATH)
             return False
         
-        # Generar el código QR exactamente igual que en add_qr_to_pdf
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=0,
-        )
-        qr.add_data(qr_url)
-        qr.make(fit=True)
-        
-        # Crear una imagen QR con fondo transparente (igual que en el certificado)
-        qr_img = qr.make_image(fill_color="black", back_color="white")
-        qr_img = qr_img.convert("RGBA")
-        
-        # Hacer que el fondo sea transparente (convertir el blanco a transparente)
-        datas = qr_img.getdata()
-        new_data = []
-        for item in datas:
-            # Si el pixel es blanco (255, 255, 255), hacerlo transparente
-            if item[0] == 255 and item[1] == 255 and item[2] == 255:
-                new_data.append((255, 255, 255, 0))  # RGBA con alpha=0 (transparente)
-            else:
-                new_data.append(item)
-        
-        qr_img.putdata(new_data)
-        
-        # Guardar la imagen temporal
-        qr_img_path = os.path.join(UPLOAD_FOLDER, f"qr_blank_{uuid.uuid4()}.png")
-        qr_img.save(qr_img_path, format="PNG")
+        # Generar el código QR exactamente igual que en add_qr_to_pdf (con
+        # QR_BACKEND=memo se reutiliza el PNG del certificado recién estampado)
+        with metrics.timer('qr_render'):
+            qr_png = qrencode.encoder.png(qr_url, transparent=True)
         
-        # Obtener las dimensiones del template para usar el mismo pagesize
-        page_size = letter  # Valor por defecto
-        try:
-            with open(template_path, 'rb') as file:
-                reader = PdfReader(file)
-                if len(reader.pages) > 0:
-                    page = reader.pages[0]
-                    mediabox = page.mediabox
-                    page_width = float(mediabox.width)
-                    page_height = float(mediabox.height)
-                    page_size = (page_width, page_height)
-                    logger.info(f"Usando dimensiones del template: {page_width} x {page_height} puntos")
-        except Exception as e:
-            logger.warning(f"No se pudieron extraer dimensiones del template, usando Letter: {str(e)}")
+        # El template y sus dimensiones se leen una sola vez y quedan en memoria
+        template_data, page_size = load_blank_template()
         
         # Crear un PDF temporal con el código QR usando las mismas dimensiones
         packet = BytesIO()
         can = canvas.Canvas(packet, pagesize=page_size)
-        can.drawImage(qr_img_path, ex, ey, qr_size, qr_size, mask='auto')  # mask='auto' para respetar la transparencia
+        can.drawImage(ImageReader(BytesIO(qr_png)), ex, ey, qr_size, qr_size, mask='auto')  # mask='auto' para respetar la transparencia
         can.save()
         
         # Mover al inicio del BytesIO
         packet.seek(0)
         
         # Leer el PDF template
-        with open(template_path, "rb") as template_file:
+        with BytesIO(template_data) as template_file:
             template_pdf = PdfReader(template_file)
             output = PdfWriter()
             
@@ -347,27 +588,64 @@ def create_blank_pdf_with_qr(qr_url, output_path, original_pdf_path=None):
             with open(output_path, "wb") as output_stream:
                 output.write(output_stream)
         
-        logger.info(f"PDF en blanco con QR creado exitosamente usando template: {output_path}")
+        logger.debug("PDF en blanco con QR creado exitosamente usando template: %s", output_path)
         return True
                     
     except Exception as e:
-        logger.exception(f"Error al crear PDF en blanco con QR: {str(e)}")
+        logger.exception("Error al crear PDF en blanco con QR: %s", e)
         return False
-    finally:
-        # Limpiar archivo temporal del QR
-        if qr_img_path and os.path.exists(qr_img_path):
-            try:
-                os.remove(qr_img_path)
-            except Exception as e:
-                logger.warning(f"No se pudo eliminar QR temporal: {str(e)}")
 
-def upload_to_backblaze(file_path, original_filename=None, folder="certificados"):
+# Deduplicación de subidas repetidas por hash del contenido recibido
+UPLOAD_DEDUPE = os.getenv('UPLOAD_DEDUPE', '1') == '1'
+SOURCE_HASH_METADATA = 'source-sha256'
+source_index = hashing.HashIndex(int(os.getenv('HASH_INDEX_SIZE', '10000')))
+UPLOAD_DEDUPE_TOTAL = metrics.counter(
+    'geotop_upload_dedupe_total', 'Comprobaciones de subidas repetidas por resultado', ['result'])
+
+# Subida directa: el navegador sube los PDF a STAGING_PREFIX con URLs
+# prefirmadas y el servidor solo los descarga para combinarlos y estamparlos
+DIRECT_UPLOAD = os.getenv('DIRECT_UPLOAD', '0') == '1'
+STAGING_PREFIX = os.getenv('STAGING_PREFIX', 'staging/')
+PRESIGN_EXPIRES = int(os.getenv('PRESIGN_EXPIRES', '900'))  # segundos
+STAGING_MAX_AGE = float(os.getenv('STAGING_MAX_AGE', str(24 * 3600)))  # segundos, 0 = no se borran
+
+def find_existing_upload(source_hash, file_key):
     """
-    Sube un archivo a Backblaze B2 usando la API S3 compatible y devuelve la URL pública.
-    Si el archivo es un PDF, añade un código QR antes de subirlo.
+    Busca un objeto ya subido cuyo contenido de origen tenga el mismo hash:
+    primero en la clave de destino y después en la que indique el índice de
+    hashes. Devuelve la clave encontrada o None.
+    """
+    s3_client = get_s3_client()
+    if not s3_client:
+        return None
+
+    indexed_key = source_index.get(source_hash)
+    candidates = [('target', file_key)]
+    if indexed_key and indexed_key != file_key:
+        candidates.append(('index', indexed_key))
+
+    for result, key in candidates:
+        try:
+            head = s3_client.head_object(Bucket=B2_BUCKET_NAME, Key=key)
+        except Exception:
+            continue  # No existe (o no se puede consultar): se sube de nuevo
+        if head.get('Metadata', {}).get(SOURCE_HASH_METADATA) == source_hash:
+            source_index.put(source_hash, key)
+            UPLOAD_DEDUPE_TOTAL.inc(result=result)
+            return key
+
+    if indexed_key:
+        # El objeto indexado se borró o se sobrescribió con otro contenido
+        source_index.discard(source_hash)
+    UPLOAD_DEDUPE_TOTAL.inc(result='miss')
+    return None
+
+def build_file_key(file_path, original_filename=None, folder="certificados", source_hash=None):
+    """
+    Calcula la clave del objeto en el bucket a partir del nombre original y la
+    carpeta. Con IMMUTABLE_KEYS y `source_hash` el nombre incluye el hash de
+    versión. Devuelve (clave, nombre de archivo seguro, extensión).
     """
-    logger.info(f"Iniciando carga de archivo: {file_path} en carpeta: {folder}")
-    
     # Obtener la extensión del archivo
     extension = os.path.splitext(file_path)[1].lower()
     
@@ -387,6 +665,8 @@ def upload_to_backblaze(file_path, original_filename=None, folder="certificados"
         # Si no hay nombre original, generar un UUID
         unique_id = str(uuid.uuid4()).replace("-", "")
         unique_filename = f"{unique_id}{extension}"
+    if IMMUTABLE_KEYS and source_hash:
+        unique_filename = f"{os.path.splitext(unique_filename)[0]}.{source_hash[:VERSION_HASH_LENGTH]}{extension}"
     
     # Si se especificó una carpeta, usar una versión segura
     if folder:
@@ -399,9 +679,26 @@ def upload_to_backblaze(file_path, original_filename=None, folder="certificados"
     file_key = re.sub(r'[^a-zA-Z0-9_./]', '_', file_key)
     # Asegurarse de que no haya espacios
     file_key = file_key.replace(' ', '_')
-    logger.debug(f"Nombre de archivo generado: {file_key}")
+    return file_key, unique_filename, extension
+
+def upload_to_backblaze(file_path, original_filename=None, folder="certificados", source_hash=None):
+    """
+    Sube un archivo a Backblaze B2 usando la API S3 compatible y devuelve la URL pública.
+    Si el archivo es un PDF, añade un código QR antes de subirlo. `source_hash`
+    (SHA-256 del contenido recibido, antes del estampado) se guarda como metadato
+    para reconocer subidas repetidas.
+    """
+    logger.info("Iniciando carga de archivo: %s en carpeta: %s", file_path, folder)
+    
+    if IMMUTABLE_KEYS and not source_hash:
+        source_hash = hashing.path_sha256(file_path)
+    file_key, unique_filename, extension = build_file_key(file_path, original_filename, folder, source_hash)
+    logger.debug("Nombre de archivo generado: %s", file_key)
     
     pdf_with_qr_path = None
+    downsampled_path = None
+    optimized_path = None
+    document_text = None
     try:
         # Obtener cliente S3
         s3_client = get_s3_client()
@@ -416,40 +713,74 @@ def upload_to_backblaze(file_path, original_filename=None, folder="certificados"
             content_type = "image/png"
         
         # Generar la URL pública anticipadamente para el código QR
-        public_url = f"{B2_ENDPOINT}/{B2_BUCKET_NAME}/{file_key}"
+        public_url = qr_url_for(file_key)
         # Si es un PDF, añadir el código QR
         upload_file_path = file_path  # Por defecto, usar el archivo original
+        qr_added = False
         if extension.lower() == '.pdf':
             # Crear un archivo temporal para el PDF con QR usando el mismo nombre para mantener consistencia
             pdf_with_qr_path = os.path.join(UPLOAD_FOLDER, f"qr_{unique_filename}")
             
+            # Texto de las primeras páginas para la búsqueda por contenido
+            if SEARCH_INDEX_PAGES > 0 and bucket_mirror is not None and bucket_mirror.search_enabled:
+                document_text = extract_pdf_text(file_path)
+            
+            # Reducir las imágenes escaneadas antes de estampar, así el QR no se recodifica
+            stamp_source_path = file_path
+            if IMAGE_MAX_DPI > 0:
+                downsampled_path = os.path.join(UPLOAD_FOLDER, f"img_{uuid.uuid4().hex}_{unique_filename}")
+                if downsample_pdf_images(file_path, downsampled_path):
+                    stamp_source_path = downsampled_path
+
             # Añadir el código QR al PDF
-            qr_added = add_qr_to_pdf(file_path, pdf_with_qr_path, public_url)
+            qr_added = add_qr_to_pdf(stamp_source_path, pdf_with_qr_path, public_url)
             
             if qr_added:
                 # Usar el nuevo archivo con QR para subir
                 upload_file_path = pdf_with_qr_path
-                logger.debug(f"QR añadido al PDF exitosamente: {pdf_with_qr_path}")
+                logger.debug("QR añadido al PDF exitosamente: %s", pdf_with_qr_path)
             else:
                 # Si hubo un error al añadir el QR, usar el archivo original
                 logger.warning("No se pudo añadir el QR al PDF, usando archivo original")
+
+            if PDF_OPTIMIZE:
+                optimized_path = os.path.join(UPLOAD_FOLDER, f"opt_{uuid.uuid4().hex}_{unique_filename}")
+                if optimize_pdf(upload_file_path, optimized_path):
+                    upload_file_path = optimized_path
         
         # Pequeño retraso para asegurar que el archivo esté listo
         time.sleep(0.2)
         
+        extra_args = {'ContentType': content_type}
+        extra_args.update(object_cache_args(file_key))
+        metadata = {}
+        if source_hash:
+            metadata[SOURCE_HASH_METADATA] = source_hash
+        if qr_added:
+            metadata[QR_URL_METADATA] = public_url
+            metadata[QR_STAMP_METADATA] = qr_stamp_geometry()
+        if metadata:
+            extra_args['Metadata'] = metadata
+
         # Subir el archivo
-        with open(upload_file_path, 'rb') as file_data:
-            s3_client.upload_fileobj(
-                file_data, 
-                B2_BUCKET_NAME, 
-                file_key,
-                ExtraArgs={
-                    'ContentType': content_type
-                }
+        with metrics.timer('s3_upload'), open(upload_file_path, 'rb') as file_data:
+            response = s3_client.put_object(
+                Body=file_data,
+                Bucket=B2_BUCKET_NAME,
+                Key=file_key,
+                **extra_args
             )
-        
+        metrics.B2_BYTES.inc(os.path.getsize(upload_file_path), direction='upload')
+        
+        invalidate_bucket_index()
+        if bucket_mirror is not None:
+            bucket_mirror.put(file_key, os.path.getsize(upload_file_path), response.get('ETag', '').strip('"'))
+            if document_text:
+                bucket_mirror.index_text(file_key, document_text)
+        if source_hash:
+            source_index.put(source_hash, file_key)
         logger.debug("Archivo subido exitosamente")
-        logger.info(f"URL pública generada: {public_url}")
+        logger.info("URL pública generada: %s", public_url)
         
         return public_url, None
     
@@ -463,16 +794,59 @@ def upload_to_backblaze(file_path, original_filename=None, folder="certificados"
             try:
                 # Pequeño retraso antes de intentar eliminar
                 time.sleep(0.2)
+                mapped.release(pdf_with_qr_path)
                 os.remove(pdf_with_qr_path)
-                logger.debug(f"Archivo temporal con QR eliminado: {pdf_with_qr_path}")
+                logger.debug("Archivo temporal con QR eliminado: %s", pdf_with_qr_path)
             except Exception as e:
-                logger.warning(f"No se pudo eliminar el archivo temporal con QR: {str(e)}")
+                logger.warning("No se pudo eliminar el archivo temporal con QR: %s", e)
+        for temp_path in (downsampled_path, optimized_path):
+            if temp_path and os.path.exists(temp_path):
+                try:
+                    mapped.release(temp_path)
+                    os.remove(temp_path)
+                except Exception as e:
+                    logger.warning("No se pudo eliminar el PDF temporal %s: %s", temp_path, e)
+
+# Índice en memoria del listado completo del bucket. Evita repetir
+# list_objects_v2 en cada navegación y en cada descarga de QR; se invalida
+# en cada escritura de la aplicación y caduca tras BUCKET_INDEX_TTL segundos.
+BUCKET_INDEX_TTL = float(os.getenv('BUCKET_INDEX_TTL', '15'))
+_bucket_index = {'files': None, 'expires': 0.0}
+_bucket_index_lock = threading.Lock()
+
+# Copia persistente en SQLite de los metadatos del bucket (ver bucketdb.py).
+# BUCKET_DB_PATH vacío la desactiva; BUCKET_SYNC_INTERVAL=0 no la reconcilia.
+BUCKET_DB_PATH = os.getenv('BUCKET_DB_PATH', os.path.join(UPLOAD_FOLDER, 'db', 'bucket.sqlite3'))
+BUCKET_SYNC_INTERVAL = float(os.getenv('BUCKET_SYNC_INTERVAL', '300'))
+bucket_mirror = bucketdb.BucketMirror(BUCKET_DB_PATH, B2_BUCKET_NAME, public_url_for) if BUCKET_DB_PATH else None
 
+def invalidate_bucket_index():
+    """
+    Descarta el índice del bucket tras una escritura (subida, borrado, movimiento).
+    """
+    with _bucket_index_lock:
+        _bucket_index['files'] = None
+        _bucket_index['expires'] = 0.0
+    delivery.invalidate_fragments()
+
+@metrics.timed('bucket_listing', is_error=lambda result: result[1] is not None)
 def list_files_in_bucket(prefix=None):
     """
     Lista todos los archivos en el bucket de Backblaze B2.
     Si se proporciona un prefijo, solo muestra los archivos que comienzan con ese prefijo.
+    Si la copia local en SQLite ya está reconciliada, se consulta esa copia.
     """
+    if bucket_mirror is not None and bucket_mirror.is_ready():
+        return bucket_mirror.list(prefix), None
+
+    with _bucket_index_lock:
+        cached = _bucket_index['files'] if time.monotonic() < _bucket_index['expires'] else None
+    metrics.record_cache('bucket_index', cached is not None)
+    if cached is not None:
+        if prefix:
+            return [f for f in cached if f['name'].startswith(prefix)], None
+        return list(cached), None
+
     try:
         # Obtener cliente S3
         s3_client = get_s3_client()
@@ -485,6 +859,7 @@ def list_files_in_bucket(prefix=None):
             params['Prefix'] = prefix
         
         # Listar objetos
+        listed_at = time.monotonic()
         response = s3_client.list_objects_v2(**params)
         
         files = []
@@ -492,27 +867,100 @@ def list_files_in_bucket(prefix=None):
             for obj in response['Contents']:
                 # Usar solo la información básica de list_objects_v2 sin head_object
                 file_key = obj['Key']
+                # Los PDF en staging aún no están procesados
+                if file_key.startswith(STAGING_PREFIX):
+                    continue
                 
                 files.append({
                     'name': file_key,
                     'id': obj['ETag'].strip('"'),
                     'size': obj['Size'],
                     'upload_timestamp': int(obj['LastModified'].timestamp() * 1000),  # Convertir a milisegundos
-                    'url': f"{B2_ENDPOINT}/{B2_BUCKET_NAME}/{file_key}"
+                    'url': public_url_for(file_key)
                 })
         
+        # Solo el listado completo alimenta el índice
+        if not prefix and BUCKET_INDEX_TTL > 0:
+            with _bucket_index_lock:
+                _bucket_index['files'] = files
+                _bucket_index['expires'] = listed_at + BUCKET_INDEX_TTL
+            files = list(files)
+        
         return files, None
     except Exception as e:
         error_msg = f"Error al listar archivos: {str(e)}"
         logger.exception(error_msg)
         return None, error_msg
 
-def get_folders_structure():
+def find_bucket_file(file_name):
+    """
+    Busca un archivo del bucket por su clave. Devuelve (info, error) con info
+    None si no existe.
+    """
+    if bucket_mirror is not None and bucket_mirror.is_ready():
+        return bucket_mirror.get(file_name), None
+    files_data, error = list_files_in_bucket()
+    if error:
+        return None, error
+    for file_info in files_data:
+        if file_info['name'] == file_name:
+            return file_info, None
+    return None, None
+
+FOLDER_PLACEHOLDER = '.folder_placeholder'
+
+def _mirror_folders_structure(folder_path=None):
+    """
+    Estructura de carpetas desde la copia local: las carpetas y sus totales
+    salen del índice por carpeta y solo se leen los archivos de `folder_path`
+    (todos si es None).
+    """
+    folders = {}
+
+    def add_folder(path, file_count=0):
+        if path not in folders:
+            folders[path] = {'name': path, 'files': [], 'subfolders': set(), 'file_count': 0}
+        folders[path]['file_count'] += file_count
+
+    for folder, file_count in bucket_mirror.folder_counts(FOLDER_PLACEHOLDER):
+        if not folder:
+            if file_count:
+                add_folder('root', file_count)
+            continue
+        parts = folder.split('/')
+        for i in range(len(parts)):
+            add_folder('/'.join(parts[:i + 1]))
+            if i > 0:
+                folders['/'.join(parts[:i])]['subfolders'].add('/'.join(parts[:i + 1]))
+        folders[folder]['file_count'] += file_count
+
+    if folder_path is None:
+        files = bucket_mirror.list()
+    else:
+        files = bucket_mirror.list_folder('' if folder_path == 'root' else folder_path)
+    for file in files:
+        folder, filename = bucketdb.folder_of(file['name']), file['name'].rsplit('/', 1)[-1]
+        if filename == FOLDER_PLACEHOLDER:
+            continue
+        file['filename'] = filename
+        folders[folder or 'root']['files'].append(file)
+
+    for folder in folders.values():
+        folder['subfolders'] = list(folder['subfolders'])
+    return folders
+
+@metrics.timed('get_folders_structure', is_error=lambda result: result[1] is not None)
+def get_folders_structure(folder_path=None):
     """
     Obtiene la estructura de carpetas basada en los archivos existentes en el bucket.
-    Retorna un diccionario con carpetas y sus archivos.
+    Retorna un diccionario con carpetas y sus archivos. Con la copia local
+    reconciliada y `folder_path`, solo se incluyen los archivos de esa carpeta
+    (las demás llevan su total en 'file_count').
     """
     try:
+        if bucket_mirror is not None and bucket_mirror.is_ready():
+            return _mirror_folders_structure(folder_path), None
+
         files, error = list_files_in_bucket()
         if error:
             return None, error
@@ -539,7 +987,7 @@ def get_folders_structure():
                     }
                 
                 # Filtrar archivos .folder_placeholder pero mantener la carpeta
-                if filename == '.folder_placeholder':
+                if filename == FOLDER_PLACEHOLDER:
                     continue
                 
                 # Añadir archivo a la carpeta
@@ -566,7 +1014,7 @@ def get_folders_structure():
                 filename = file_path
                 
                 # Filtrar archivos .folder_placeholder
-                if filename == '.folder_placeholder':
+                if filename == FOLDER_PLACEHOLDER:
                     continue
                 
                 if 'root' not in folders:
@@ -582,6 +1030,7 @@ def get_folders_structure():
         # Convertir sets a listas para JSON serialization
         for folder in folders.values():
             folder['subfolders'] = list(folder['subfolders'])
+            folder['file_count'] = len(folder['files'])
         
         return folders, None
     except Exception as e:
@@ -621,14 +1070,17 @@ def create_folder(folder_path):
             pass  # La carpeta no existe, podemos crearla
         
         # Subir el archivo placeholder
-        s3_client.put_object(
+        response = s3_client.put_object(
             Bucket=B2_BUCKET_NAME,
             Key=placeholder_key,
             Body=b'',
             ContentType='text/plain'
         )
+        invalidate_bucket_index()
+        if bucket_mirror is not None:
+            bucket_mirror.put(placeholder_key, 0, response.get('ETag', '').strip('"'))
         
-        logger.info(f"Carpeta creada: {folder_path}")
+        logger.info("Carpeta creada: %s", folder_path)
         return True, None
         
     except Exception as e:
@@ -663,8 +1115,11 @@ def delete_folder(folder_path):
                 Bucket=B2_BUCKET_NAME,
                 Delete={'Objects': objects_to_delete}
             )
+            invalidate_bucket_index()
+            if bucket_mirror is not None:
+                bucket_mirror.delete(obj['Key'] for obj in objects_to_delete)
         
-        logger.info(f"Carpeta eliminada: {folder_path}")
+        logger.info("Carpeta eliminada: %s", folder_path)
         return True, None
         
     except Exception as e:
@@ -682,12 +1137,20 @@ def move_file(old_path, new_path):
         if not s3_client:
             return False, "Error al conectar con Backblaze B2"
         
-        # Copiar el archivo a la nueva ubicación
+        # Copiar el archivo a la nueva ubicación. Si hay cabeceras de caché que
+        # dependen del nombre, se reemplazan conservando tipo y metadatos
         copy_source = {'Bucket': B2_BUCKET_NAME, 'Key': old_path}
+        copy_args = {}
+        cache_args = object_cache_args(new_path)
+        if cache_args:
+            head = s3_client.head_object(Bucket=B2_BUCKET_NAME, Key=old_path)
+            copy_args = dict(cache_args, MetadataDirective='REPLACE', Metadata=head.get('Metadata', {}),
+                             ContentType=head.get('ContentType') or 'application/octet-stream')
         s3_client.copy_object(
             CopySource=copy_source,
             Bucket=B2_BUCKET_NAME,
-            Key=new_path
+            Key=new_path,
+            **copy_args
         )
         
         # Eliminar el archivo original
@@ -695,8 +1158,11 @@ def move_file(old_path, new_path):
             Bucket=B2_BUCKET_NAME,
             Key=old_path
         )
+        invalidate_bucket_index()
+        if bucket_mirror is not None:
+            bucket_mirror.move(old_path, new_path)
         
-        logger.info(f"Archivo movido de {old_path} a {new_path}")
+        logger.info("Archivo movido de %s a %s", old_path, new_path)
         return True, None
         
     except Exception as e:
@@ -719,8 +1185,11 @@ def delete_file(file_name):
             Bucket=B2_BUCKET_NAME,
             Key=file_name
         )
+        invalidate_bucket_index()
+        if bucket_mirror is not None:
+            bucket_mirror.delete([file_name])
         
-        logger.info(f"Archivo {file_name} eliminado exitosamente")
+        logger.info("Archivo %s eliminado exitosamente", file_name)
         return True, None
     
     except Exception as e:
@@ -730,8 +1199,9 @@ def delete_file(file_name):
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', max_upload_mb=MAX_UPLOAD_MB, direct_upload=DIRECT_UPLOAD)
 
+@metrics.timed('merge_pdfs', is_error=lambda ok: not ok)
 def merge_pdfs(pdf_paths, output_path):
     """
     Combina múltiples archivos PDF en uno solo.
@@ -743,17 +1213,42 @@ def merge_pdfs(pdf_paths, output_path):
     Returns:
         bool: True si la combinación fue exitosa, False en caso contrario
     """
+    with metrics.MemoryProbe() as probe:
+        if MERGE_MODE == 'stream':
+            merged = _merge_pdfs_streaming(pdf_paths, output_path)
+        else:
+            merged = _merge_pdfs_in_memory(pdf_paths, output_path)
+    if probe.peak is not None:
+        pdfstream.MERGE_PEAK_MEMORY.observe(probe.peak, mode=MERGE_MODE)
+        logger.info("Pico de memoria al combinar %s PDFs (%s, %s): %.1f MB",
+                    len(pdf_paths), MERGE_MODE, probe.source, probe.peak / (1024 * 1024))
+    return merged
+
+def _merge_pdfs_streaming(pdf_paths, output_path):
+    try:
+        total_pages = pdfstream.merge(pdf_paths, output_path, reader_for=pdfcache.reader_for)
+        if total_pages == 0:
+            logger.error("No se pudieron agregar páginas de ningún PDF")
+            return False
+        logger.info("PDFs combinados exitosamente en: %s (%s páginas totales)", output_path, total_pages)
+        return True
+
+    except Exception as e:
+        logger.error("Error al combinar PDFs: %s", e)
+        return False
+
+def _merge_pdfs_in_memory(pdf_paths, output_path):
+    from PyPDF2 import PdfWriter
+
     try:
         pdf_writer = PdfWriter()
         
         for pdf_path in pdf_paths:
             try:
-                with open(pdf_path, 'rb') as pdf_file:
-                    pdf_reader = PdfReader(pdf_file)
-                    
+                with pdfcache.reader_for(pdf_path) as (pdf_reader, _):
                     # Verificar que el PDF no esté corrupto
                     if len(pdf_reader.pages) == 0:
-                        logger.warning(f"PDF vacío o corrupto: {pdf_path}")
+                        logger.warning("PDF vacío o corrupto: %s", pdf_path)
                         continue
                     
                     # Agregar todas las páginas del PDF actual
@@ -761,10 +1256,11 @@ def merge_pdfs(pdf_paths, output_path):
                         page = pdf_reader.pages[page_num]
                         pdf_writer.add_page(page)
                     
-                    logger.info(f"PDF agregado exitosamente: {pdf_path} ({len(pdf_reader.pages)} páginas)")
+                    logger.debug("PDF agregado exitosamente: %s (%s páginas)", pdf_path, len(pdf_reader.pages),
+                                 extra={'sample_rate': LOG_SAMPLE_RATE})
                     
-            except (PdfReadError, Exception) as e:
-                logger.error(f"Error al leer PDF {pdf_path}: {str(e)}")
+            except Exception as e:
+                logger.error("Error al leer PDF %s: %s", pdf_path, e)
                 continue
         
         # Verificar que tengamos al menos una página
@@ -776,14 +1272,16 @@ def merge_pdfs(pdf_paths, output_path):
         with open(output_path, 'wb') as output_file:
             pdf_writer.write(output_file)
         
-        logger.info(f"PDFs combinados exitosamente en: {output_path} ({len(pdf_writer.pages)} páginas totales)")
+        logger.info("PDFs combinados exitosamente en: %s (%s páginas totales)", output_path, len(pdf_writer.pages))
         return True
         
     except Exception as e:
-        logger.error(f"Error al combinar PDFs: {str(e)}")
+        logger.error("Error al combinar PDFs: %s", e)
         return False
 
 @app.route('/upload', methods=['POST'])
+@admission.limited('upload', read_body=True)
+@profiling.profiled
 def upload_file():
     logger.info("Solicitud de carga de archivo recibida")
     
@@ -810,132 +1308,539 @@ def upload_file():
     
     # Obtener el índice del archivo que debe tener el QR
     qr_file_index = int(request.form.get('qr_file_index', 0))
-    logger.info(f"Índice del archivo para QR: {qr_file_index}")
+    logger.debug("Índice del archivo para QR: %s", qr_file_index)
     
     temp_files = []
-    final_pdf_path = None
     
     try:
-        logger.info(f"Procesando {len(valid_files)} archivo(s)")
+        logger.info("Procesando %s archivo(s)", len(valid_files))
         
         # Reorganizar archivos para que el archivo con QR esté primero
-        if len(valid_files) > 1 and 0 <= qr_file_index < len(valid_files):
-            # Mover el archivo seleccionado para QR al inicio
-            qr_file = valid_files.pop(qr_file_index)
-            valid_files.insert(0, qr_file)
-            logger.info(f"Archivo reorganizado: '{qr_file.filename}' movido a la primera posición para QR")
+        valid_files = move_qr_file_first(valid_files, qr_file_index)
+        
+        # Rechazar lo que no es un PDF antes de guardar ni procesar nada
+        for file in valid_files:
+            _, error = pdfcheck.check_upload(file)
+            if error is None and len(valid_files) > 1 and pdfcheck.is_image(file.filename):
+                error = 'solo se pueden combinar archivos PDF'
+            if error:
+                logger.warning("Archivo rechazado '%s': %s", file.filename, error)
+                flash(f"No se pudo procesar '{file.filename}': {error}", 'error')
+                return redirect(url_for('index'))
         
         # Guardar todos los archivos temporalmente (ya reorganizados)
-        for i, file in enumerate(valid_files):
-            temp_filename = f"{uuid.uuid4()}_{i}_{file.filename}"
-            temp_filepath = os.path.join(app.config['UPLOAD_FOLDER'], temp_filename)
-            file.save(temp_filepath)
-            temp_files.append(temp_filepath)
-            logger.info(f"Archivo {i+1} guardado temporalmente: {temp_filepath} ({'CON QR' if i == 0 else 'sin QR'})")
-        
+        with metrics.timer('save_files'):
+            for i, file in enumerate(valid_files):
+                temp_filename = f"{uuid.uuid4()}_{i}_{file.filename}"
+                temp_filepath = os.path.join(app.config['UPLOAD_FOLDER'], temp_filename)
+                file.save(temp_filepath)
+                temp_files.append(temp_filepath)
+                logger.debug("Archivo %s guardado temporalmente: %s (%s)", i+1, temp_filepath, 'CON QR' if i == 0 else 'sin QR')
+        
+        # Comprobar que cada PDF se pueda abrir (páginas, cifrado) antes de combinar o estampar
+        with metrics.timer('validate_files'):
+            for file, temp_filepath in zip(valid_files, temp_files):
+                pages, error = pdfcheck.check_upload(file, temp_filepath)
+                if error:
+                    logger.warning("Archivo rechazado '%s': %s", file.filename, error)
+                    flash(f"No se pudo procesar '{file.filename}': {error}", 'error')
+                    return redirect(url_for('index'))
+                logger.debug("Archivo '%s' validado: %s página(s)", file.filename, pages)
+        
+        result, error = process_pdf_package(temp_files, [f.filename for f in valid_files], target_folder,
+                                             [hashing.file_sha256(f) for f in valid_files])
+        return render_package_result(result, error)
+    except Exception as e:
+        logger.exception("Error en el proceso de carga: %s", e)
+        flash(f'Error en el proceso de carga: {str(e)}', 'error')
+        return redirect(url_for('index'))
+    finally:
+        # Asegurarse de que todos los archivos temporales se eliminen si ocurre una excepción
+        remove_temp_files(temp_files, "en finally")
+
+def move_qr_file_first(items, qr_file_index):
+    """
+    Devuelve `items` con el elemento que debe llevar el QR en la primera posición.
+    """
+    items = list(items)
+    if len(items) > 1 and 0 <= qr_file_index < len(items):
+        # Mover el archivo seleccionado para QR al inicio
+        qr_item = items.pop(qr_file_index)
+        items.insert(0, qr_item)
+        logger.info("Archivo reorganizado: índice %s movido a la primera posición para QR", qr_file_index)
+    return items
+
+def remove_temp_files(paths, context=""):
+    """
+    Elimina los archivos temporales que sigan existiendo.
+    """
+    for temp_file in paths:
+        if temp_file and os.path.exists(temp_file):
+            try:
+                mapped.release(temp_file)
+                os.remove(temp_file)
+                logger.debug("Archivo temporal eliminado %s: %s", context, temp_file)
+            except Exception as e:
+                # Si no se puede eliminar, simplemente lo registramos
+                logger.warning("No se pudo eliminar el archivo temporal %s: %s", temp_file, e)
+
+def process_pdf_package(temp_files, filenames, target_folder, file_hashes):
+    """
+    Procesa un paquete de PDFs ya guardados y validados (el primero es el que
+    lleva el QR): lo combina si hay varios, lo estampa, lo sube a la carpeta de
+    destino y genera el PDF en blanco con QR. Lo usan la subida a través del
+    servidor y la subida directa al bucket. Los archivos de `temp_files` se
+    eliminan al terminar.
+
+    Devuelve (resultado, error); el resultado es un dict con url, filename,
+    blank_pdf, files_count y duplicate.
+    """
+    final_pdf_path = None
+    try:
+        # Nombre con el que se publicará el archivo (el combinado toma el del primero)
+        if len(filenames) > 1:
+            original_filename = f"{os.path.splitext(filenames[0])[0]}_combinado.pdf"
+        else:
+            original_filename = filenames[0]
+        
+        # Si el mismo contenido ya está subido, reutilizarlo sin combinar, estampar ni subir
+        source_hash = hashing.combined_sha256(file_hashes)
+        duplicate_key = None
+        if UPLOAD_DEDUPE:
+            target_key = build_file_key(original_filename, original_filename, target_folder, source_hash)[0]
+            duplicate_key = find_existing_upload(source_hash, target_key)
+        
+        if duplicate_key:
+            logger.info("Contenido ya subido en %s (sha256 %s), se omiten el estampado y la subida",
+                        duplicate_key, source_hash)
         # Si hay múltiples archivos, combinarlos
-        if len(valid_files) > 1:
-            # Crear nombre para el archivo combinado
-            first_filename = valid_files[0].filename
-            base_name = os.path.splitext(first_filename)[0]
-            combined_filename = f"{base_name}_combinado.pdf"
-            final_pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], f"combined_{uuid.uuid4()}.pdf")
+        elif len(temp_files) > 1:
+            final_pdf_path = os.path.join(UPLOAD_FOLDER, f"combined_{uuid.uuid4()}.pdf")
             
             # Combinar los PDFs
             if merge_pdfs(temp_files, final_pdf_path):
-                logger.info(f"PDFs combinados exitosamente en: {final_pdf_path}")
-                original_filename = combined_filename
+                logger.info("PDFs combinados exitosamente en: %s", final_pdf_path)
             else:
                 logger.error("Error al combinar PDFs")
-                flash('Error al combinar los archivos PDF', 'error')
-                return redirect(url_for('index'))
+                return None, 'Error al combinar los archivos PDF'
         else:
             # Solo un archivo, usar directamente
             final_pdf_path = temp_files[0]
-            original_filename = valid_files[0].filename
         
-        logger.info(f"Archivo final para subir: {final_pdf_path}")
-        logger.info(f"Nombre original del archivo: {original_filename}")
-        logger.info(f"Carpeta de destino: {target_folder}")
+        logger.debug("Archivo final para subir: %s", final_pdf_path)
+        logger.debug("Nombre original del archivo: %s", original_filename)
+        logger.debug("Carpeta de destino: %s", target_folder)
         
         # Subir a Backblaze B2 con el nombre original y carpeta especificada
-        cloud_url, error = upload_to_backblaze(final_pdf_path, original_filename=original_filename, folder=target_folder)
+        if duplicate_key:
+            cloud_url, error = qr_url_for(duplicate_key), None
+        else:
+            cloud_url, error = upload_to_backblaze(final_pdf_path, original_filename=original_filename,
+                                                   folder=target_folder, source_hash=source_hash)
         
-        if cloud_url:
-            # Crear PDF en blanco con QR ANTES de eliminar los archivos temporales
-            # para que create_blank_pdf_with_qr pueda acceder al archivo original
-            blank_pdf_filename = f"blank_{os.path.splitext(original_filename)[0]}.pdf"
-            blank_pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], blank_pdf_filename)
-            
-            # Generar PDF en blanco con QR usando las dimensiones exactas del PDF final
-            blank_pdf_created = create_blank_pdf_with_qr(cloud_url, blank_pdf_path, final_pdf_path)
-            
-            # Pequeño retraso para asegurar que los archivos no estén en uso
-            time.sleep(0.5)
-            
-            # Limpiar todos los archivos temporales
-            for temp_file in temp_files:
-                if os.path.exists(temp_file):
-                    try:
-                        os.remove(temp_file)
-                        logger.debug(f"Archivo temporal eliminado: {temp_file}")
-                    except Exception as e:
-                        logger.warning(f"No se pudo eliminar el archivo temporal {temp_file}: {str(e)}")
-            
-            # Si se creó un archivo combinado separado, también eliminarlo
-            if len(valid_files) > 1 and final_pdf_path and os.path.exists(final_pdf_path):
-                try:
-                    os.remove(final_pdf_path)
-                    logger.debug(f"Archivo combinado temporal eliminado: {final_pdf_path}")
-                except Exception as e:
-                    logger.warning(f"No se pudo eliminar el archivo combinado temporal: {str(e)}")
-            
-            if blank_pdf_created:
-                logger.info(f"PDF en blanco creado localmente: {blank_pdf_path}")
-            else:
-                logger.error("Error al crear PDF en blanco con QR")
-                blank_pdf_filename = None
-            
-            files_count = len(valid_files)
-            success_message = f'¡{files_count} archivo(s) combinado(s) y subido(s) con éxito!' if files_count > 1 else '¡Archivo subido con éxito!'
-            logger.info(f"Archivos procesados exitosamente: {files_count} archivo(s)")
-            flash(success_message, 'success')
-            return render_template('success.html', url=cloud_url, filename=original_filename, blank_pdf=blank_pdf_filename if blank_pdf_created else None)
+        if not cloud_url:
+            logger.error("Error al subir el archivo: %s", error)
+            return None, f'Error al subir el archivo: {error}'
+        
+        # Crear PDF en blanco con QR ANTES de eliminar los archivos temporales
+        # para que create_blank_pdf_with_qr pueda acceder al archivo original
+        blank_pdf_filename = f"blank_{os.path.splitext(original_filename)[0]}.pdf"
+        
+        # Generar PDF en blanco con QR en el almacén de artefactos (escritura atómica)
+        blank_pdf_path = artifact_store.produce(
+            blank_pdf_filename, lambda tmp_path: create_blank_pdf_with_qr(cloud_url, tmp_path, final_pdf_path))
+        
+        # Pequeño retraso para asegurar que los archivos no estén en uso
+        time.sleep(0.5)
+        
+        if blank_pdf_path is not None:
+            logger.info("PDF en blanco creado localmente: %s", blank_pdf_path)
         else:
-            logger.error(f"Error al subir el archivo: {error}")
-            flash(f'Error al subir el archivo: {error}', 'error')
-            return redirect(url_for('index'))
+            logger.error("Error al crear PDF en blanco con QR")
+            blank_pdf_filename = None
+        
+        logger.info("Archivos procesados exitosamente: %s archivo(s)", len(filenames))
+        return {
+            'url': cloud_url,
+            'filename': original_filename,
+            'blank_pdf': blank_pdf_filename,
+            'files_count': len(filenames),
+            'duplicate': duplicate_key is not None,
+        }, None
+    finally:
+        # Limpiar todos los archivos temporales y, si se creó, el combinado
+        remove_temp_files(temp_files)
+        if len(temp_files) > 1:
+            remove_temp_files([final_pdf_path], "(combinado)")
+
+def render_package_result(result, error):
+    """
+    Muestra el resultado de process_pdf_package: la página de éxito o el
+    formulario con el error.
+    """
+    if error:
+        flash(error, 'error')
+        return redirect(url_for('index'))
+    
+    files_count = result['files_count']
+    success_message = f'¡{files_count} archivo(s) combinado(s) y subido(s) con éxito!' if files_count > 1 else '¡Archivo subido con éxito!'
+    if result['duplicate']:
+        success_message = '¡Este contenido ya estaba subido! Se reutilizó el enlace existente.'
+    flash(success_message, 'success')
+    return render_template('success.html', url=result['url'], filename=result['filename'], blank_pdf=result['blank_pdf'],
+                           blank_key=key_from_public_url(result['url']))
+
+def staging_key(upload_id, index, filename):
+    """
+    Clave temporal de un archivo de una subida directa.
+    """
+    safe_name = re.sub(r'[^a-zA-Z0-9_.]', '_', os.path.basename(filename))
+    return f"{STAGING_PREFIX}{upload_id}/{index}_{safe_name}"
+
+@app.route('/api/uploads/presign', methods=['POST'])
+def presign_upload():
+    """
+    Prepara una subida directa: devuelve un identificador de subida y una URL
+    PUT prefirmada en el prefijo de staging para cada archivo.
+    """
+    if not DIRECT_UPLOAD:
+        abort(404)
+    payload = request.get_json(silent=True)
+    files = payload.get('files') if isinstance(payload, dict) else None
+    if not files:
+        return jsonify({'error': 'No se seleccionaron archivos'}), 400
+    if not isinstance(files, list) or not all(isinstance(file, dict) for file in files):
+        return jsonify({'error': 'Formato de la petición no válido'}), 400
+    
+    max_bytes = MAX_UPLOAD_MB * 1024 * 1024
+    sizes = []
+    for file in files:
+        name = str(file.get('name', ''))
+        try:
+            size = int(file.get('size'))
+        except (TypeError, ValueError):
+            return jsonify({'error': f"Tamaño no válido para el archivo '{name}'"}), 400
+        if not name.lower().endswith('.pdf'):
+            return jsonify({'error': f"El archivo '{name}' no es un PDF"}), 400
+        if size <= 0:
+            return jsonify({'error': f"El archivo '{name}' está vacío"}), 400
+        if size > max_bytes:
+            return jsonify({'error': f"El archivo '{name}' supera el máximo de {MAX_UPLOAD_MB}MB"}), 400
+        sizes.append(size)
+    
+    s3_client = get_s3_client()
+    if not s3_client:
+        return jsonify({'error': 'Error al conectar con Backblaze B2'}), 502
+    
+    upload_id = uuid.uuid4().hex
+    entries = []
+    for i, (file, size) in enumerate(zip(files, sizes)):
+        key = staging_key(upload_id, i, str(file['name']))
+        # Content-Length firmado: el PUT solo se acepta con el tamaño declarado
+        url = s3_client.generate_presigned_url(
+            'put_object',
+            Params={'Bucket': B2_BUCKET_NAME, 'Key': key, 'ContentType': 'application/pdf', 'ContentLength': size},
+            ExpiresIn=PRESIGN_EXPIRES)
+        entries.append({'name': file['name'], 'key': key, 'url': url})
+    logger.info("Subida directa %s preparada: %s archivo(s)", upload_id, len(entries))
+    return jsonify({'upload_id': upload_id, 'files': entries, 'complete_url': url_for('complete_direct_upload')})
+
+@app.route('/upload/complete', methods=['POST'])
+@admission.limited('upload')
+@profiling.profiled
+def complete_direct_upload():
+    """
+    Termina una subida directa: descarga los PDF del prefijo de staging, los
+    valida y los procesa igual que /upload. Los objetos de staging se borran
+    al terminar, haya ido bien o no.
+    """
+    if not DIRECT_UPLOAD:
+        abort(404)
+    upload_id = request.form.get('upload_id', '')
+    keys = request.form.getlist('keys')
+    names = request.form.getlist('names')
+    if not re.fullmatch(r'[0-9a-f]{32}', upload_id) or not keys or len(keys) != len(names):
+        flash('Subida directa no válida', 'error')
+        return redirect(url_for('index'))
+    if any(not key.startswith(f"{STAGING_PREFIX}{upload_id}/") for key in keys):
+        flash('Subida directa no válida', 'error')
+        return redirect(url_for('index'))
+    
+    target_folder = request.form.get('target_folder', 'certificados').strip()
+    if target_folder == 'root':
+        target_folder = 'certificados'
+    qr_file_index = int(request.form.get('qr_file_index', 0))
+    
+    s3_client = get_s3_client()
+    if not s3_client:
+        flash('Error al conectar con Backblaze B2', 'error')
+        return redirect(url_for('index'))
+    
+    staged = move_qr_file_first(list(zip(keys, names)), qr_file_index)
+    temp_files = []
+    try:
+        # Descargar y validar cada archivo antes de combinar o estampar
+        max_bytes = MAX_UPLOAD_MB * 1024 * 1024
+        with metrics.timer('fetch_staged'):
+            for i, (key, name) in enumerate(staged):
+                head = s3_client.head_object(Bucket=B2_BUCKET_NAME, Key=key)
+                if head['ContentLength'] > max_bytes:
+                    flash(f"No se pudo procesar '{name}': supera el máximo de {MAX_UPLOAD_MB}MB", 'error')
+                    return redirect(url_for('index'))
+                temp_filepath = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4()}_{i}_{os.path.basename(key)}")
+                temp_files.append(temp_filepath)
+                s3_client.download_file(B2_BUCKET_NAME, key, temp_filepath)
+                metrics.B2_BYTES.inc(head['ContentLength'], direction='download')
+        
+        with metrics.timer('validate_files'):
+            for (key, name), temp_filepath in zip(staged, temp_files):
+                pages, error = pdfcheck.check_file(temp_filepath)
+                if error:
+                    logger.warning("Archivo rechazado '%s': %s", name, error)
+                    flash(f"No se pudo procesar '{name}': {error}", 'error')
+                    return redirect(url_for('index'))
+                logger.debug("Archivo '%s' validado: %s página(s)", name, pages)
+        
+        result, error = process_pdf_package(temp_files, [name for _, name in staged], target_folder,
+                                             [hashing.path_sha256(path) for path in temp_files])
+        return render_package_result(result, error)
     except Exception as e:
-        logger.exception(f"Error en el proceso de carga: {str(e)}")
+        logger.exception("Error en la subida directa %s: %s", upload_id, e)
         flash(f'Error en el proceso de carga: {str(e)}', 'error')
         return redirect(url_for('index'))
     finally:
-        # Asegurarse de que todos los archivos temporales se eliminen si ocurre una excepción
-        for temp_file in temp_files:
-            if os.path.exists(temp_file):
+        remove_temp_files(temp_files, "en finally")
+        try:
+            s3_client.delete_objects(Bucket=B2_BUCKET_NAME,
+                                     Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+        except Exception as e:
+            logger.warning("No se pudieron borrar los archivos de staging de %s: %s", upload_id, e)
+
+# API por lotes para integraciones (ERP): un manifiesto con varios
+# certificados, cada uno con su carpeta y los PDF que se combinan en él
+BATCH_API_TOKEN = os.getenv('BATCH_API_TOKEN')
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', '2'))
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '100'))
+
+BATCH_ITEMS = metrics.counter('geotop_batch_items_total', 'Certificados procesados por el API por lotes', ['status'])
+
+def parse_batch_request():
+    """
+    Lee el manifiesto del lote, en JSON (archivos en base64) o multipart (campo
+    `manifest` y los archivos en `files`), y guarda los archivos en
+    UPLOAD_FOLDER. Devuelve (elementos, error). Los errores de un elemento
+    concreto (un archivo que falta o mal codificado) se guardan en el propio
+    elemento para responderlos junto al resto.
+    """
+    if request.is_json:
+        manifest = request.get_json(silent=True)
+        uploads = None
+    else:
+        try:
+            manifest = json.loads(request.form.get('manifest', ''))
+        except ValueError:
+            return None, 'El campo manifest no es un JSON válido'
+        uploads = {}
+        for file in request.files.getlist('files'):
+            if file.filename in uploads:
+                return None, f"El archivo '{file.filename}' está repetido"
+            if file.filename:
+                uploads[file.filename] = file
+
+    entries = manifest.get('items') if isinstance(manifest, dict) else None
+    if not isinstance(entries, list) or not entries:
+        return None, 'El manifiesto no tiene elementos (items)'
+    if len(entries) > BATCH_MAX_ITEMS:
+        return None, f'El lote supera el máximo de {BATCH_MAX_ITEMS} elementos'
+
+    # Primero se valida todo el manifiesto, así un error no deja archivos guardados
+    qr_file_indexes = []
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not isinstance(entry.get('files'), list) or not entry['files']:
+            return None, f'El elemento {index} no tiene archivos (files)'
+        qr_file_index = entry.get('qr_file_index')
+        try:
+            qr_file_indexes.append(0 if qr_file_index is None else int(qr_file_index))
+        except (TypeError, ValueError):
+            return None, f'El elemento {index} tiene un qr_file_index no válido'
+
+    items = []
+    for index, (entry, qr_file_index) in enumerate(zip(entries, qr_file_indexes)):
+        folder = str(entry.get('folder') or 'certificados').strip()
+        item = {'index': index, 'id': str(entry.get('id', index)),
+                'folder': 'certificados' if folder == 'root' else folder,
+                'filenames': [], 'temp_files': [], 'uploads': [], 'file_hashes': []}
+        items.append(item)
+        refs = move_qr_file_first(entry['files'], qr_file_index)
+        for i, ref in enumerate(refs):
+            if uploads is None:
+                name = str(ref.get('filename', '')) if isinstance(ref, dict) else ''
                 try:
-                    os.remove(temp_file)
-                    logger.debug(f"Archivo temporal eliminado en finally: {temp_file}")
-                except Exception:
-                    # Si no se puede eliminar, simplemente lo registramos
-                    pass
-        
-        # También limpiar el archivo combinado si existe
-        if final_pdf_path and len(temp_files) > 1 and os.path.exists(final_pdf_path):
-            try:
-                os.remove(final_pdf_path)
-                logger.debug(f"Archivo combinado eliminado en finally: {final_pdf_path}")
-            except Exception:
-                pass
+                    data = base64.b64decode(ref.get('content', ''), validate=True) if name else None
+                except (binascii.Error, ValueError, TypeError):
+                    data = None
+                if data is None:
+                    item['error'] = f"El archivo {i} no tiene filename y content en base64"
+                    break
+                file = None
+            else:
+                name = str(ref)
+                file = uploads.get(name)
+                if file is None:
+                    item['error'] = f"Falta el archivo '{name}'"
+                    break
+            safe_name = re.sub(r'[^a-zA-Z0-9_.]', '_', os.path.basename(name))
+            temp_filepath = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4()}_{i}_{safe_name}")
+            if file is None:
+                with open(temp_filepath, 'wb') as f:
+                    f.write(data)
+            else:
+                # El mismo archivo puede aparecer en varios elementos
+                file.stream.seek(0)
+                file.save(temp_filepath)
+            item['filenames'].append(name)
+            item['temp_files'].append(temp_filepath)
+            item['uploads'].append(file)
+    return items, None
+
+def process_batch_item(item):
+    """
+    Valida y procesa un elemento del lote con process_pdf_package. Se ejecuta
+    en los hilos del lote; devuelve el resultado para la respuesta.
+    """
+    result = {'id': item['id'], 'index': item['index']}
+    error = item.get('error')
+    try:
+        max_bytes = MAX_UPLOAD_MB * 1024 * 1024
+        for name, path, file in zip(item['filenames'], item['temp_files'], item['uploads']):
+            if error:
+                break
+            if len(item['filenames']) > 1 and pdfcheck.is_image(name):
+                error = 'solo se pueden combinar archivos PDF'
+            elif os.path.getsize(path) > max_bytes:
+                error = f'supera el máximo de {MAX_UPLOAD_MB}MB'
+            elif file is not None:
+                error = pdfcheck.check_upload(file, path)[1]
+            elif not pdfcheck.is_image(name):
+                error = pdfcheck.check_file(path)[1]
+            if error:
+                error = f"No se pudo procesar '{name}': {error}"
+            else:
+                item['file_hashes'].append(hashing.file_sha256(file) if file is not None else hashing.path_sha256(path))
+        if not error:
+            package, error = process_pdf_package(item['temp_files'], item['filenames'], item['folder'],
+                                                 item['file_hashes'])
+            # process_pdf_package ya eliminó los temporales
+            item['temp_files'] = []
+            if package:
+                result.update(status='ok', url=package['url'], filename=package['filename'],
+                              blank_pdf=package['blank_pdf'], duplicate=package['duplicate'])
+    except Exception as e:
+        logger.exception("Error en el elemento %s del lote: %s", item['id'], e)
+        error = f'Error en el proceso de carga: {str(e)}'
+    finally:
+        remove_temp_files(item['temp_files'], "(lote)")
+    if error:
+        result.update(status='error', error=error)
+    BATCH_ITEMS.inc(status=result['status'])
+    return result
+
+class BatchRun:
+    """
+    Un lote en proceso: los elementos se envían a BATCH_WORKERS hilos al
+    crearlo. Es dueño de sus temporales y del hueco de admisión 'batch' (ya
+    tomado): `close()` cancela los elementos que no empezaron y borra sus
+    temporales, espera a los que están en curso y devuelve el hueco, una sola
+    vez. Se llama con call_on_close, así también se ejecuta si la respuesta se
+    cierra antes de empezar a enviarse.
+    """
+
+    def __init__(self, items):
+        self._executor = ThreadPoolExecutor(max_workers=max(1, BATCH_WORKERS), thread_name_prefix='batch')
+        self._futures = {self._executor.submit(process_batch_item, item): item for item in items}
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def results(self):
+        """
+        Resultados de los elementos a medida que terminan.
+        """
+        for future in as_completed(self._futures):
+            yield future.result()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        try:
+            for future, item in self._futures.items():
+                if future.cancel():
+                    remove_temp_files(item['temp_files'], "(lote cancelado)")
+            self._executor.shutdown()
+        finally:
+            admission.release('batch')
+
+@app.route('/api/batch', methods=['POST'])
+def api_batch():
+    """
+    Sube varios certificados en una sola llamada. Responde un JSON con el
+    resultado de cada elemento en el orden del manifiesto, o con `?stream=1`
+    (o Accept: application/x-ndjson) una línea NDJSON por elemento a medida
+    que terminan.
+    """
+    if BATCH_API_TOKEN and request.headers.get('Authorization') != f'Bearer {BATCH_API_TOKEN}':
+        return jsonify({'error': 'No autorizado'}), 401
+    # La admisión se decide antes de guardar los archivos del lote en disco
+    if not admission.admit('batch'):
+        return admission.busy_response()
+    try:
+        items, error = parse_batch_request()
+    except Exception:
+        admission.release('batch')
+        raise
+    if error:
+        admission.release('batch')
+        return jsonify({'error': error}), 400
+    
+    try:
+        run = BatchRun(items)
+    except Exception:
+        admission.release('batch')
+        for item in items:
+            remove_temp_files(item['temp_files'], "(lote no iniciado)")
+        raise
+    logger.info("Lote recibido: %s elemento(s)", len(items))
+    
+    def with_links(results):
+        for result in results:
+            if result.get('blank_pdf'):
+                result['blank_pdf_url'] = url_for('download_blank_pdf', filename=result['blank_pdf'],
+                                                  key=key_from_public_url(result['url']), _external=True)
+            yield result
+    
+    if request.args.get('stream') == '1' or 'application/x-ndjson' in request.headers.get('Accept', ''):
+        lines = (json.dumps(result, ensure_ascii=False) + '\n' for result in with_links(run.results()))
+        response = Response(stream_with_context(lines), mimetype='application/x-ndjson')
+        response.call_on_close(run.close)
+        return response
+    
+    try:
+        ordered = sorted(with_links(run.results()), key=lambda result: result['index'])
+    finally:
+        run.close()
+    ok = sum(1 for result in ordered if result['status'] == 'ok')
+    return jsonify({'items': ordered, 'ok': ok, 'errors': len(ordered) - ok})
 
 @app.route('/files')
 @app.route('/files/<path:folder_path>')
+@profiling.profiled
 def list_files(folder_path=None):
     """
     Muestra una lista de archivos organizados por carpetas.
     Si se especifica folder_path, muestra solo esa carpeta.
     """
-    folders, error = get_folders_structure()
+    folders, error = get_folders_structure(folder_path)
     
     if error:
         flash(f'Error al listar archivos: {error}', 'error')
@@ -959,7 +1864,7 @@ def delete_file_route(file_name):
     """
     Elimina un archivo del bucket.
     """
-    logger.info(f"Solicitud para eliminar archivo: {file_name}")
+    logger.info("Solicitud para eliminar archivo: %s", file_name)
     
     success, error = delete_file(file_name)
     
@@ -971,104 +1876,167 @@ def delete_file_route(file_name):
     return redirect(url_for('list_files'))
 
 @app.route('/download_blank/<filename>')
+@profiling.profiled
 def download_blank_pdf(filename):
     """
-    Descarga el PDF en blanco con QR.
+    Descarga el PDF en blanco con QR. Con `?key=<clave del objeto>` se
+    regenera si ya no está en el almacén local.
     """
     try:
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        if os.path.exists(file_path):
+        file_path = artifact_store.get(filename)
+        # Si el artefacto fue expulsado, regenerarlo desde la URL del objeto
+        key = request.args.get('key')
+        if not file_path and key:
+            file_path = artifact_store.produce(
+                filename, lambda tmp_path: create_blank_pdf_with_qr(qr_url_for(key), tmp_path))
+        if file_path:
             return send_file(file_path, as_attachment=True, download_name=filename)
         else:
             flash('Archivo no encontrado', 'error')
             return redirect(url_for('index'))
+    except ValueError:
+        flash('Archivo no encontrado', 'error')
+        return redirect(url_for('index'))
     except Exception as e:
-        logger.exception(f"Error al descargar PDF en blanco {filename}: {str(e)}")
+        logger.exception("Error al descargar PDF en blanco %s: %s", filename, e)
         flash('Error al descargar archivo', 'error')
         return redirect(url_for('index'))
 
+def render_qr_png(qr_url, output_path):
+    """
+    Genera el PNG del código QR de `qr_url` en `output_path`.
+    """
+    with metrics.timer('qr_render'):
+        qr_png = qrencode.encoder.png(qr_url)
+    with open(output_path, 'wb') as f:
+        f.write(qr_png)
+    return True
+
+def qr_png_for(file_name, qr_url):
+    """
+    Ruta del PNG del QR de un archivo del bucket y nombre de descarga. El PNG
+    se guarda en el almacén de artefactos y se reutiliza en siguientes descargas.
+    """
+    # Reemplazar barras por guiones bajos para evitar problemas de directorio
+    safe_filename = os.path.splitext(file_name)[0].replace('/', '_').replace('\\', '_')
+    qr_filename = f"qr_{safe_filename}.png"
+    return artifact_store.get_or_produce(qr_filename, lambda tmp_path: render_qr_png(qr_url, tmp_path)), qr_filename
+
 @app.route('/download_qr/<path:file_name>')
+@admission.limited('stamp')
+@profiling.profiled
 def download_qr(file_name):
     """
     Genera y descarga solo el código QR de un archivo específico.
     """
     try:
-        # Buscar el archivo en la lista de archivos del bucket
-        files_data, error = list_files_in_bucket()
-        if error or not files_data:
+        # Buscar el archivo en el bucket
+        target_file, error = find_bucket_file(file_name)
+        if error:
             flash('No se pudieron obtener los archivos', 'error')
             return redirect(url_for('list_files'))
         
-        # Buscar el archivo específico
-        target_file = None
-        for file_info in files_data:
-            if file_info['name'] == file_name:
-                target_file = file_info
-                break
-        
         if not target_file:
             flash('Archivo no encontrado', 'error')
             return redirect(url_for('list_files'))
         
-        # Generar el código QR
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=0,
-        )
-        qr.add_data(target_file['url'])
-        qr.make(fit=True)
-        
-        # Crear imagen QR
-        qr_img = qr.make_image(fill_color="black", back_color="white")
-        
-        # Guardar temporalmente
-        # Reemplazar barras por guiones bajos para evitar problemas de directorio
-        safe_filename = os.path.splitext(file_name)[0].replace('/', '_').replace('\\', '_')
-        qr_filename = f"qr_{safe_filename}.png"
-        qr_path = os.path.join(app.config['UPLOAD_FOLDER'], qr_filename)
-        qr_img.save(qr_path, format="PNG")
-        
-        # Enviar archivo y programar eliminación
-        def remove_file():
-            try:
-                if os.path.exists(qr_path):
-                    os.remove(qr_path)
-            except:
-                pass
-        
-        # Programar eliminación después de 5 segundos
-        import threading
-        timer = threading.Timer(5.0, remove_file)
-        timer.start()
-        
+        qr_path, qr_filename = qr_png_for(file_name, qr_url_for(file_name))
         return send_file(qr_path, as_attachment=True, download_name=qr_filename)
         
     except Exception as e:
-        logger.exception(f"Error al generar QR para {file_name}: {str(e)}")
+        logger.exception("Error al generar QR para %s: %s", file_name, e)
         flash('Error al generar código QR', 'error')
         return redirect(url_for('list_files'))
 
+EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', str(export.default_workers())))
+
+def qr_archive_name(relative_key):
+    """
+    Nombre del PNG dentro del ZIP: misma ruta relativa que el archivo, con el
+    prefijo qr_ en el nombre.
+    """
+    directory, filename = os.path.split(relative_key)
+    return os.path.join(directory, f"qr_{os.path.splitext(filename)[0]}.png")
+
+@app.route('/export_qr/<path:folder_path>')
+def export_folder_qr(folder_path):
+    """
+    Exporta los QR de todos los archivos bajo una carpeta (incluidas sus
+    subcarpetas): ?format=zip (PNG, por defecto) o ?format=labels (PDF de
+    etiquetas con ?columns= x ?rows= QR por página). La respuesta se envía a
+    medida que se generan los QR.
+    """
+    export_format = request.args.get('format', 'zip')
+    if export_format not in ('zip', 'labels'):
+        abort(400)
+    columns = min(max(request.args.get('columns', 3, type=int), 1), 8)
+    rows = min(max(request.args.get('rows', 4, type=int), 1), 12)
+    
+    prefix = folder_path.strip('/') + '/'
+    files, error = list_files_in_bucket(prefix=prefix)
+    if error:
+        flash('No se pudieron obtener los archivos', 'error')
+        return redirect(url_for('list_files'))
+    files = [f for f in files if not f['name'].endswith('/.folder_placeholder')]
+    if not files:
+        flash('La carpeta no tiene archivos', 'error')
+        return redirect(url_for('list_files', folder_path=folder_path))
+    
+    def png_for(file_info):
+        # En memoria: guardarlos en el almacén de artefactos llenaría el disco en
+        # carpetas grandes y expulsaría los PDF en blanco de /download_blank
+        with metrics.timer('qr_render'):
+            return qrencode.encoder.png(qr_url_for(file_info['name']))
+    
+    export_name = re.sub(r'[^a-zA-Z0-9_-]', '_', folder_path.strip('/'))
+    if export_format == 'labels':
+        items = ((os.path.basename(f['name']), f) for f in files)
+        chunks = export.labels_stream(items, png_for, EXPORT_WORKERS, columns, rows)
+        mimetype, download_name = 'application/pdf', f"etiquetas_qr_{export_name}.pdf"
+    else:
+        items = ((qr_archive_name(f['name'][len(prefix):]), f) for f in files)
+        chunks = export.zip_stream(items, png_for, EXPORT_WORKERS)
+        mimetype, download_name = 'application/zip', f"qr_{export_name}.zip"
+    
+    body = admission.streaming('stamp', chunks)
+    if body is None:
+        return admission.busy_response()
+    logger.info("Exportando %s QR de %s (%s)", len(files), prefix, export_format)
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{download_name}"'})
+
+@app.route('/c/<path:file_key>')
+def object_alias(file_key):
+    """
+    Alias estable de un objeto (la URL de los QR con IMMUTABLE_KEYS): redirige
+    a la versión más reciente de la clave, o a la propia clave si no tiene
+    versiones. La redirección se puede cachear ALIAS_CACHE_SECONDS segundos.
+    """
+    files, error = list_files_in_bucket(prefix=os.path.splitext(file_key)[0])
+    if error:
+        return Response('No se pudo consultar el bucket', status=503, mimetype='text/plain')
+    versions = [f for f in files if f['name'] == file_key or stable_key(f['name']) == file_key]
+    if not versions:
+        abort(404)
+    latest = max(versions, key=lambda f: f['upload_timestamp'])
+    response = redirect(public_url_for(latest['name']), code=302)
+    response.headers['Cache-Control'] = f'public, max-age={ALIAS_CACHE_SECONDS}'
+    return response
+
 @app.route('/download_blank_with_qr/<path:file_name>')
+@admission.limited('stamp')
+@profiling.profiled
 def download_blank_with_qr(file_name):
     """
     Genera y descarga un PDF en blanco con el QR del archivo específico.
     """
     try:
-        # Buscar el archivo en la lista de archivos del bucket
-        files_data, error = list_files_in_bucket()
-        if error or not files_data:
+        # Buscar el archivo en el bucket
+        target_file, error = find_bucket_file(file_name)
+        if error:
             flash('No se pudieron obtener los archivos', 'error')
             return redirect(url_for('list_files'))
         
-        # Buscar el archivo específico
-        target_file = None
-        for file_info in files_data:
-            if file_info['name'] == file_name:
-                target_file = file_info
-                break
-        
         if not target_file:
             flash('Archivo no encontrado', 'error')
             return redirect(url_for('list_files'))
@@ -1077,31 +2045,19 @@ def download_blank_with_qr(file_name):
         # Reemplazar barras por guiones bajos para evitar problemas de directorio
         safe_filename = os.path.splitext(file_name)[0].replace('/', '_').replace('\\', '_')
         blank_filename = f"blank_qr_{safe_filename}.pdf"
-        blank_path = os.path.join(app.config['UPLOAD_FOLDER'], blank_filename)
         
-        # Usar la función existente para crear el PDF en blanco con QR
-        success = create_blank_pdf_with_qr(target_file['url'], blank_path)
+        # Usar la función existente para crear el PDF en blanco con QR (se reutiliza si ya existe)
+        blank_path = artifact_store.get_or_produce(
+            blank_filename, lambda tmp_path: create_blank_pdf_with_qr(qr_url_for(file_name), tmp_path))
         
-        if success and os.path.exists(blank_path):
-            # Programar eliminación del archivo temporal
-            def remove_file():
-                try:
-                    if os.path.exists(blank_path):
-                        os.remove(blank_path)
-                except:
-                    pass
-            
-            import threading
-            timer = threading.Timer(10.0, remove_file)
-            timer.start()
-            
+        if blank_path:
             return send_file(blank_path, as_attachment=True, download_name=blank_filename)
         else:
             flash('Error al crear PDF en blanco con QR', 'error')
             return redirect(url_for('list_files'))
         
     except Exception as e:
-        logger.exception(f"Error al crear PDF en blanco con QR para {file_name}: {str(e)}")
+        logger.exception("Error al crear PDF en blanco con QR para %s: %s", file_name, e)
         flash('Error al crear PDF en blanco con QR', 'error')
         return redirect(url_for('list_files'))
 
@@ -1198,6 +2154,56 @@ def move_file_route():
     
     return redirect(url_for('list_files'))
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """
+    Métricas en formato Prometheus. Si METRICS_TOKEN está definido, se exige
+    como token Bearer.
+    """
+    token = os.getenv('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return Response('No autorizado\n', status=401, mimetype='text/plain')
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/debug/profiles')
+def list_profiles():
+    """
+    Lista los perfiles capturados (requiere PROFILE_SECRET).
+    """
+    if not profiling.authorized():
+        abort(404)
+    return jsonify({'profiles': profiling.store.list()})
+
+@app.route('/debug/profiles/<profile_id>')
+def download_profile(profile_id):
+    """
+    Descarga un perfil: .prof (pstats/snakeviz) para cProfile o pilas
+    colapsadas (flamegraph/speedscope) para el muestreo.
+    """
+    if not profiling.authorized():
+        abort(404)
+    entry = profiling.store.get(profile_id)
+    if not entry:
+        abort(404)
+    return send_file(BytesIO(entry['data']), as_attachment=True,
+                     download_name=profiling.filename_for(entry), mimetype='application/octet-stream')
+
+@app.route('/api/search')
+def api_search():
+    """
+    Busca certificados por el texto indexado al subirlos (cliente, número de
+    serie, número de certificado...). Parámetros: q y limit (máximo 100).
+    """
+    query = request.args.get('q', '').strip()
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    if bucket_mirror is None or not bucket_mirror.search_enabled:
+        return jsonify({'error': 'La búsqueda por contenido no está disponible'}), 503
+    if not query:
+        return jsonify({'query': query, 'results': []})
+    with metrics.timer('search'):
+        results = bucket_mirror.search(query, limit)
+    return jsonify({'query': query, 'results': results})
+
 @app.route('/api/folders')
 def api_get_folders():
     """
@@ -1213,7 +2219,57 @@ def api_get_folders():
     # Devolver la estructura completa de carpetas para que el JavaScript pueda procesarla
     return jsonify({'folders': folders})
 
+def warmup():
+    """
+    Precalienta lo que la primera petición necesitaría: módulos pesados,
+    cliente S3, template del PDF en blanco e índice del bucket.
+    """
+    start = time.perf_counter()
+    try:
+        import qrcode  # noqa: F401
+        import PyPDF2  # noqa: F401
+        import reportlab.pdfgen.canvas  # noqa: F401
+        import PIL.Image  # noqa: F401
+        get_s3_client()
+        load_blank_template()
+        list_files_in_bucket()
+        logger.info("Warmup completado en %.0f ms", (time.perf_counter() - start) * 1000)
+    except Exception as e:
+        logger.warning("Warmup incompleto: %s", e)
+
+def start_warmup(port, timeout=30.0):
+    """
+    Lanza `warmup()` en segundo plano en cuanto el servidor acepta conexiones
+    en `port`, para no retrasar la apertura del puerto (Render la espera).
+    """
+    def _wait_and_warm():
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                    break
+            except OSError:
+                time.sleep(0.05)
+        warmup()
+
+    threading.Thread(target=_wait_and_warm, name='warmup', daemon=True).start()
+
+def start_background_tasks():
+    """
+    Lanza los hilos de mantenimiento del servidor: el conserje de artefactos y
+    la reconciliación de la copia local del bucket. Solo al arrancar la
+    aplicación; importar el módulo (restamp.py, benchmarks) no los lanza.
+    """
+    if ARTIFACT_JANITOR_INTERVAL > 0:
+        artifacts.start_janitor(artifact_store, UPLOAD_FOLDER, ORPHAN_MAX_AGE, ARTIFACT_JANITOR_INTERVAL)
+    if bucket_mirror is not None and BUCKET_SYNC_INTERVAL > 0:
+        bucketdb.start_sync(bucket_mirror, get_s3_client, B2_BUCKET_NAME, BUCKET_SYNC_INTERVAL, STAGING_PREFIX,
+                            STAGING_MAX_AGE, on_change=invalidate_bucket_index)
+
 if __name__ == '__main__':
     logger.info("Iniciando la aplicación Flask")
     port = int(os.environ.get('PORT', 8080))
+    start_background_tasks()
+    if os.getenv('WARMUP_ON_START', '1') == '1':
+        start_warmup(port)
     app.run(debug=False, host='0.0.0.0', port=port)
\ No newline at end of file
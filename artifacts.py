@@ -0,0 +1,183 @@
+"""
+Almacén local acotado para los archivos generados (PDF en blanco con QR, PNG
+del QR).
+
+- Escrituras atómicas: el productor escribe en un temporal del mismo
+  directorio y se publica con os.replace, así nunca se sirve un archivo a medias.
+- Expulsión por TTL (desde el último acceso) y por tamaño total (LRU).
+- Un hilo conserje aplica la expulsión periódicamente y borra los temporales
+  huérfanos que hayan quedado en la carpeta de subidas tras un fallo.
+
+El índice vive en memoria y se reconstruye al arrancar a partir de las fechas
+de modificación de los archivos.
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+
+import metrics
+
+logger = logging.getLogger('backblaze_uploader.artifacts')
+
+TMP_PREFIX = '.tmp-'
+
+ARTIFACT_EVICTIONS = metrics.counter(
+    'geotop_artifact_evictions_total', 'Artefactos locales expulsados por motivo', ['reason'])
+ARTIFACT_BYTES = metrics.gauge('geotop_artifact_bytes', 'Bytes ocupados por el almacén de artefactos')
+ARTIFACT_FILES = metrics.gauge('geotop_artifact_files', 'Archivos en el almacén de artefactos')
+ORPHANS_REMOVED = metrics.counter(
+    'geotop_orphan_files_removed_total', 'Temporales huérfanos eliminados de uploads/')
+
+
+class ArtifactStore:
+    def __init__(self, root, max_bytes, ttl):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}  # nombre -> [tamaño, último acceso]
+        os.makedirs(root, exist_ok=True)
+        self._load()
+        ARTIFACT_BYTES.set_function(self.total_bytes)
+        ARTIFACT_FILES.set_function(lambda: len(self._entries))
+
+    def _load(self):
+        for entry in os.scandir(self.root):
+            if not entry.is_file():
+                continue
+            if entry.name.startswith(TMP_PREFIX):
+                # Escritura interrumpida en una ejecución anterior
+                self._remove_file(entry.path)
+                continue
+            stat = entry.stat()
+            self._entries[entry.name] = [stat.st_size, stat.st_mtime]
+
+    def path_for(self, name):
+        if not name or name != os.path.basename(name) or name.startswith('.'):
+            raise ValueError(f"Nombre de artefacto no válido: {name!r}")
+        return os.path.join(self.root, name)
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(size for size, _ in self._entries.values())
+
+    def get(self, name):
+        """
+        Devuelve la ruta del artefacto si existe y no ha caducado, o None.
+        """
+        path = self.path_for(name)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and self.ttl and now - entry[1] > self.ttl:
+                entry = None
+            if entry is not None and not os.path.exists(path):
+                self._entries.pop(name, None)
+                entry = None
+            if entry is not None:
+                entry[1] = now
+        metrics.record_cache('artifacts', entry is not None)
+        return path if entry is not None else None
+
+    def produce(self, name, producer):
+        """
+        Genera el artefacto de forma atómica. `producer(ruta_temporal)` debe
+        escribir el archivo y devolver True si tuvo éxito. Devuelve la ruta
+        final o None.
+        """
+        path = self.path_for(name)
+        tmp_path = os.path.join(self.root, f"{TMP_PREFIX}{uuid.uuid4().hex}-{name}")
+        try:
+            if not producer(tmp_path) or not os.path.exists(tmp_path):
+                return None
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                self._remove_file(tmp_path)
+        with self._lock:
+            self._entries[name] = [os.path.getsize(path), time.time()]
+        self.evict()
+        return path
+
+    def get_or_produce(self, name, producer):
+        return self.get(name) or self.produce(name, producer)
+
+    def evict(self):
+        """
+        Elimina los artefactos caducados y, si se supera max_bytes, los menos
+        usados recientemente.
+        """
+        now = time.time()
+        victims = []
+        with self._lock:
+            if self.ttl:
+                for name, (size, last_access) in list(self._entries.items()):
+                    if now - last_access > self.ttl:
+                        victims.append((name, 'ttl'))
+                        del self._entries[name]
+            total = sum(size for size, _ in self._entries.values())
+            if self.max_bytes and total > self.max_bytes:
+                for name, (size, _) in sorted(self._entries.items(), key=lambda item: item[1][1]):
+                    if total <= self.max_bytes:
+                        break
+                    victims.append((name, 'size'))
+                    del self._entries[name]
+                    total -= size
+        for name, reason in victims:
+            self._remove_file(os.path.join(self.root, name))
+            ARTIFACT_EVICTIONS.inc(reason=reason)
+        if victims:
+            logger.debug("Artefactos expulsados: %s", len(victims))
+        return len(victims)
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning("No se pudo eliminar %s: %s", path, e)
+
+
+def remove_orphans(folder, max_age):
+    """
+    Borra los archivos sueltos de `folder` (no subcarpetas) con más de
+    `max_age` segundos: temporales de subidas o QR que un fallo dejó atrás.
+    """
+    now = time.time()
+    removed = 0
+    try:
+        entries = list(os.scandir(folder))
+    except OSError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_file(follow_symlinks=False) and now - entry.stat().st_mtime > max_age:
+                os.remove(entry.path)
+                removed += 1
+        except OSError:
+            continue
+    if removed:
+        ORPHANS_REMOVED.inc(removed)
+        logger.info("Temporales huérfanos eliminados de %s: %s", folder, removed)
+    return removed
+
+
+def start_janitor(store, orphan_folder, orphan_max_age, interval):
+    """
+    Lanza el hilo conserje que expulsa artefactos y limpia huérfanos cada
+    `interval` segundos.
+    """
+    def _run():
+        while True:
+            time.sleep(interval)
+            try:
+                store.evict()
+                remove_orphans(orphan_folder, orphan_max_age)
+            except Exception as e:
+                logger.warning("Error en el conserje de artefactos: %s", e)
+
+    thread = threading.Thread(target=_run, name='artifact-janitor', daemon=True)
+    thread.start()
+    return thread
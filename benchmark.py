@@ -0,0 +1,327 @@
+"""
+Microbenchmarks de la aplicación.
+
+Cada sección se registra con @benchmark y se puede ejecutar por separado:
+
+    python benchmark.py                 # todas las secciones
+    python benchmark.py --only startup  # solo una
+    python benchmark.py --json bench.json
+
+Las secciones que arrancan la aplicación usan el servidor S3 local de
+s3_local.py, así que no necesitan credenciales de Backblaze.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+BENCHMARKS = {}
+
+# Entorno mínimo para poder importar app.py sin credenciales reales
+DUMMY_ENV = {
+    'B2_ACCESS_KEY_ID': 'local',
+    'B2_SECRET_ACCESS_KEY': 'local',
+    'B2_BUCKET_NAME': 'geotop-bench',
+    'B2_ENDPOINT': 'http://127.0.0.1:9',
+    'B2_REGION': 'us-east-005',
+    'LOG_FILE': os.devnull,
+    'LOG_LEVEL': 'WARNING',
+    # Sin copia SQLite del bucket: cada medida empieza con las cachés frías
+    'BUCKET_DB_PATH': '',
+}
+
+
+def benchmark(name):
+    def decorator(function):
+        BENCHMARKS[name] = function
+        return function
+    return decorator
+
+
+def run_python(code, env=None):
+    """
+    Ejecuta `code` en un intérprete nuevo y devuelve lo que imprima como JSON.
+    """
+    full_env = dict(os.environ)
+    full_env.update(DUMMY_ENV)
+    full_env.update(env or {})
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=BASE_DIR, env=full_env)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def run_python_repeat(code, repeat, env=None):
+    return [run_python(code, env) for _ in range(repeat)]
+
+
+def median_ms(values):
+    return round(statistics.median(values) * 1000, 1)
+
+
+@benchmark('startup')
+def bench_startup(args):
+    """
+    Tiempo de importación de app.py, coste de los módulos pesados que ahora se
+    cargan bajo demanda y tiempo hasta el primer byte con y sin warmup.
+    """
+    import requests
+    import s3_local
+    from loadtest import BUCKET_NAME, free_port, make_pdf, seed_bucket, start_app, wait_for_http
+
+    import_app = run_python_repeat(
+        "import json, time; t = time.perf_counter(); import app; print(json.dumps(time.perf_counter() - t))",
+        args.repeat)
+    import_heavy = run_python_repeat(
+        "import json, time; t = time.perf_counter(); "
+        "import boto3, PyPDF2, qrcode, PIL.Image, reportlab.pdfgen.canvas; "
+        "print(json.dumps(time.perf_counter() - t))",
+        args.repeat)
+
+    server, endpoint = s3_local.start_server()
+    try:
+        seed_bucket(endpoint, BUCKET_NAME, [make_pdf(1)], 20)
+        results = {}
+        for warmup in ('0', '1'):
+            first_byte, first_files = [], []
+            for _ in range(args.repeat):
+                port = free_port()
+                process = start_app(endpoint, port, {'WARMUP_ON_START': warmup, 'LOG_LEVEL': 'WARNING'})
+                try:
+                    first_byte.append(wait_for_http(f"http://127.0.0.1:{port}/"))
+                    # Dar tiempo al warmup en segundo plano antes de la primera navegación
+                    time.sleep(1.0)
+                    t = time.perf_counter()
+                    requests.get(f"http://127.0.0.1:{port}/files")
+                    first_files.append(time.perf_counter() - t)
+                finally:
+                    process.terminate()
+                    process.wait(timeout=10)
+            results[warmup] = (first_byte, first_files)
+    finally:
+        server.shutdown()
+
+    return {
+        'import_app_ms': median_ms(import_app),
+        'import_heavy_modules_ms': median_ms(import_heavy),
+        'time_to_first_byte_ms': median_ms(results['1'][0]),
+        'first_files_request_ms_without_warmup': median_ms(results['0'][1]),
+        'first_files_request_ms_with_warmup': median_ms(results['1'][1]),
+    }
+
+
+def make_scanned_pdf(path, pages, image_mb):
+    """
+    Genera un PDF que imita un anexo escaneado: una imagen de `image_mb` MB
+    de ruido (incompresible) distinta en cada página.
+    """
+    from PIL import Image
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfgen import canvas
+
+    side = int((image_mb * 1024 * 1024 / 3) ** 0.5)
+    can = canvas.Canvas(path, pagesize=letter)
+    for _ in range(pages):
+        image = Image.frombytes('RGB', (side, side), os.urandom(side * side * 3))
+        can.drawImage(ImageReader(image), 36, 36, 540, 720)
+        can.showPage()
+    can.save()
+
+
+MERGE_CODE = """
+import glob, json, os, sys, time
+import app, metrics
+from PyPDF2 import PdfReader, PdfWriter
+paths = sorted(glob.glob(os.path.join(sys.argv[1], 'anexo_*.pdf')))
+t = time.perf_counter()
+with metrics.MemoryProbe(interval=0.001) as probe:
+    ok = app.merge_pdfs(paths, os.path.join(sys.argv[1], 'combinado.pdf'))
+print(json.dumps([ok, time.perf_counter() - t, probe.peak]))
+"""
+
+
+@benchmark('merge')
+def bench_merge(args):
+    """
+    Pico de memoria (RSS por encima del de partida, muestreado) y tiempo de
+    merge_pdfs con MERGE_MODE=memory y MERGE_MODE=stream sobre un paquete de
+    anexos escaneados de ~16 MB.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for index in range(8):
+            make_scanned_pdf(os.path.join(workdir, f"anexo_{index}.pdf"), 2, 1)
+        results['input_mb'] = round(sum(
+            os.path.getsize(os.path.join(workdir, name)) for name in os.listdir(workdir)) / (1024 * 1024), 1)
+        for mode in ('memory', 'stream'):
+            runs = []
+            for _ in range(args.repeat):
+                code = "import sys; sys.argv = ['', %r]\n%s" % (workdir, MERGE_CODE)
+                ok, elapsed, growth = run_python(code, {'MERGE_MODE': mode, 'WARMUP_ON_START': '0',
+                                                              'ARTIFACT_JANITOR_INTERVAL': '0'})
+                if not ok:
+                    raise RuntimeError(f"merge_pdfs falló con MERGE_MODE={mode}")
+                runs.append((elapsed, growth))
+            results[f'{mode}_merge_ms'] = median_ms([elapsed for elapsed, _ in runs])
+            results[f'{mode}_peak_rss_growth_mb'] = round(
+                statistics.median(growth for _, growth in runs) / (1024 * 1024), 1)
+    return results
+
+
+MMAP_CODE = """
+import json, os, sys, threading
+import app, metrics
+
+def rss_anon():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('RssAnon:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+workdir = sys.argv[1]
+source = os.path.join(workdir, 'escaneo.pdf')
+base = rss_anon()
+peak_anon = [base]
+stop = threading.Event()
+
+def sample():
+    while not stop.wait(0.001):
+        peak_anon[0] = max(peak_anon[0], rss_anon())
+
+sampler = threading.Thread(target=sample, daemon=True)
+with app.app.test_request_context('/upload', method='POST'):
+    sampler.start()
+    with metrics.MemoryProbe(interval=0.001) as probe:
+        ok = app.merge_pdfs([source], os.path.join(workdir, 'combinado.pdf'))
+        ok = ok and app.add_qr_to_pdf(os.path.join(workdir, 'combinado.pdf'),
+                                      os.path.join(workdir, 'estampado.pdf'), 'https://example.com/x.pdf')
+    stop.set()
+    sampler.join()
+print(json.dumps([ok, probe.peak, peak_anon[0] - base]))
+"""
+
+
+@benchmark('mmap')
+def bench_mmap(args):
+    """
+    Pico de memoria de merge_pdfs + add_qr_to_pdf sobre un escaneo de ~16 MB
+    con PDF_MMAP=0 y PDF_MMAP=1, dentro de una petición (las lecturas del
+    mismo archivo comparten el mapeo). Se mide el RSS total y la memoria
+    anónima (RssAnon): las páginas de un mmap de archivo cuentan en el RSS
+    pero el sistema las puede descartar sin escribirlas en swap.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        source = os.path.join(workdir, 'escaneo.pdf')
+        make_scanned_pdf(source, 8, 1.6)
+        results['input_mb'] = round(os.path.getsize(source) / (1024 * 1024), 1)
+        for mode in ('0', '1'):
+            runs = []
+            for _ in range(args.repeat):
+                code = "import sys; sys.argv = ['', %r]\n%s" % (workdir, MMAP_CODE)
+                ok, rss, anon = run_python(code, {'PDF_MMAP': mode, 'WARMUP_ON_START': '0',
+                                                  'ARTIFACT_JANITOR_INTERVAL': '0'})
+                if not ok:
+                    raise RuntimeError(f"El estampado falló con PDF_MMAP={mode}")
+                runs.append((rss, anon))
+            label = 'mmap' if mode == '1' else 'open'
+            results[f'{label}_peak_rss_growth_mb'] = round(
+                statistics.median(rss for rss, _ in runs) / (1024 * 1024), 1)
+            results[f'{label}_peak_anon_growth_mb'] = round(
+                statistics.median(anon for _, anon in runs) / (1024 * 1024), 1)
+    return results
+
+
+QR_URL_LENGTHS = (40, 90, 200, 600)
+
+
+def _qr_urls(length, count, tag):
+    """
+    `count` URL distintas de `length` caracteres. El nombre único va al final y
+    lo que se recorta es el relleno o el dominio.
+    """
+    base = 'https://f000.backblazeb2.com/file/geotop/certificados/'
+    urls = []
+    for index in range(count):
+        name = f"{tag}_{index}.pdf"
+        urls.append((base + 'x' * length)[:max(0, length - len(name))] + name)
+    return urls
+
+
+@benchmark('qr')
+def bench_qr(args):
+    """
+    Codificadores de qrencode.py por longitud de URL y nivel de corrección.
+    Cada medida simula las subidas de 10 URL distintas: el QR transparente del
+    certificado, el del PDF en blanco y el PNG de descarga de cada una. Antes
+    se comprueba que cada backend produce la misma matriz y los mismos píxeles
+    que `qrcode`; el recomendado es el más rápido en total entre los idénticos.
+    """
+    import qrencode
+
+    results = {}
+    totals = {name: 0.0 for name in qrencode.BACKENDS}
+    identical = {name: True for name in qrencode.BACKENDS}
+    for level in qrencode.ERROR_CORRECTION_LEVELS:
+        reference = qrencode.get_encoder('qrcode', level)
+        for length in QR_URL_LENGTHS:
+            sample = _qr_urls(length, 1, 'check')[0]
+            expected = (reference.matrix(sample), reference.image(sample, True).tobytes(),
+                        reference.image(sample).tobytes())
+            for name in qrencode.BACKENDS:
+                encoder = qrencode.get_encoder(name, level)
+                produced = (encoder.matrix(sample), encoder.image(sample, True).tobytes(),
+                            encoder.image(sample).tobytes())
+                identical[name] = identical[name] and produced == expected
+
+                runs = []
+                for round_index in range(args.repeat):
+                    # Codificador nuevo en cada ronda: la memoria de `memo` empieza vacía
+                    encoder = qrencode.get_encoder(name, level)
+                    urls = _qr_urls(length, 10, f"r{round_index}")
+                    start = time.perf_counter()
+                    for url in urls:
+                        encoder.png(url, transparent=True)
+                        encoder.png(url, transparent=True)
+                        encoder.png(url)
+                    runs.append((time.perf_counter() - start) / len(urls))
+                results[f'{name}_{level}_{length}_ms_per_upload'] = median_ms(runs)
+                totals[name] += statistics.median(runs)
+
+    for name in qrencode.BACKENDS:
+        results[f'{name}_identical'] = identical[name]
+    candidates = [name for name in qrencode.BACKENDS if identical[name]]
+    results['recommended_backend'] = min(candidates, key=totals.get)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks de GEOTOP')
+    parser.add_argument('--only', action='append', choices=sorted(BENCHMARKS), help='Secciones a ejecutar')
+    parser.add_argument('--repeat', type=int, default=3, help='Repeticiones por medida (se usa la mediana)')
+    parser.add_argument('--json', help='Guardar los resultados en JSON')
+    args = parser.parse_args()
+
+    sys.path.insert(0, BASE_DIR)
+    results = {}
+    for name in args.only or sorted(BENCHMARKS):
+        print(f"== {name} ==")
+        section = BENCHMARKS[name](args)
+        results[name] = section
+        for key, value in section.items():
+            print(f"  {key:<45} {value}")
+        print()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+"""
+Copia local en SQLite de los metadatos del bucket.
+
+Guarda por cada objeto la clave, tamaño, ETag, fecha de subida y carpeta, con
+índices por carpeta, para que el listado de archivos, la estructura de
+carpetas y las búsquedas por nombre no dependan de un `list_objects_v2`
+completo. El archivo persiste entre reinicios: tras arrancar, `/files` se
+sirve desde la copia mientras se reconcilia en segundo plano.
+
+- Las escrituras de la aplicación (subir, mover, borrar, crear carpeta)
+  actualizan la copia en el momento.
+- `sync()` recorre el bucket página a página (ContinuationToken) y aplica solo
+  los cambios; cada pasada marca las filas que ve con un número de generación
+  y, si termina entera, borra las que no vio (objetos borrados fuera de la
+  aplicación). Si falla a mitad, lo ya aplicado se conserva.
+- Los objetos bajo el prefijo excluido (staging de las subidas directas) no se
+  copian; los que superan `stale_after` segundos se borran del bucket, porque
+  son subidas que el navegador no llegó a completar.
+
+En el mismo archivo, la tabla FTS5 `documents` guarda el texto extraído de
+cada PDF al subirlo (`index_text`) para buscar por contenido (`search`): nombre
+del cliente, número de serie o de certificado. Sigue a la tabla de objetos en
+los borrados y movimientos. Si SQLite no tiene FTS5, la búsqueda se desactiva.
+"""
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger('backblaze_uploader.bucketdb')
+
+SYNC_PAGE_SIZE = 1000
+
+BUCKET_DB_OBJECTS = metrics.gauge('geotop_bucket_db_objects', 'Objetos en la copia local de metadatos del bucket')
+BUCKET_DB_SYNC_CHANGES = metrics.counter(
+    'geotop_bucket_db_sync_changes_total', 'Cambios aplicados al reconciliar la copia local del bucket', ['change'])
+STAGING_SWEPT = metrics.counter(
+    'geotop_staging_swept_total', 'Objetos de staging abandonados borrados al reconciliar')
+BUCKET_DB_LAST_SYNC = metrics.gauge(
+    'geotop_bucket_db_last_sync_timestamp_seconds', 'Momento de la última reconciliación completa del bucket')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    key TEXT PRIMARY KEY,
+    folder TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    etag TEXT,
+    upload_timestamp INTEGER NOT NULL,
+    generation INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS objects_folder ON objects (folder, key);
+CREATE TABLE IF NOT EXISTS sync_state (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Sin distinguir mayúsculas ni tildes ("Pérez" encuentra "PEREZ")
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS documents USING fts5(
+    key UNINDEXED, filename, content, tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+SNIPPET_TOKENS = 16
+
+
+def folder_of(key):
+    return key.rsplit('/', 1)[0] if '/' in key else ''
+
+
+def _filename_terms(key):
+    # build_file_key sustituye espacios y signos por "_": se separan de nuevo en palabras
+    return os.path.splitext(key.rsplit('/', 1)[-1])[0].replace('_', ' ')
+
+
+class BucketMirror:
+    def __init__(self, path, bucket, url_for_key):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._url_for_key = url_for_key
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(_SCHEMA)
+        try:
+            self._db.executescript(_FTS_SCHEMA)
+            self.search_enabled = True
+        except sqlite3.OperationalError as e:
+            logger.warning("SQLite sin FTS5, la búsqueda por contenido queda desactivada: %s", e)
+            self.search_enabled = False
+        self._db.commit()
+        if self._state('bucket') != bucket:
+            # Copia de otro bucket (o nueva): se empieza de cero
+            with self._lock, self._db:
+                self._db.execute('DELETE FROM objects')
+                if self.search_enabled:
+                    self._db.execute('DELETE FROM documents')
+                self._db.execute('DELETE FROM sync_state')
+                self._db.execute("INSERT INTO sync_state (name, value) VALUES ('bucket', ?)", (bucket,))
+        BUCKET_DB_OBJECTS.set_function(self.count)
+        BUCKET_DB_LAST_SYNC.set_function(lambda: float(self._state('synced_at') or 0))
+
+    # --- Consultas ---
+
+    def _state(self, name):
+        with self._lock:
+            row = self._db.execute('SELECT value FROM sync_state WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def is_ready(self):
+        """
+        True si ya hubo al menos una reconciliación completa (en esta ejecución
+        o en una anterior).
+        """
+        return self._state('synced_at') is not None
+
+    def count(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM objects').fetchone()[0]
+
+    def _file(self, row):
+        key, size, etag, timestamp = row
+        return {'name': key, 'id': etag or '', 'size': size, 'upload_timestamp': timestamp,
+                'url': self._url_for_key(key)}
+
+    def list(self, prefix=None):
+        """
+        Objetos ordenados por clave, con el mismo formato que
+        list_files_in_bucket. `prefix` se resuelve con el índice de la clave.
+        """
+        query = 'SELECT key, size, etag, upload_timestamp FROM objects'
+        params = ()
+        if prefix:
+            # Rango de claves con el prefijo, para que SQLite use el índice
+            query += ' WHERE key >= ? AND key < ?'
+            params = (prefix, prefix + '\U0010ffff')
+        with self._lock:
+            rows = self._db.execute(query + ' ORDER BY key', params).fetchall()
+        return [self._file(row) for row in rows]
+
+    def list_folder(self, folder):
+        """
+        Objetos directamente dentro de `folder` ('' para la raíz).
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT key, size, etag, upload_timestamp FROM objects WHERE folder = ? ORDER BY key',
+                (folder,)).fetchall()
+        return [self._file(row) for row in rows]
+
+    def folder_counts(self, exclude_name=''):
+        """
+        Pares (carpeta, número de objetos) ordenados por carpeta, sin contar
+        los objetos llamados `exclude_name`. Se resuelve con el índice de carpeta.
+        """
+        with self._lock:
+            return self._db.execute(
+                "SELECT folder, SUM(key != CASE folder WHEN '' THEN ? ELSE folder || '/' || ? END) "
+                'FROM objects GROUP BY folder ORDER BY folder', (exclude_name, exclude_name)).fetchall()
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT key, size, etag, upload_timestamp FROM objects WHERE key = ?', (key,)).fetchone()
+        return self._file(row) if row else None
+
+    # --- Escrituras de la aplicación ---
+
+    def _write_generation(self):
+        # Las filas que escribe la aplicación llevan la generación de la próxima
+        # pasada, así una reconciliación en curso que ya recorrió esa parte del
+        # bucket no las borra al terminar
+        row = self._db.execute("SELECT value FROM sync_state WHERE name = 'generation'").fetchone()
+        return int(row[0] if row else 0) + 1
+
+    def put(self, key, size, etag=None, upload_timestamp=None):
+        if upload_timestamp is None:
+            upload_timestamp = int(time.time() * 1000)
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT INTO objects (key, folder, size, etag, upload_timestamp, generation) VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET size = excluded.size, etag = excluded.etag, '
+                'upload_timestamp = excluded.upload_timestamp, generation = excluded.generation',
+                (key, folder_of(key), size, etag, upload_timestamp, self._write_generation()))
+
+    def delete(self, keys):
+        keys = [(key,) for key in keys]
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM objects WHERE key = ?', keys)
+            if self.search_enabled:
+                self._db.executemany('DELETE FROM documents WHERE key = ?', keys)
+
+    def move(self, old_key, new_key):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM objects WHERE key = ?', (new_key,))
+            self._db.execute('UPDATE objects SET key = ?, folder = ?, generation = ? WHERE key = ?',
+                             (new_key, folder_of(new_key), self._write_generation(), old_key))
+            if self.search_enabled:
+                self._db.execute('DELETE FROM documents WHERE key = ?', (new_key,))
+                self._db.execute('UPDATE documents SET key = ?, filename = ? WHERE key = ?',
+                                 (new_key, _filename_terms(new_key), old_key))
+
+    # --- Búsqueda por contenido ---
+
+    def index_text(self, key, text):
+        """
+        Guarda (o sustituye) el texto de un documento para la búsqueda.
+        """
+        if not self.search_enabled:
+            return
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM documents WHERE key = ?', (key,))
+            self._db.execute('INSERT INTO documents (key, filename, content) VALUES (?, ?, ?)',
+                             (key, _filename_terms(key), text))
+
+    def search(self, query, limit=20):
+        """
+        Documentos que contienen todas las palabras de `query` (como prefijo),
+        ordenados por relevancia, con un fragmento del texto alrededor.
+        """
+        if not self.search_enabled:
+            return []
+        terms = re.findall(r'\w+', query)
+        if not terms:
+            return []
+        # Cada palabra entre comillas para que la sintaxis de FTS5 no se interprete
+        match = ' '.join(f'"{term}"*' for term in terms)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT key, snippet(documents, 2, '', '', '…', ?) FROM documents "
+                'WHERE documents MATCH ? ORDER BY rank LIMIT ?',
+                (SNIPPET_TOKENS, match, limit)).fetchall()
+        return [{'name': key, 'url': self._url_for_key(key), 'snippet': snippet} for key, snippet in rows]
+
+    # --- Reconciliación ---
+
+    def sync(self, s3_client, bucket, exclude_prefix=None, stale_after=None):
+        """
+        Reconcilia la copia con el bucket. Devuelve un dict con los objetos
+        vistos, los añadidos, actualizados y borrados, y los objetos de
+        `exclude_prefix` con más de `stale_after` segundos borrados del bucket.
+        """
+        with self._sync_lock:
+            generation = int(self._state('generation') or 0) + 1
+            stats = {'seen': 0, 'added': 0, 'updated': 0, 'deleted': 0, 'swept': 0}
+            stale = []
+            params = {'Bucket': bucket, 'MaxKeys': SYNC_PAGE_SIZE}
+            while True:
+                response = s3_client.list_objects_v2(**params)
+                contents = response.get('Contents', [])
+                if exclude_prefix and stale_after:
+                    cutoff = time.time() - stale_after
+                    stale.extend(obj['Key'] for obj in contents
+                                 if obj['Key'].startswith(exclude_prefix) and obj['LastModified'].timestamp() < cutoff)
+                self._apply_page(contents, generation, exclude_prefix, stats)
+                if not response.get('IsTruncated'):
+                    break
+                params['ContinuationToken'] = response['NextContinuationToken']
+
+            # delete_objects admite hasta 1000 claves por llamada
+            for start in range(0, len(stale), 1000):
+                s3_client.delete_objects(Bucket=bucket, Delete={
+                    'Objects': [{'Key': key} for key in stale[start:start + 1000]], 'Quiet': True})
+            stats['swept'] = len(stale)
+            STAGING_SWEPT.inc(len(stale))
+
+            with self._lock, self._db:
+                stats['deleted'] = self._db.execute(
+                    'DELETE FROM objects WHERE generation < ?', (generation,)).rowcount
+                if self.search_enabled and stats['deleted']:
+                    self._db.execute('DELETE FROM documents WHERE key NOT IN (SELECT key FROM objects)')
+                self._db.executemany('INSERT OR REPLACE INTO sync_state (name, value) VALUES (?, ?)',
+                                     [('generation', str(generation)), ('synced_at', str(time.time()))])
+            for change in ('added', 'updated', 'deleted'):
+                BUCKET_DB_SYNC_CHANGES.inc(stats[change], change=change)
+            return stats
+
+    def _apply_page(self, contents, generation, exclude_prefix, stats):
+        rows = []
+        for obj in contents:
+            if exclude_prefix and obj['Key'].startswith(exclude_prefix):
+                continue
+            rows.append((obj['Key'], obj['Size'], obj['ETag'].strip('"'),
+                         int(obj['LastModified'].timestamp() * 1000)))
+        stats['seen'] += len(rows)
+        if not rows:
+            return
+        with self._lock, self._db:
+            known = {}
+            # SQLite limita el número de parámetros por consulta
+            for start in range(0, len(rows), 500):
+                chunk = [row[0] for row in rows[start:start + 500]]
+                placeholders = ','.join('?' * len(chunk))
+                for key, etag, size in self._db.execute(
+                        f'SELECT key, etag, size FROM objects WHERE key IN ({placeholders})', chunk):
+                    known[key] = (etag, size)
+            changed = []
+            unchanged = []
+            for key, size, etag, timestamp in rows:
+                previous = known.get(key)
+                if previous == (etag, size):
+                    unchanged.append((generation, key))
+                    continue
+                stats['added' if previous is None else 'updated'] += 1
+                changed.append((key, folder_of(key), size, etag, timestamp, generation))
+            self._db.executemany('UPDATE objects SET generation = ? WHERE key = ?', unchanged)
+            self._db.executemany(
+                'INSERT INTO objects (key, folder, size, etag, upload_timestamp, generation) '
+                'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET folder = excluded.folder, '
+                'size = excluded.size, etag = excluded.etag, upload_timestamp = excluded.upload_timestamp, '
+                'generation = excluded.generation', changed)
+
+
+def start_sync(mirror, s3_client_factory, bucket, interval, exclude_prefix=None, stale_after=None,
+               on_change=None):
+    """
+    Lanza el hilo que reconcilia la copia al arrancar y cada `interval` segundos.
+    `on_change()` se llama tras cada pasada que añade, actualiza o borra objetos
+    (cambios hechos fuera de la aplicación).
+    """
+    def _run():
+        while True:
+            try:
+                s3_client = s3_client_factory()
+                if s3_client is not None:
+                    start = time.perf_counter()
+                    stats = mirror.sync(s3_client, bucket, exclude_prefix, stale_after)
+                    logger.info("Copia local del bucket reconciliada en %.0f ms: %s",
+                                (time.perf_counter() - start) * 1000, stats)
+                    if on_change is not None and (stats['added'] or stats['updated'] or stats['deleted']):
+                        on_change()
+            except Exception as e:
+                logger.warning("No se pudo reconciliar la copia local del bucket: %s", e)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=_run, name='bucket-sync', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,239 @@
+"""
+Entrega comprimida y cacheable de las páginas y los archivos estáticos.
+
+- Compresión: `compress_response` (after_request) comprime con brotli, si el
+  paquete está instalado y el navegador lo acepta, o con gzip las respuestas
+  de texto de al menos COMPRESS_MIN_BYTES. No toca las respuestas generadas
+  mientras se envían (exportaciones, NDJSON) ni las descargas de archivos; los
+  estáticos se comprimen una sola vez y se guardan en memoria.
+- Estáticos con huella: `static_url_defaults` (url_defaults) añade a cada
+  `url_for('static', ...)` el parámetro `v` con el hash del contenido, y
+  `static_cache_headers` sirve con caché de un año las peticiones que traen la
+  huella vigente. Al cambiar el archivo cambia la URL.
+- Caché de fragmentos: la extensión de Jinja `{% cache 'nombre', clave %}...
+  {% endcache %}` guarda el HTML generado durante FRAGMENT_CACHE_TTL segundos
+  o hasta `invalidate_fragments()`.
+"""
+import collections
+import gzip
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from flask import current_app, request
+from jinja2 import nodes
+from jinja2.ext import Extension
+from werkzeug.security import safe_join
+
+import metrics
+
+try:
+    import brotli
+except ImportError:  # opcional: sin el paquete solo se usa gzip
+    brotli = None
+
+logger = logging.getLogger('backblaze_uploader.delivery')
+
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', '1024'))  # 0 = sin compresión
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', '6'))  # gzip 1-9
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', '5'))  # 0-11; por encima de 5 es lento para páginas dinámicas
+STATIC_MAX_AGE = int(os.getenv('STATIC_MAX_AGE', str(365 * 24 * 3600)))  # segundos
+FRAGMENT_CACHE_TTL = float(os.getenv('FRAGMENT_CACHE_TTL', '30'))  # segundos, 0 = desactivada
+FRAGMENT_CACHE_SIZE = 256
+
+COMPRESSIBLE_TYPES = ('text/html', 'text/css', 'text/plain', 'text/javascript', 'application/javascript',
+                      'application/json', 'image/svg+xml')
+
+COMPRESSED_RESPONSES = metrics.counter(
+    'geotop_compressed_responses_total', 'Respuestas comprimidas por codificación', ['encoding'])
+COMPRESSION_SAVED_BYTES = metrics.counter(
+    'geotop_compression_saved_bytes_total', 'Bytes ahorrados al comprimir respuestas', ['encoding'])
+
+
+def _choose_encoding(accept_encodings):
+    if brotli is not None and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def _compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=COMPRESS_LEVEL, mtime=0)
+
+
+class _StaticFile:
+    __slots__ = ('signature', 'fingerprint', 'data', 'variants')
+
+    def __init__(self, signature, data):
+        self.signature = signature
+        self.fingerprint = hashlib.sha256(data).hexdigest()[:12]
+        self.data = data
+        self.variants = {}
+
+
+_static_files = {}
+_static_lock = threading.Lock()
+
+
+def _static_file(filename):
+    """
+    Contenido y huella de un archivo estático, releídos solo si cambió su fecha
+    de modificación o su tamaño. Devuelve None si no existe.
+    """
+    path = safe_join(current_app.static_folder, filename)
+    try:
+        stat = os.stat(path) if path else None
+    except OSError:
+        stat = None
+    if stat is None:
+        return None
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with _static_lock:
+        entry = _static_files.get(filename)
+    if entry is None or entry.signature != signature:
+        with open(path, 'rb') as f:
+            entry = _StaticFile(signature, f.read())
+        with _static_lock:
+            _static_files[filename] = entry
+    return entry
+
+
+def static_url_defaults(endpoint, values):
+    """
+    url_defaults: añade la huella `v` a las URL de los archivos estáticos.
+    """
+    if endpoint != 'static' or 'filename' not in values or 'v' in values:
+        return
+    entry = _static_file(values['filename'])
+    if entry is not None:
+        values['v'] = entry.fingerprint
+
+
+def static_cache_headers(response):
+    """
+    after_request: caché de larga duración para los estáticos pedidos con la
+    huella vigente. Sin huella (o con una antigua) se mantienen las cabeceras
+    por defecto de Flask.
+    """
+    if request.endpoint != 'static' or response.status_code not in (200, 304):
+        return response
+    version = request.args.get('v')
+    entry = _static_file(request.view_args.get('filename', '')) if version else None
+    if entry is not None and entry.fingerprint == version:
+        response.headers['Cache-Control'] = f'public, max-age={STATIC_MAX_AGE}, immutable'
+        response.expires = None
+    return response
+
+
+def compress_response(response):
+    """
+    after_request: comprime las respuestas de texto si el cliente lo acepta.
+    """
+    if COMPRESS_MIN_BYTES <= 0 or response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    if response.mimetype not in COMPRESSIBLE_TYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = _choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    if request.endpoint == 'static':
+        entry = _static_file(request.view_args.get('filename', ''))
+        if entry is None or len(entry.data) < COMPRESS_MIN_BYTES:
+            return response
+        data = entry.variants.get(encoding)
+        if data is None:
+            data = entry.variants[encoding] = _compress(entry.data, encoding)
+        original_size = len(entry.data)
+        # Se sustituye el archivo abierto por send_file por la versión comprimida
+        response.close()
+        response.direct_passthrough = False
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f'{etag}-{encoding}', weak)
+    elif response.is_streamed or response.direct_passthrough:
+        return response
+    else:
+        body = response.get_data()
+        if len(body) < COMPRESS_MIN_BYTES:
+            return response
+        data = _compress(body, encoding)
+        original_size = len(body)
+
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    COMPRESSED_RESPONSES.inc(encoding=encoding)
+    COMPRESSION_SAVED_BYTES.inc(max(0, original_size - len(data)), encoding=encoding)
+    return response
+
+
+class FragmentCache:
+    """
+    HTML de fragmentos de plantilla por clave, con caducidad y un máximo de
+    entradas (se descartan las menos usadas). `invalidate()` descarta todo, y
+    también lo que se esté generando en ese momento.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get_or_render(self, key, render):
+        if self.ttl <= 0:
+            return render()
+        with self._lock:
+            entry = self._entries.get(key)
+            generation = self._generation
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                metrics.record_cache('fragment', True)
+                return entry[1]
+        metrics.record_cache('fragment', False)
+        html = render()
+        with self._lock:
+            if generation == self._generation:
+                self._entries[key] = (time.monotonic() + self.ttl, html)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return html
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+
+fragment_cache = FragmentCache(FRAGMENT_CACHE_TTL, FRAGMENT_CACHE_SIZE)
+
+
+def invalidate_fragments():
+    fragment_cache.invalidate()
+
+
+class FragmentCacheExtension(Extension):
+    """
+    Etiqueta `{% cache 'nombre', valor, ... %}...{% endcache %}`: el cuerpo se
+    genera una vez por combinación de valores y se reutiliza desde fragment_cache.
+    """
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [nodes.List(args)]), [], [], body).set_lineno(lineno)
+
+    def _render(self, key, caller):
+        return fragment_cache.get_or_render(tuple(key), caller)
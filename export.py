@@ -0,0 +1,150 @@
+"""
+Exportación de los QR de todos los archivos de una carpeta.
+
+Dos formatos, ambos generados y enviados a medida que se completan:
+
+- `zip_stream`: un ZIP con el PNG del QR de cada archivo. zipfile escribe cada
+  entrada con descriptor de datos porque el destino (ChunkStream) no permite
+  retroceder, así que cada entrada se puede enviar en cuanto está escrita.
+- `labels_stream`: un PDF de etiquetas con `columns` x `rows` QR por página y
+  el nombre del archivo debajo de cada uno. Cada página se dibuja por separado
+  con reportlab y se añade con StreamingPdfWriter.
+
+Los PNG se obtienen en un pool de hilos con un número acotado de resultados
+pendientes, de modo que la memoria no depende del tamaño de la carpeta (solo
+la tabla de desplazamientos del ZIP o del PDF crece con el número de archivos).
+"""
+import collections
+import logging
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import metrics
+import pdfstream
+
+logger = logging.getLogger('backblaze_uploader.export')
+
+EXPORT_ITEMS = metrics.counter('geotop_export_items_total', 'QR exportados por formato', ['format'])
+
+LABEL_MARGIN = 36  # puntos
+LABEL_FONT_SIZE = 7
+
+
+class ChunkStream:
+    """
+    Destino de solo escritura que acumula lo escrito hasta que se recoge con
+    `drain()`. Lleva la cuenta de la posición (tell) pero no permite seek.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _ordered_results(items, function, workers):
+    """
+    Aplica `function` a cada elemento en un pool de hilos y entrega
+    (elemento, resultado) en el orden original, con como mucho 2 x workers
+    resultados pendientes a la vez.
+    """
+    in_flight = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in items:
+            in_flight.append((item, executor.submit(function, item)))
+            if len(in_flight) >= 2 * workers:
+                item, future = in_flight.popleft()
+                yield item, future.result()
+        while in_flight:
+            item, future = in_flight.popleft()
+            yield item, future.result()
+
+
+def zip_stream(items, png_for, workers):
+    """
+    Genera los bytes de un ZIP con un PNG por elemento. `items` son pares
+    (nombre dentro del ZIP, dato) y `png_for(dato)` devuelve los bytes del PNG.
+    """
+    output = ChunkStream()
+    with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for (arcname, _), png in _ordered_results(items, lambda item: png_for(item[1]), workers):
+            # Los PNG ya están comprimidos: se guardan sin volver a comprimir
+            archive.writestr(arcname, png)
+            EXPORT_ITEMS.inc(format='zip')
+            yield output.drain()
+    yield output.drain()
+
+
+def _label_page(entries, columns, rows, page_size):
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfgen import canvas
+
+    width, height = page_size
+    cell_width = (width - 2 * LABEL_MARGIN) / columns
+    cell_height = (height - 2 * LABEL_MARGIN) / rows
+    qr_size = min(cell_width, cell_height - 2 * LABEL_FONT_SIZE) * 0.85
+    max_chars = max(8, int(cell_width / (LABEL_FONT_SIZE * 0.5)))
+
+    packet = BytesIO()
+    can = canvas.Canvas(packet, pagesize=page_size)
+    can.setFont('Helvetica', LABEL_FONT_SIZE)
+    for index, (label, png) in enumerate(entries):
+        column, row = index % columns, index // columns
+        left = LABEL_MARGIN + column * cell_width
+        top = height - LABEL_MARGIN - row * cell_height
+        x = left + (cell_width - qr_size) / 2
+        y = top - qr_size - (cell_height - qr_size - 2 * LABEL_FONT_SIZE) / 2
+        can.drawImage(ImageReader(BytesIO(png)), x, y, qr_size, qr_size)
+        if len(label) > max_chars:
+            label = label[:max_chars - 1] + '…'
+        can.drawCentredString(left + cell_width / 2, y - 1.5 * LABEL_FONT_SIZE, label)
+    can.showPage()
+    can.save()
+    return packet.getvalue()
+
+
+def labels_stream(items, png_for, workers, columns=3, rows=4, page_size=None):
+    """
+    Genera los bytes de un PDF de etiquetas. `items` son pares (texto de la
+    etiqueta, dato) y `png_for(dato)` devuelve los bytes del PNG del QR.
+    """
+    from PyPDF2 import PdfReader
+    from reportlab.lib.pagesizes import letter
+
+    page_size = page_size or letter
+    per_page = columns * rows
+    output = ChunkStream()
+    writer = pdfstream.StreamingPdfWriter(output)
+    page = []
+    for (label, _), png in _ordered_results(items, lambda item: png_for(item[1]), workers):
+        page.append((label, png))
+        EXPORT_ITEMS.inc(format='labels')
+        if len(page) == per_page:
+            writer.append_reader(PdfReader(BytesIO(_label_page(page, columns, rows, page_size))))
+            page = []
+            yield output.drain()
+    if page or writer.page_count == 0:
+        writer.append_reader(PdfReader(BytesIO(_label_page(page, columns, rows, page_size))))
+    writer.close()
+    yield output.drain()
+
+
+def default_workers():
+    return min(8, os.cpu_count() or 1)
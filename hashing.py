@@ -0,0 +1,117 @@
+"""
+Hash de contenido de las subidas, calculado mientras llega la petición.
+
+HashingRequest sustituye el stream en el que werkzeug vuelca cada archivo del
+formulario multipart por un envoltorio que va actualizando un SHA-256 con
+cada bloque escrito, así que al terminar de recibir la petición el hash ya está
+calculado sin volver a leer el archivo.
+
+HashIndex recuerda en memoria qué clave del bucket tiene cada hash de origen
+para reconocer un contenido repetido aunque se suba con otro nombre o carpeta.
+"""
+import collections
+import hashlib
+import threading
+
+from flask import Request
+
+CHUNK_SIZE = 64 * 1024
+
+
+class HashingStream:
+    """
+    Envoltorio de archivo que calcula el SHA-256 de todo lo que se escribe.
+    El resto de operaciones (read, seek, close...) se delegan al archivo real.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._hasher = hashlib.sha256()
+
+    def write(self, data):
+        self._hasher.update(data)
+        return self._stream.write(data)
+
+    def hexdigest(self):
+        return self._hasher.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def __iter__(self):
+        return iter(self._stream)
+
+
+class HashingRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream = super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        return HashingStream(stream)
+
+
+def file_sha256(file_storage):
+    """
+    SHA-256 de un FileStorage. Usa el calculado durante la recepción si existe;
+    si no (por ejemplo, un archivo creado a mano), lo calcula leyendo el stream.
+    """
+    stream = file_storage.stream
+    # El stream puede venir envuelto (p. ej. por pdfcheck) sobre un HashingStream
+    hexdigest = getattr(stream, 'hexdigest', None)
+    if hexdigest is not None:
+        return hexdigest()
+    hasher = hashlib.sha256()
+    position = stream.tell()
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+        hasher.update(chunk)
+    stream.seek(position)
+    return hasher.hexdigest()
+
+
+def path_sha256(path):
+    """
+    SHA-256 de un archivo en disco.
+    """
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def combined_sha256(hashes):
+    """
+    Hash de origen de una subida: el del archivo si es uno solo, o el hash de
+    la lista ordenada de hashes si se combinan varios (el orden importa porque
+    cambia el PDF resultante y la página que lleva el QR).
+    """
+    if len(hashes) == 1:
+        return hashes[0]
+    return hashlib.sha256(('merge:' + ','.join(hashes)).encode('ascii')).hexdigest()
+
+
+class HashIndex:
+    """
+    Índice LRU en memoria de hash de origen -> clave en el bucket.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, source_hash):
+        with self._lock:
+            key = self._entries.get(source_hash)
+            if key is not None:
+                self._entries.move_to_end(source_hash)
+            return key
+
+    def put(self, source_hash, key):
+        with self._lock:
+            self._entries[source_hash] = key
+            self._entries.move_to_end(source_hash)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, source_hash):
+        with self._lock:
+            self._entries.pop(source_hash, None)
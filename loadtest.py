@@ -0,0 +1,410 @@
+"""
+Generador de carga que reproduce el tráfico real de subida y navegación.
+
+Por defecto arranca un servidor S3 local (s3_local.py), lanza la aplicación con
+`python app.py` apuntando a él, siembra el bucket con certificados de ejemplo y
+ejecuta una mezcla configurable de peticiones contra:
+
+    upload        POST /upload con un solo PDF
+    upload_merge  POST /upload con varios PDFs a combinar
+    files         GET  /files/<carpeta>
+    api_folders   GET  /api/folders
+    download_qr   GET  /download_qr/<archivo>
+    download_blank_with_qr  GET /download_blank_with_qr/<archivo>
+
+Al terminar informa del throughput, percentiles de latencia por ruta, tasa de
+errores y de los archivos temporales que quedaron en `uploads/`.
+
+Ejemplos:
+    python loadtest.py --duration 60 --concurrency 8
+    python loadtest.py --mix upload=1,files=5,download_qr=2 --requests 500
+    python loadtest.py --base-url http://localhost:8080 --uploads-dir uploads
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from io import BytesIO
+
+import requests
+
+DEFAULT_MIX = 'upload=2,upload_merge=1,files=4,api_folders=3,download_qr=2,download_blank_with_qr=2'
+SEED_FOLDERS = ['certificados', 'tecnicos', 'laborales']
+BUCKET_NAME = 'geotop-loadtest'
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_pdf(pages=1, label='Certificado'):
+    """
+    Genera un PDF de ejemplo con reportlab (texto y algo de dibujo por página).
+    """
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.pagesizes import letter
+
+    buffer = BytesIO()
+    can = canvas.Canvas(buffer, pagesize=letter)
+    for page in range(pages):
+        can.setFont('Helvetica-Bold', 18)
+        can.drawString(72, 720, f"{label} - página {page + 1}")
+        can.setFont('Helvetica', 10)
+        for line in range(40):
+            can.drawString(72, 690 - line * 14, f"Línea {line:02d}: equipo SN-{random.randint(10000, 99999)} calibrado")
+        can.rect(60, 60, 490, 660)
+        can.showPage()
+    can.save()
+    return buffer.getvalue()
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise SystemExit(f"Escenario desconocido: {name} (disponibles: {', '.join(SCENARIOS)})")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_http(url, timeout=60.0):
+    """
+    Espera hasta que la URL responda. Devuelve los segundos transcurridos.
+    """
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        try:
+            requests.get(url, timeout=2)
+            return time.perf_counter() - start
+        except requests.RequestException:
+            time.sleep(0.05)
+    raise RuntimeError(f"La aplicación no respondió en {timeout} segundos: {url}")
+
+
+# --- Escenarios ---
+
+class LoadContext:
+    """
+    Estado compartido por los workers: URL base, objetos sembrados y PDFs de ejemplo.
+    """
+
+    def __init__(self, base_url, seeded_keys, sample_pdfs):
+        self.base_url = base_url.rstrip('/')
+        self.seeded_keys = seeded_keys
+        self.sample_pdfs = sample_pdfs
+
+
+def _is_success_page(response):
+    # /upload responde 200 con success.html; los errores redirigen a index con flash
+    return response.status_code == 200 and b'action-btn' in response.content
+
+
+def scenario_upload(session, ctx):
+    name = f"carga_{random.randint(0, 10 ** 9)}.pdf"
+    files = [('files', (name, random.choice(ctx.sample_pdfs), 'application/pdf'))]
+    data = {'target_folder': random.choice(SEED_FOLDERS), 'qr_file_index': '0'}
+    response = session.post(f"{ctx.base_url}/upload", files=files, data=data, allow_redirects=False)
+    return _is_success_page(response), response
+
+
+def scenario_upload_merge(session, ctx):
+    count = random.randint(2, 4)
+    files = [
+        ('files', (f"anexo_{i}_{random.randint(0, 10 ** 9)}.pdf", random.choice(ctx.sample_pdfs), 'application/pdf'))
+        for i in range(count)
+    ]
+    data = {'target_folder': random.choice(SEED_FOLDERS), 'qr_file_index': str(random.randrange(count))}
+    response = session.post(f"{ctx.base_url}/upload", files=files, data=data, allow_redirects=False)
+    return _is_success_page(response), response
+
+
+def scenario_files(session, ctx):
+    response = session.get(f"{ctx.base_url}/files/{random.choice(SEED_FOLDERS)}", allow_redirects=False)
+    return response.status_code == 200, response
+
+
+def scenario_api_folders(session, ctx):
+    response = session.get(f"{ctx.base_url}/api/folders", allow_redirects=False)
+    return response.status_code == 200 and 'folders' in response.json(), response
+
+
+def scenario_download_qr(session, ctx):
+    key = random.choice(ctx.seeded_keys)
+    response = session.get(f"{ctx.base_url}/download_qr/{key}", allow_redirects=False)
+    return response.status_code == 200 and response.headers.get('Content-Type', '').startswith('image/'), response
+
+
+def scenario_download_blank_with_qr(session, ctx):
+    key = random.choice(ctx.seeded_keys)
+    response = session.get(f"{ctx.base_url}/download_blank_with_qr/{key}", allow_redirects=False)
+    return response.status_code == 200 and response.headers.get('Content-Type', '') == 'application/pdf', response
+
+
+SCENARIOS = {
+    'upload': scenario_upload,
+    'upload_merge': scenario_upload_merge,
+    'files': scenario_files,
+    'api_folders': scenario_api_folders,
+    'download_qr': scenario_download_qr,
+    'download_blank_with_qr': scenario_download_blank_with_qr,
+}
+
+
+# --- Ejecución ---
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.status_codes = defaultdict(lambda: defaultdict(int))
+
+    def record(self, route, elapsed, ok, status):
+        with self.lock:
+            self.latencies[route].append(elapsed)
+            self.status_codes[route][status] += 1
+            if not ok:
+                self.errors[route] += 1
+
+
+def worker(ctx, mix, results, deadline, remaining, remaining_lock):
+    session = requests.Session()
+    routes = list(mix)
+    weights = [mix[r] for r in routes]
+    while time.perf_counter() < deadline:
+        if remaining is not None:
+            with remaining_lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+        route = random.choices(routes, weights)[0]
+        start = time.perf_counter()
+        try:
+            ok, response = SCENARIOS[route](session, ctx)
+            status = response.status_code
+        except Exception:
+            ok, status = False, 'exc'
+        results.record(route, time.perf_counter() - start, ok, status)
+
+
+def snapshot_uploads(uploads_dir):
+    """
+    Tamaño de cada archivo de `uploads_dir` y sus subcarpetas (artifacts/,
+    db/...), por ruta relativa con "/".
+    """
+    if not os.path.isdir(uploads_dir):
+        return {}
+    snapshot = {}
+    for root, _, files in os.walk(uploads_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                snapshot[os.path.relpath(path, uploads_dir).replace(os.sep, '/')] = os.path.getsize(path)
+            except OSError:
+                continue
+    return snapshot
+
+
+def classify_leftover(path):
+    folder, _, name = path.rpartition('/')
+    if folder == 'artifacts':
+        # El almacén de artefactos está acotado; un temporal suyo es una escritura a medias
+        return 'artefacto_a_medias' if name.startswith('.tmp-') else 'artefacto'
+    if folder == 'db':
+        return 'copia_bucket'
+    for prefix in ('blank_qr_', 'blank_', 'qr_blank_', 'qr_', 'combined_'):
+        if name.startswith(prefix):
+            return prefix.rstrip('_')
+    return 'temporal_subida'
+
+
+def seed_bucket(endpoint, bucket, sample_pdfs, count):
+    """
+    Sube certificados de ejemplo directamente al S3 local para que las rutas de
+    navegación y descarga tengan objetos reales.
+    """
+    import boto3
+    from botocore.client import Config
+
+    client = boto3.client(
+        's3', endpoint_url=endpoint, aws_access_key_id='local', aws_secret_access_key='local',
+        region_name='us-east-005', config=Config(signature_version='s3v4'))
+    keys = []
+    for folder in SEED_FOLDERS:
+        client.put_object(Bucket=bucket, Key=f"{folder}/.folder_placeholder", Body=b'', ContentType='text/plain')
+    for i in range(count):
+        key = f"{SEED_FOLDERS[i % len(SEED_FOLDERS)]}/semilla_{i:04d}.pdf"
+        client.put_object(Bucket=bucket, Key=key, Body=sample_pdfs[i % len(sample_pdfs)], ContentType='application/pdf')
+        keys.append(key)
+    return keys
+
+
+def start_app(endpoint, port, extra_env):
+    env = dict(os.environ)
+    env.update({
+        'B2_ACCESS_KEY_ID': 'local',
+        'B2_SECRET_ACCESS_KEY': 'local',
+        'B2_BUCKET_NAME': BUCKET_NAME,
+        'B2_ENDPOINT': endpoint,
+        'B2_REGION': 'us-east-005',
+        'FLASK_SECRET_KEY': 'loadtest',
+        'PORT': str(port),
+        # Copia SQLite del bucket nueva: el S3 local empieza vacío en cada ejecución
+        'BUCKET_DB_PATH': os.path.join(tempfile.mkdtemp(prefix='geotop-loadtest-'), 'bucket.sqlite3'),
+    })
+    env.update(extra_env)
+    return subprocess.Popen(
+        [sys.executable, 'app.py'], cwd=BASE_DIR, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def print_report(results, elapsed, leftover, startup):
+    total = sum(len(v) for v in results.latencies.values())
+    total_errors = sum(results.errors.values())
+    print()
+    print(f"Duración: {elapsed:.1f} s  Peticiones: {total}  Throughput: {total / elapsed if elapsed else 0:.2f} req/s  "
+          f"Errores: {total_errors} ({100.0 * total_errors / total if total else 0:.1f}%)")
+    if startup is not None:
+        print(f"Arranque de la aplicación hasta el primer byte: {startup * 1000:.0f} ms")
+    print()
+    header = f"{'ruta':<24}{'n':>7}{'err%':>7}{'req/s':>8}{'p50 ms':>9}{'p90 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+    print(header)
+    print('-' * len(header))
+    for route in sorted(results.latencies):
+        values = sorted(results.latencies[route])
+        n = len(values)
+        print(f"{route:<24}{n:>7}{100.0 * results.errors[route] / n:>7.1f}{n / elapsed:>8.2f}"
+              f"{percentile(values, 50) * 1000:>9.0f}{percentile(values, 90) * 1000:>9.0f}"
+              f"{percentile(values, 95) * 1000:>9.0f}{percentile(values, 99) * 1000:>9.0f}{values[-1] * 1000:>9.0f}")
+    print()
+    if leftover:
+        by_kind = defaultdict(lambda: [0, 0])
+        for name, size in leftover.items():
+            by_kind[classify_leftover(name)][0] += 1
+            by_kind[classify_leftover(name)][1] += size
+        print(f"Archivos nuevos en uploads/ al terminar: {len(leftover)} ({sum(leftover.values()) / 1024:.1f} KB)")
+        for kind, (count, size) in sorted(by_kind.items()):
+            print(f"  {kind:<20}{count:>6} archivos {size / 1024:>10.1f} KB")
+    else:
+        print("Sin archivos nuevos en uploads/ al terminar")
+
+
+def build_report(results, elapsed, leftover, startup):
+    routes = {}
+    for route, values in results.latencies.items():
+        values = sorted(values)
+        routes[route] = {
+            'count': len(values),
+            'errors': results.errors[route],
+            'status_codes': {str(k): v for k, v in results.status_codes[route].items()},
+            'p50': percentile(values, 50), 'p90': percentile(values, 90),
+            'p95': percentile(values, 95), 'p99': percentile(values, 99), 'max': values[-1],
+        }
+    total = sum(r['count'] for r in routes.values())
+    return {
+        'elapsed': elapsed,
+        'requests': total,
+        'throughput': total / elapsed if elapsed else 0,
+        'startup_seconds': startup,
+        'routes': routes,
+        'uploads_leftover': leftover,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prueba de carga de la aplicación GEOTOP')
+    parser.add_argument('--base-url', help='URL de una aplicación ya arrancada (si no, se lanza una local)')
+    parser.add_argument('--uploads-dir', default=os.path.join(BASE_DIR, 'uploads'),
+                        help='Carpeta uploads/ de la aplicación, para medir archivos residuales')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'Pesos por escenario (por defecto: {DEFAULT_MIX})')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=30.0, help='Segundos de prueba')
+    parser.add_argument('--requests', type=int, help='Número total de peticiones (detiene antes que --duration)')
+    parser.add_argument('--seed-objects', type=int, default=30, help='Objetos a sembrar en el S3 local')
+    parser.add_argument('--pages', type=int, default=3, help='Páginas de los PDFs de ejemplo')
+    parser.add_argument('--app-env', action='append', default=[], metavar='CLAVE=VALOR',
+                        help='Variables de entorno extra para la aplicación lanzada')
+    parser.add_argument('--json', help='Guardar el informe también en JSON en esta ruta')
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    sample_pdfs = [make_pdf(pages=random.randint(1, args.pages), label=f"Certificado {i}") for i in range(5)]
+
+    s3_server = None
+    app_process = None
+    startup = None
+    seeded_keys = []
+    try:
+        if args.base_url:
+            base_url = args.base_url
+            seeded_keys = [f['name'] for f in requests.get(f"{base_url}/api/folders").json()['folders'].get(
+                'certificados', {}).get('files', [])]
+        else:
+            import s3_local
+            s3_server, endpoint = s3_local.start_server()
+            seeded_keys = seed_bucket(endpoint, BUCKET_NAME, sample_pdfs, args.seed_objects)
+            port = free_port()
+            base_url = f"http://127.0.0.1:{port}"
+            extra_env = dict(item.split('=', 1) for item in args.app_env)
+            app_process = start_app(endpoint, port, extra_env)
+            startup = wait_for_http(f"{base_url}/")
+
+        if not seeded_keys:
+            mix.pop('download_qr', None)
+            mix.pop('download_blank_with_qr', None)
+        ctx = LoadContext(base_url, seeded_keys, sample_pdfs)
+
+        before = snapshot_uploads(args.uploads_dir)
+        results = Results()
+        remaining = [args.requests] if args.requests else None
+        remaining_lock = threading.Lock()
+        start = time.perf_counter()
+        deadline = start + args.duration
+        threads = [
+            threading.Thread(target=worker, args=(ctx, mix, results, deadline, remaining, remaining_lock), daemon=True)
+            for _ in range(args.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        # Los temporales se borran al terminar cada petición; el conserje solo
+        # recoge huérfanos pasado ORPHAN_MAX_AGE, así que no hay nada que esperar
+        after = snapshot_uploads(args.uploads_dir)
+        leftover = {name: size for name, size in after.items() if name not in before}
+
+        print_report(results, elapsed, leftover, startup)
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(build_report(results, elapsed, leftover, startup), f, indent=2)
+    finally:
+        if app_process:
+            app_process.terminate()
+            app_process.wait(timeout=10)
+        if s3_server:
+            s3_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
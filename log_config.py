@@ -0,0 +1,156 @@
+"""
+Configuración de logging no bloqueante.
+
+Los hilos de las peticiones solo encolan registros (QueueHandler); un
+QueueListener en segundo plano los escribe en consola y en un archivo con
+rotación por tamaño. La salida puede ser JSON (por defecto) o texto, e incluye
+el ID de la petición y, cuando el registro lo aporta, los tiempos por etapa.
+
+Variables de entorno:
+    LOG_LEVEL          nivel mínimo (INFO por defecto)
+    LOG_FORMAT         json | text
+    LOG_FILE           archivo de log (backblaze_uploader.log)
+    LOG_MAX_BYTES      tamaño máximo antes de rotar (5 MB)
+    LOG_BACKUP_COUNT   archivos rotados que se conservan (5)
+    LOG_SAMPLE_RATE    1 de cada N mensajes de detalle por página (20)
+"""
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_SAMPLE_RATE = int(os.getenv('LOG_SAMPLE_RATE', '20'))
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
+
+# Atributos estándar de LogRecord que no se copian como campos extra en JSON
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'request_id', 'sample_rate'}
+
+
+class RequestContextFilter(logging.Filter):
+    """
+    Añade `request_id` al registro desde el contexto de Flask (si lo hay).
+    Se ejecuta en el hilo que emite el registro, antes de encolarlo.
+    """
+
+    def filter(self, record):
+        if not hasattr(record, 'request_id'):
+            record.request_id = '-'
+            try:
+                from flask import g, has_request_context
+                if has_request_context():
+                    record.request_id = g.get('request_id', '-')
+            except ImportError:
+                pass
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Deja pasar solo 1 de cada N registros que declaren `sample_rate=N` en
+    `extra`, agrupando por mensaje. El resto de registros pasa siempre.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        rate = getattr(record, 'sample_rate', None)
+        if not rate or rate <= 1:
+            return True
+        key = (record.name, record.msg)
+        with self._lock:
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+        return count % rate == 0
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _AsyncQueueHandler(QueueHandler):
+    """
+    QueueHandler que conserva la traza de excepción aparte del mensaje para que
+    el formateador JSON del listener pueda emitirla como campo propio.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener = None
+
+
+def setup_logging():
+    """
+    Configura el logger raíz con la cola asíncrona. Es idempotente.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    level = getattr(logging, os.getenv('LOG_LEVEL', 'INFO').upper(), logging.INFO)
+    if os.getenv('LOG_FORMAT', 'json').lower() == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT)
+
+    file_handler = RotatingFileHandler(
+        os.getenv('LOG_FILE', 'backblaze_uploader.log'),
+        maxBytes=int(os.getenv('LOG_MAX_BYTES', str(5 * 1024 * 1024))),
+        backupCount=int(os.getenv('LOG_BACKUP_COUNT', '5')),
+        encoding='utf-8',
+    )
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _AsyncQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+    queue_handler.addFilter(RequestContextFilter())
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    # Las bibliotecas de red son muy verbosas en DEBUG
+    for noisy in ('botocore', 'boto3', 's3transfer', 'urllib3'):
+        logging.getLogger(noisy).setLevel(max(level, logging.INFO))
+
+    _listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
@@ -0,0 +1,151 @@
+"""
+Lectura de PDFs a través de mmap.
+
+`open_pdf(ruta)` entrega un stream de solo lectura respaldado por un mmap del
+archivo: el sistema operativo carga las páginas bajo demanda y las lecturas no
+pasan por los buffers de Python de un archivo abierto. Dentro de una petición
+de Flask el mapeo de cada ruta se comparte entre todas las lecturas (merge,
+estampado, optimización...) y se cierra al terminar la petición; cada lector
+recibe su propia posición, así que pueden usarse a la vez sobre el mismo mapeo.
+
+Con PDF_MMAP=0, o si el archivo no se puede mapear (vacío, sistema de archivos
+sin soporte), se usa open() como antes.
+"""
+import logging
+import mmap
+import os
+from contextlib import contextmanager
+
+logger = logging.getLogger('backblaze_uploader.mapped')
+
+PDF_MMAP = os.getenv('PDF_MMAP', '1') == '1'
+
+
+class MappedStream:
+    """
+    Vista de lectura con posición propia sobre un mmap compartido. Implementa
+    lo que usa PdfReader: read, seek, tell y readline.
+    """
+
+    def __init__(self, mapping):
+        self._mapping = mapping
+        self._size = len(mapping)
+        self._position = 0
+
+    def read(self, size=-1):
+        start = self._position
+        end = self._size if size is None or size < 0 else min(self._size, start + size)
+        self._position = max(start, end)
+        return self._mapping[start:end]
+
+    def readline(self, size=-1):
+        end = self._mapping.find(b'\n', self._position)
+        end = self._size if end < 0 else end + 1
+        if size is not None and size >= 0:
+            end = min(end, self._position + size)
+        return self.read(end - self._position)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError(f"Posición negativa: {offset}")
+        self._position = offset
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def close(self):
+        pass
+
+
+def _map(path):
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _request_maps():
+    """
+    Diccionario ruta -> mmap de la petición en curso, o None fuera de Flask.
+    """
+    try:
+        from flask import g, has_request_context
+    except ImportError:
+        return None
+    if not has_request_context():
+        return None
+    return g.setdefault('pdf_mmaps', {})
+
+
+@contextmanager
+def open_pdf(path):
+    """
+    Abre `path` para lectura binaria, mapeado en memoria si es posible.
+    """
+    if not PDF_MMAP:
+        with open(path, 'rb') as f:
+            yield f
+        return
+
+    maps = _request_maps()
+    key = os.path.abspath(path)
+    mapping = maps.get(key) if maps is not None else None
+    owned = False
+    if mapping is None or mapping.closed:
+        try:
+            mapping = _map(path)
+        except (ValueError, OSError) as e:
+            logger.debug("No se pudo mapear %s (%s), se lee con open()", path, e)
+            with open(path, 'rb') as f:
+                yield f
+            return
+        if maps is not None:
+            maps[key] = mapping
+        else:
+            owned = True
+    try:
+        yield MappedStream(mapping)
+    finally:
+        if owned:
+            mapping.close()
+
+
+def release(path):
+    """
+    Cierra el mapeo compartido de `path` en la petición en curso (por ejemplo,
+    antes de borrar o sobrescribir el archivo).
+    """
+    maps = _request_maps()
+    if maps:
+        mapping = maps.pop(os.path.abspath(path), None)
+        if mapping is not None:
+            _close(mapping)
+
+
+def close_request_maps(exc=None):
+    """
+    Cierra todos los mapeos de la petición. Se registra como teardown_request.
+    """
+    maps = _request_maps()
+    if not maps:
+        return
+    for mapping in maps.values():
+        _close(mapping)
+    maps.clear()
+
+
+def _close(mapping):
+    try:
+        mapping.close()
+    except BufferError:
+        # Aún hay memoryviews exportados: el mmap se libera al recolectarlos
+        pass
@@ -0,0 +1,421 @@
+"""
+Métricas en formato de exposición de Prometheus, sin dependencias externas.
+
+Define contadores, gauges e histogramas con etiquetas y un registro global que
+se sirve en `/metrics`. Incluye:
+
+- `timer(stage)` / `timed(stage)`: miden la duración de cada etapa del pipeline.
+- `instrument_s3_client(client)`: cuenta llamadas a B2 por operación y su latencia
+  usando los eventos de botocore.
+- `record_cache(cache, hit)`: aciertos/fallos de las cachés.
+"""
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Etiquetas inválidas para {self.name}: {sorted(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f'{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}' for k, v in items]
+
+
+class Gauge(_Metric):
+    """
+    Gauge con valores asignados explícitamente o calculados en cada scrape
+    mediante `set_function`.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        """
+        `function()` debe devolver un número (sin etiquetas) o un dict
+        {tupla_de_valores_de_etiquetas: número}.
+        """
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            result = self._function()
+            items = sorted(result.items()) if isinstance(result, dict) else [((), result)]
+        else:
+            with self._lock:
+                items = sorted(self._values.items())
+        return [f'{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}' for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((k, ([*v[0]], v[1], v[2])) for k, v in self._values.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+# --- Métricas de la aplicación ---
+
+STAGE_DURATION = histogram(
+    'geotop_stage_duration_seconds', 'Duración de cada etapa del pipeline', ['stage'])
+STAGE_TOTAL = counter(
+    'geotop_stage_total', 'Ejecuciones de cada etapa del pipeline por resultado', ['stage', 'result'])
+
+HTTP_REQUESTS = counter(
+    'geotop_http_requests_total', 'Peticiones HTTP atendidas', ['endpoint', 'method', 'status'])
+HTTP_DURATION = histogram(
+    'geotop_http_request_duration_seconds', 'Duración de las peticiones HTTP', ['endpoint'])
+HTTP_BYTES = counter(
+    'geotop_http_bytes_total', 'Bytes recibidos (in) y enviados (out) por HTTP', ['direction'])
+
+B2_CALLS = counter(
+    'geotop_b2_api_calls_total', 'Llamadas a la API S3 de Backblaze B2', ['operation', 'result'])
+B2_DURATION = histogram(
+    'geotop_b2_api_call_duration_seconds', 'Latencia de las llamadas a Backblaze B2', ['operation'])
+B2_BYTES = counter(
+    'geotop_b2_bytes_total', 'Bytes subidos (upload) y descargados (download) de Backblaze B2', ['direction'])
+
+CACHE_REQUESTS = counter(
+    'geotop_cache_requests_total', 'Consultas a cachés internas por resultado', ['cache', 'result'])
+
+UPLOADS_DISK_BYTES = gauge('geotop_uploads_disk_bytes', 'Bytes ocupados por la carpeta uploads/ y sus subcarpetas')
+UPLOADS_DISK_FILES = gauge('geotop_uploads_disk_files', 'Archivos en la carpeta uploads/ y sus subcarpetas')
+
+
+# Funciones llamadas con (etapa, segundos) al terminar cada etapa
+_stage_listeners = []
+
+
+def add_stage_listener(listener):
+    """
+    Registra `listener(stage, seconds)`, que se llama al terminar cada etapa
+    (por ejemplo, para acumular los tiempos de la petición en curso).
+    """
+    _stage_listeners.append(listener)
+
+
+def _observe_stage(stage, seconds, result):
+    STAGE_DURATION.observe(seconds, stage=stage)
+    STAGE_TOTAL.inc(stage=stage, result=result)
+    for listener in _stage_listeners:
+        listener(stage, seconds)
+
+
+@contextmanager
+def timer(stage):
+    """
+    Mide la duración de una etapa y cuenta si terminó bien o con excepción.
+    """
+    start = time.perf_counter()
+    result = 'ok'
+    try:
+        yield
+    except BaseException:
+        result = 'error'
+        raise
+    finally:
+        _observe_stage(stage, time.perf_counter() - start, result)
+
+
+def timed(stage, is_error=None):
+    """
+    Decorador equivalente a `timer` para funciones completas. Como muchas
+    funciones de la aplicación capturan sus excepciones y devuelven False o
+    (None, error), `is_error(resultado)` permite marcar esos casos como error.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = 'error'
+            try:
+                value = function(*args, **kwargs)
+                if is_error is None or not is_error(value):
+                    result = 'ok'
+                return value
+            finally:
+                _observe_stage(stage, time.perf_counter() - start, result)
+        return wrapper
+    return decorator
+
+
+class MemoryProbe:
+    """
+    Mide el pico de memoria durante un bloque `with`, en bytes por encima del
+    uso al entrar (`peak`).
+
+    Si tracemalloc está activo se usa su pico (solo asignaciones de Python, pero
+    exacto). Si no, o en Python 3.8 (sin `tracemalloc.reset_peak`), un hilo
+    muestrea el RSS del proceso cada `interval` segundos, lo que incluye la
+    memoria de otras peticiones concurrentes.
+    Fuera de Linux, sin /proc, `peak` queda en None.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = None
+        self.source = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        import tracemalloc
+
+        if tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak'):
+            self.source = 'tracemalloc'
+            self._baseline = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        elif _current_rss() is not None:
+            self.source = 'rss'
+            self._baseline = self._max_rss = _current_rss()
+            self._thread = threading.Thread(target=self._sample, name='memory-probe', daemon=True)
+            self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._max_rss = max(self._max_rss, _current_rss() or 0)
+
+    def __exit__(self, *exc_info):
+        import tracemalloc
+
+        if self.source == 'tracemalloc':
+            self.peak = max(0, tracemalloc.get_traced_memory()[1] - self._baseline)
+        elif self.source == 'rss':
+            self._stop.set()
+            self._thread.join()
+            self._max_rss = max(self._max_rss, _current_rss() or 0)
+            self.peak = max(0, self._max_rss - self._baseline)
+        return False
+
+
+def _current_rss():
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def record_cache(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+def _directory_usage(path):
+    """
+    (bytes, archivos) de `path` y todas sus subcarpetas, sin seguir enlaces.
+    """
+    total = 0
+    files = 0
+    pending = [path]
+    while pending:
+        try:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            total += entry.stat(follow_symlinks=False).st_size
+                            files += 1
+                    except OSError:
+                        continue  # borrado mientras se recorría
+        except OSError:
+            continue
+    return total, files
+
+
+def watch_directory(path, max_age=1.0):
+    """
+    Publica el tamaño y número de archivos de `path`, subcarpetas incluidas.
+    Se recorre una vez por scrape: los dos gauges comparten el resultado
+    durante `max_age` segundos.
+    """
+    lock = threading.Lock()
+    cached = {'usage': (0, 0), 'expires': 0.0}
+
+    def _usage():
+        with lock:
+            if time.monotonic() >= cached['expires']:
+                cached['usage'] = _directory_usage(path)
+                cached['expires'] = time.monotonic() + max_age
+            return cached['usage']
+
+    UPLOADS_DISK_BYTES.set_function(lambda: _usage()[0])
+    UPLOADS_DISK_FILES.set_function(lambda: _usage()[1])
+
+
+# --- Instrumentación de boto3 ---
+
+def _before_call(model, context, **kwargs):
+    context['_metrics_start'] = time.perf_counter()
+
+
+def _after_call(http_response, model, context, **kwargs):
+    start = context.pop('_metrics_start', None)
+    if start is not None:
+        B2_DURATION.observe(time.perf_counter() - start, operation=model.name)
+    result = 'ok' if http_response.status_code < 300 else 'error'
+    B2_CALLS.inc(operation=model.name, result=result)
+
+
+def _after_call_error(model, context, **kwargs):
+    start = context.pop('_metrics_start', None)
+    if start is not None:
+        B2_DURATION.observe(time.perf_counter() - start, operation=model.name)
+    B2_CALLS.inc(operation=model.name, result='error')
+
+
+def instrument_s3_client(client):
+    """
+    Registra manejadores de eventos de botocore para contar y cronometrar cada
+    operación de la API que hace el cliente.
+    """
+    events = client.meta.events
+    events.register('before-call.s3', _before_call, unique_id='geotop-metrics-before')
+    events.register('after-call.s3', _after_call, unique_id='geotop-metrics-after')
+    events.register('after-call-error.s3', _after_call_error, unique_id='geotop-metrics-error')
+    return client
+
+
+def render():
+    return REGISTRY.render()
@@ -0,0 +1,144 @@
+"""
+Caché de documentos PDF ya analizados, indexada por el hash del contenido.
+
+Los paquetes suelen combinar un certificado distinto cada vez con los mismos
+anexos estándar (hojas de calibración, condiciones). Con esta caché un anexo
+repetido cuesta solo calcular su SHA-256: el PdfReader (con su tabla xref, sus
+páginas y los objetos ya resueltos) se reutiliza entre peticiones.
+
+- Solo se admiten archivos de hasta PDF_CACHE_MAX_ENTRY_MB y un documento entra
+  la segunda vez que se ve, para que los certificados únicos y los PDF
+  combinados no desplacen a los anexos.
+- El coste de cada entrada se estima como el doble del tamaño del archivo (los
+  bytes más los objetos analizados) y se expulsa por LRU al superar
+  PDF_CACHE_MB.
+- PdfReader no es seguro entre hilos: cada entrada tiene su candado y el lector
+  se entrega con él tomado. Quien modifique páginas debe trabajar sobre una
+  copia (`copy_page`).
+"""
+import collections
+import hashlib
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from io import BytesIO
+
+import mapped
+import metrics
+
+logger = logging.getLogger('backblaze_uploader.pdfcache')
+
+PDF_CACHE_BYTES = int(float(os.getenv('PDF_CACHE_MB', '64')) * 1024 * 1024)
+PDF_CACHE_MAX_ENTRY_BYTES = int(float(os.getenv('PDF_CACHE_MAX_ENTRY_MB', '4')) * 1024 * 1024)
+
+# Número de hashes recientes que se recuerdan para decidir la admisión
+_SEEN_SIZE = 1024
+
+PARSED_PDF_BYTES = metrics.gauge('geotop_parsed_pdf_cache_bytes', 'Coste estimado de la caché de PDFs analizados')
+PARSED_PDF_ENTRIES = metrics.gauge('geotop_parsed_pdf_cache_entries', 'Documentos en la caché de PDFs analizados')
+
+
+class _Entry:
+    __slots__ = ('reader', 'lock', 'cost')
+
+    def __init__(self, reader, cost):
+        self.reader = reader
+        self.lock = threading.Lock()
+        self.cost = cost
+
+
+class ParsedPdfCache:
+    def __init__(self, max_bytes, max_entry_bytes):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self._entries = collections.OrderedDict()  # sha256 -> _Entry
+        self._seen = collections.OrderedDict()  # sha256 de documentos vistos una vez
+        self._total = 0
+        self._lock = threading.Lock()
+        PARSED_PDF_BYTES.set_function(lambda: self._total)
+        PARSED_PDF_ENTRIES.set_function(lambda: len(self._entries))
+
+    @contextmanager
+    def reader_for(self, pdf_path):
+        """
+        Entrega `(lector, compartido)` para `pdf_path`. Si el documento está (o
+        entra) en la caché, el lector es compartido y se usa con el candado de
+        su entrada tomado; si no, se abre un lector normal sobre el archivo.
+        """
+        from PyPDF2 import PdfReader
+
+        entry = self._entry_for(pdf_path)
+        if entry is None:
+            with mapped.open_pdf(pdf_path) as pdf_file:
+                yield PdfReader(pdf_file), False
+            return
+        with entry.lock:
+            yield entry.reader, True
+
+    def _entry_for(self, pdf_path):
+        if self.max_bytes <= 0:
+            return None
+        try:
+            size = os.path.getsize(pdf_path)
+        except OSError:
+            return None
+        if size > self.max_entry_bytes:
+            return None
+
+        with mapped.open_pdf(pdf_path) as pdf_file:
+            data = pdf_file.read()
+        digest = hashlib.sha256(data).hexdigest()
+
+        admit = False
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                self._entries.move_to_end(digest)
+            elif digest in self._seen:
+                admit = True
+            else:
+                # Primera vez que se ve: recordar el hash pero no guardar el documento
+                self._seen[digest] = True
+                while len(self._seen) > _SEEN_SIZE:
+                    self._seen.popitem(last=False)
+        metrics.record_cache('parsed_pdf', entry is not None)
+        if not admit:
+            return entry
+
+        from PyPDF2 import PdfReader
+
+        reader = PdfReader(BytesIO(data))
+        if reader.is_encrypted:
+            reader.decrypt('')
+        entry = _Entry(reader, 2 * len(data))
+        with self._lock:
+            existing = self._entries.get(digest)
+            if existing is not None:
+                # Otro hilo lo analizó a la vez
+                return existing
+            self._seen.pop(digest, None)
+            self._entries[digest] = entry
+            self._total += entry.cost
+            while self._total > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._total -= evicted.cost
+        logger.debug("Documento añadido a la caché de PDFs analizados: %s (%s bytes)", pdf_path, len(data))
+        return entry
+
+
+def copy_page(page):
+    """
+    Copia superficial de una página para poder estamparla sin modificar la
+    original. merge_page sustituye /Contents y /Resources por objetos nuevos,
+    así que no hace falta copiar lo que cuelga de ellos.
+    """
+    from PyPDF2 import PageObject
+
+    copy = PageObject(page.pdf, page.indirect_reference)
+    copy.update(page)
+    return copy
+
+
+cache = ParsedPdfCache(PDF_CACHE_BYTES, PDF_CACHE_MAX_ENTRY_BYTES)
+reader_for = cache.reader_for
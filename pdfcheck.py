@@ -0,0 +1,191 @@
+"""
+Validación temprana de los PDF subidos.
+
+PdfUploadRequest envuelve cada archivo del formulario con PdfSniffingStream
+mientras werkzeug lo recibe: comprueba que la cabecera `%PDF-` aparezca en el
+primer KB y guarda el último KB para buscar el `%%EOF` final. Si la cabecera no
+aparece, deja de escribir el resto del archivo en disco. Después, antes de
+combinar, estampar o subir nada, `validate_pdf` abre el documento y comprueba
+que tenga páginas, que no pida contraseña y que no supere PDF_MAX_PAGES.
+
+Los PDF que el navegador sube directamente al bucket se revisan igual, una vez
+descargados, con `check_file`.
+
+Las imágenes (.jpg, .jpeg, .png) se suben tal cual y no se validan aquí.
+"""
+import logging
+import os
+
+import hashing
+import mapped
+import metrics
+
+logger = logging.getLogger('backblaze_uploader.pdfcheck')
+
+PDF_MAX_PAGES = int(os.getenv('PDF_MAX_PAGES', '0'))  # 0 = sin límite
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# La especificación permite basura antes de la cabecera y después del %%EOF;
+# los lectores la buscan en el primer y el último KB
+_HEADER_WINDOW = 1024
+_TRAILER_WINDOW = 1024
+
+UPLOADS_REJECTED = metrics.counter(
+    'geotop_uploads_rejected_total', 'Archivos rechazados por la validación previa', ['reason'])
+
+
+def is_image(filename):
+    return os.path.splitext(filename or '')[1].lower() in IMAGE_EXTENSIONS
+
+
+class PdfSniffingStream:
+    """
+    Envoltorio de archivo que revisa la cabecera y el final del PDF a medida
+    que se escribe. El resto de operaciones se delegan al archivo real.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._head = b''
+        self._tail = b''
+        self._header_ok = False
+        self._size = 0
+        self.rejected = None
+
+    def write(self, data):
+        self._size += len(data)
+        if self.rejected:
+            # Ya se sabe que no es un PDF: no tiene sentido guardar el resto
+            return len(data)
+        if not self._header_ok:
+            self._head = (self._head + data)[:_HEADER_WINDOW + 5]
+            if b'%PDF-' in self._head:
+                self._header_ok = True
+                self._head = b''
+            elif len(self._head) >= _HEADER_WINDOW + 5:
+                self.rejected = 'header'
+                return len(data)
+        self._tail = (self._tail + data)[-_TRAILER_WINDOW:]
+        return self._stream.write(data)
+
+    def pdf_error(self):
+        """
+        Motivo del rechazo según lo recibido, o None si parece un PDF completo.
+        """
+        if self._size == 0:
+            return 'empty'
+        if self.rejected or not self._header_ok:
+            return 'header'
+        if b'%%EOF' not in self._tail:
+            return 'trailer'
+        return None
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def __iter__(self):
+        return iter(self._stream)
+
+
+class PdfUploadRequest(hashing.HashingRequest):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream = super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        if is_image(filename):
+            return stream
+        return PdfSniffingStream(stream)
+
+
+_MESSAGES = {
+    'empty': 'el archivo está vacío',
+    'header': 'no es un archivo PDF (falta la cabecera %PDF)',
+    'trailer': 'el PDF está incompleto o dañado (falta el final %%EOF)',
+    'corrupt': 'el PDF está dañado y no se puede leer',
+    'no_pages': 'el PDF no tiene páginas',
+    'encrypted': 'el PDF está protegido con contraseña',
+    'too_many_pages': 'el PDF supera el máximo de {max_pages} páginas',
+}
+
+
+def stream_error(file_storage):
+    """
+    Motivo del rechazo detectado durante la recepción, o None. Los archivos que
+    no pasaron por PdfSniffingStream (creados a mano) no se revisan aquí.
+    """
+    pdf_error = getattr(file_storage.stream, 'pdf_error', None)
+    return pdf_error() if pdf_error is not None else None
+
+
+def validate_pdf(pdf_path):
+    """
+    Abre el PDF y comprueba que se pueda usar. Devuelve (páginas, motivo) con
+    motivo None si es válido.
+    """
+    from PyPDF2 import PdfReader
+
+    try:
+        with mapped.open_pdf(pdf_path) as pdf_file:
+            reader = PdfReader(pdf_file)
+            if reader.is_encrypted:
+                # Los PDF con solo contraseña de propietario se abren con la vacía
+                try:
+                    if not reader.decrypt(''):
+                        return 0, 'encrypted'
+                except Exception:
+                    return 0, 'encrypted'
+            pages = len(reader.pages)
+    except Exception as e:
+        logger.info("No se pudo leer %s: %s", pdf_path, e)
+        return 0, 'corrupt'
+    if pages == 0:
+        return 0, 'no_pages'
+    if PDF_MAX_PAGES and pages > PDF_MAX_PAGES:
+        return pages, 'too_many_pages'
+    return pages, None
+
+
+def check_upload(file_storage, saved_path=None):
+    """
+    Valida un archivo subido: primero lo visto durante la recepción y, si se
+    indica `saved_path`, la estructura del documento guardado. Devuelve
+    (páginas, mensaje de error) con mensaje None si el archivo es válido.
+    """
+    if is_image(file_storage.filename):
+        return 0, None
+    reason = stream_error(file_storage)
+    pages = 0
+    if reason is None and saved_path is not None:
+        pages, reason = validate_pdf(saved_path)
+    return _result(pages, reason)
+
+
+def check_file(pdf_path):
+    """
+    Igual que `check_upload` para un PDF que no pasó por el formulario (por
+    ejemplo, descargado del prefijo de staging): revisa la cabecera y el final
+    leyendo solo el primer y el último KB, y después la estructura.
+    """
+    size = os.path.getsize(pdf_path)
+    with open(pdf_path, 'rb') as f:
+        head = f.read(_HEADER_WINDOW + 5)
+        f.seek(max(0, size - _TRAILER_WINDOW))
+        tail = f.read()
+    if size == 0:
+        reason = 'empty'
+    elif b'%PDF-' not in head:
+        reason = 'header'
+    elif b'%%EOF' not in tail:
+        reason = 'trailer'
+    else:
+        reason = None
+    pages = 0
+    if reason is None:
+        pages, reason = validate_pdf(pdf_path)
+    return _result(pages, reason)
+
+
+def _result(pages, reason):
+    if reason is None:
+        return pages, None
+    UPLOADS_REJECTED.inc(reason=reason)
+    return pages, _MESSAGES[reason].format(max_pages=PDF_MAX_PAGES)
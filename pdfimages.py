@@ -0,0 +1,195 @@
+"""
+Reducción opcional de las imágenes de PDFs escaneados.
+
+Busca las imágenes de cada página (XObjects /Image del diccionario de
+recursos), estima su resolución suponiendo que ocupan la página completa, que
+es el caso de los escaneos, y las que superan `max_dpi` se reescalan y se
+recodifican como JPEG con la calidad indicada. Al estimar con el tamaño de la
+página, una imagen dibujada más pequeña (un logo) nunca parece tener más DPI
+de los reales, así que no se degrada por error.
+
+Solo se tocan imágenes JPEG (DCTDecode) o sin pérdida (FlateDecode) de 8 bits
+en RGB o escala de grises y sin máscara; el resto se copia tal cual. El
+recodificado se reparte entre varios hilos (Pillow libera el GIL al
+redimensionar y comprimir) y el resultado se escribe con StreamingPdfWriter.
+"""
+import collections
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import mapped
+import metrics
+import pdfstream
+
+logger = logging.getLogger('backblaze_uploader.pdfimages')
+
+IMAGES_RECOMPRESSED = metrics.counter(
+    'geotop_images_recompressed_total', 'Imágenes reescaladas o recodificadas antes del estampado')
+IMAGES_SAVED_BYTES = metrics.counter(
+    'geotop_images_saved_bytes_total', 'Bytes ahorrados al recodificar imágenes de PDFs escaneados')
+
+_COLOR_MODES = {'/DeviceRGB': 'RGB', '/DeviceGray': 'L'}
+
+# Claves que describen la codificación original y se sustituyen al recodificar
+_ENCODING_KEYS = ('/Filter', '/DecodeParms', '/Length', '/Width', '/Height', '/BitsPerComponent', '/ColorSpace')
+
+
+def _candidate(image):
+    """
+    Devuelve el modo de Pillow si la imagen se puede recodificar, o None.
+    """
+    if image.get('/Subtype') != '/Image' or '/SMask' in image or '/Mask' in image or '/Decode' in image:
+        return None
+    if image.get('/ImageMask') or image.get('/BitsPerComponent') != 8:
+        return None
+    color_space = image.get('/ColorSpace')
+    color_space = color_space.get_object() if color_space is not None else None
+    mode = _COLOR_MODES.get(color_space)
+    if mode is None or _image_filter(image) not in ('/DCTDecode', '/FlateDecode'):
+        return None
+    return mode
+
+
+def _image_filter(image):
+    """
+    Filtro que define la codificación de la imagen. Se admiten delante los
+    filtros ASCII que añaden algunos generadores (reportlab usa ASCII85).
+    """
+    filters = image.get('/Filter')
+    filters = filters.get_object() if filters is not None else None
+    if not isinstance(filters, list):
+        return filters
+    if not filters or any(f not in ('/ASCII85Decode', '/ASCIIHexDecode') for f in filters[:-1]):
+        return None
+    return filters[-1]
+
+
+def _find_images(reader):
+    """
+    Recorre las páginas y devuelve {(idnum, generación): (referencia, modo, dpi)}
+    con la menor resolución estimada de cada imagen entre las páginas que la usan.
+    """
+    from PyPDF2.generic import IndirectObject
+
+    found = {}
+    for page in reader.pages:
+        page_width = float(page.mediabox.width) / 72.0
+        page_height = float(page.mediabox.height) / 72.0
+        if page_width <= 0 or page_height <= 0:
+            continue
+        resources = page.get('/Resources')
+        resources = resources.get_object() if resources is not None else {}
+        xobjects = resources.get('/XObject')
+        xobjects = xobjects.get_object() if xobjects is not None else {}
+        for ref in xobjects.values():
+            if not isinstance(ref, IndirectObject):
+                continue
+            image = ref.get_object()
+            mode = _candidate(image)
+            if mode is None:
+                continue
+            width, height = int(image['/Width']), int(image['/Height'])
+            # La orientación de la imagen puede no coincidir con la de la página
+            dpi = min(max(width, height) / max(page_width, page_height),
+                      min(width, height) / min(page_width, page_height))
+            key = (ref.idnum, ref.generation)
+            if key not in found or dpi < found[key][2]:
+                found[key] = (ref, mode, dpi)
+    return found
+
+
+def _recompress(raw, is_jpeg, mode, size, scale, quality):
+    """
+    Decodifica, reescala y codifica como JPEG. Se ejecuta en los hilos de trabajo.
+    """
+    from PIL import Image
+
+    if is_jpeg:
+        image = Image.open(BytesIO(raw))
+        image.draft(mode, (int(size[0] * scale), int(size[1] * scale)))
+        image = image.convert(mode)
+    else:
+        image = Image.frombytes(mode, size, raw)
+    if scale < 1:
+        new_size = (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+        image = image.resize(new_size, Image.LANCZOS)
+    output = BytesIO()
+    image.save(output, format='JPEG', quality=quality, optimize=True)
+    return output.getvalue(), image.size
+
+
+def _replacement(original, mode, data, size):
+    from PyPDF2.generic import EncodedStreamObject, NameObject, NumberObject
+
+    stream = EncodedStreamObject()
+    for key, value in original.items():
+        if key not in _ENCODING_KEYS:
+            stream[NameObject(key)] = value
+    stream[NameObject('/Width')] = NumberObject(size[0])
+    stream[NameObject('/Height')] = NumberObject(size[1])
+    stream[NameObject('/BitsPerComponent')] = NumberObject(8)
+    stream[NameObject('/ColorSpace')] = NameObject('/DeviceRGB' if mode == 'RGB' else '/DeviceGray')
+    stream[NameObject('/Filter')] = NameObject('/DCTDecode')
+    stream._data = data
+    return stream
+
+
+def downsample(input_path, output_path, max_dpi, quality=75, workers=None):
+    """
+    Reescala a `max_dpi` las imágenes que lo superen y escribe el resultado en
+    `output_path`. Devuelve un dict con las imágenes revisadas, las
+    recodificadas y los bytes ahorrados; si no hay nada que cambiar no escribe
+    el archivo de salida.
+    """
+    from PyPDF2 import PdfReader
+
+    replacements = {}
+    saved = 0
+    with mapped.open_pdf(input_path) as pdf_file:
+        reader = PdfReader(pdf_file)
+        if reader.is_encrypted:
+            reader.decrypt('')
+        images = _find_images(reader)
+
+        def collect(job):
+            nonlocal saved
+            key, image, mode, future = job
+            try:
+                data, size = future.result()
+            except Exception as e:
+                logger.warning("No se pudo recodificar la imagen %s: %s", key, e)
+                return
+            if len(data) < len(image._data):
+                replacements[key] = _replacement(image, mode, data, size)
+                saved += len(image._data) - len(data)
+
+        workers = workers or os.cpu_count() or 1
+        in_flight = collections.deque()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for key, (ref, mode, dpi) in images.items():
+                if dpi <= max_dpi:
+                    continue
+                image = ref.get_object()
+                is_jpeg = _image_filter(image) == '/DCTDecode'
+                # Se decodifica aquí porque PdfReader no es seguro entre hilos;
+                # en un JPEG get_data() devuelve el archivo JPEG sin descomprimir
+                raw = image.get_data()
+                size = (int(image['/Width']), int(image['/Height']))
+                future = executor.submit(_recompress, raw, is_jpeg, mode, size, max_dpi / dpi, quality)
+                in_flight.append((key, image, mode, future))
+                # Limitar las imágenes descomprimidas en memoria a la vez
+                if len(in_flight) >= 2 * workers:
+                    collect(in_flight.popleft())
+            while in_flight:
+                collect(in_flight.popleft())
+
+    if replacements:
+        with open(output_path, 'wb') as output_file:
+            writer = pdfstream.StreamingPdfWriter(output_file)
+            writer.append(input_path, replacements)
+            writer.close()
+        IMAGES_RECOMPRESSED.inc(len(replacements))
+        IMAGES_SAVED_BYTES.inc(saved)
+    return {'images': len(images), 'recompressed': len(replacements), 'saved': saved}
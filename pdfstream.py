@@ -0,0 +1,410 @@
+"""
+Escritor de PDF incremental para combinar archivos con memoria acotada.
+
+A diferencia de PdfWriter, que mantiene todas las páginas y sus recursos en
+memoria hasta el final, StreamingPdfWriter escribe cada objeto en el archivo de
+salida en cuanto se copia y solo conserva en memoria la tabla de offsets (un
+entero por objeto) y la lista de páginas. Cada documento de origen se abre con
+su propio PdfReader, se copian sus páginas renumerando los objetos y se libera
+antes de pasar al siguiente, así que el pico de memoria depende del objeto más
+grande de un archivo (normalmente una imagen escaneada), no del paquete entero.
+
+Igual que PdfWriter.add_page, solo se copian las páginas y lo que cuelga de
+ellas (recursos, contenidos, anotaciones); no se copian marcadores ni
+formularios a nivel de documento.
+
+`optimize()` reescribe un PDF ya generado con el mismo escritor: descarta los
+objetos que no cuelgan de ninguna página, fusiona los objetos idénticos (por
+ejemplo el logo o las fuentes que cada anexo trae por separado) y comprime con
+FlateDecode los streams que no tienen filtro.
+"""
+import collections
+import hashlib
+import logging
+import zlib
+
+import mapped
+import metrics
+from log_config import LOG_SAMPLE_RATE
+
+logger = logging.getLogger('backblaze_uploader.pdfstream')
+
+MERGE_PEAK_MEMORY = metrics.histogram(
+    'geotop_merge_peak_memory_bytes', 'Pico de memoria por combinación de PDFs', ['mode'],
+    buckets=tuple(mb * 1024 * 1024 for mb in (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)))
+
+OPTIMIZE_SAVED_BYTES = metrics.counter(
+    'geotop_pdf_optimize_saved_bytes_total', 'Bytes ahorrados por la optimización de PDFs antes de subirlos')
+
+_CATALOG = 1
+_PAGES = 2
+
+
+class StreamingPdfWriter:
+    """
+    Uso:
+
+        with open(ruta, 'wb') as output:
+            writer = StreamingPdfWriter(output)
+            writer.append(ruta_origen)   # una vez por archivo
+            writer.close()
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._offsets = [None, None, None]  # índice = número de objeto; 1 y 2 reservados
+        self._page_numbers = []
+        self.stream.write(b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n')
+
+    @property
+    def page_count(self):
+        return len(self._page_numbers)
+
+    def _allocate(self):
+        self._offsets.append(None)
+        return len(self._offsets) - 1
+
+    def _begin_object(self, number):
+        self._offsets[number] = self.stream.tell()
+        self.stream.write(f"{number} 0 obj\n".encode('ascii'))
+
+    def _end_object(self):
+        self.stream.write(b'\nendobj\n')
+
+    def _write_serialized(self, number, data):
+        self._begin_object(number)
+        self.stream.write(data)
+        self._end_object()
+
+    def append(self, pdf_path, replacements=None):
+        """
+        Copia todas las páginas de `pdf_path` al final del documento y devuelve
+        cuántas se añadieron. El archivo de origen se lee de forma perezosa y
+        se cierra al terminar. `replacements` permite sustituir objetos del
+        origen, indexados por (idnum, generación), por otros ya construidos.
+        """
+        from PyPDF2 import PdfReader
+
+        with mapped.open_pdf(pdf_path) as pdf_file:
+            reader = PdfReader(pdf_file)
+            if reader.is_encrypted:
+                # Igual que PdfWriter: solo se admiten PDF cifrados sin contraseña de apertura
+                reader.decrypt('')
+            return self.append_reader(reader, replacements)
+
+    def append_reader(self, reader, replacements=None, release=True):
+        """
+        Como `append`, pero con un PdfReader ya abierto. Con `release=False` no
+        se vacía la caché de objetos del lector (lectores compartidos).
+        """
+        pages = reader.pages
+        total = len(pages)
+        if total == 0:
+            return 0
+        _SourceCopier(self, reader, replacements, release).copy_pages(pages)
+        return total
+
+    def close(self):
+        """
+        Escribe el árbol de páginas, el catálogo, la tabla xref y el trailer.
+        """
+        kids = ' '.join(f"{number} 0 R" for number in self._page_numbers)
+        self._begin_object(_PAGES)
+        self.stream.write(f"<< /Type /Pages /Kids [ {kids} ] /Count {len(self._page_numbers)} >>".encode('ascii'))
+        self._end_object()
+        self._begin_object(_CATALOG)
+        self.stream.write(f"<< /Type /Catalog /Pages {_PAGES} 0 R >>".encode('ascii'))
+        self._end_object()
+
+        xref_offset = self.stream.tell()
+        self.stream.write(f"xref\n0 {len(self._offsets)}\n".encode('ascii'))
+        self.stream.write(b'0000000000 65535 f \n')
+        for offset in self._offsets[1:]:
+            if offset is None:
+                # Objeto reservado que no llegó a escribirse (origen ilegible a medias)
+                self.stream.write(b'0000000000 65535 f \n')
+            else:
+                self.stream.write(f"{offset:010d} 00000 n \n".encode('ascii'))
+        self.stream.write(
+            f"trailer\n<< /Size {len(self._offsets)} /Root {_CATALOG} 0 R >>\n"
+            f"startxref\n{xref_offset}\n%%EOF\n".encode('ascii'))
+        self.stream.flush()
+
+
+class _SourceCopier:
+    """
+    Copia las páginas de un PdfReader al escritor. Mantiene la correspondencia
+    entre los números de objeto del origen y los nuevos solo mientras dura la
+    copia de ese archivo.
+    """
+
+    def __init__(self, writer, reader, replacements=None, release=True):
+        self.writer = writer
+        self.reader = reader
+        self.replacements = replacements or {}
+        self.release = release
+        self._numbers = {}  # (idnum, generación) del origen -> número nuevo
+        self._pending = collections.deque()
+
+    def copy_pages(self, pages):
+        # Reservar primero los números de todas las páginas para que los
+        # enlaces internos (/Dest, /P) apunten a las copias y no las dupliquen
+        page_numbers = []
+        for page in pages:
+            ref = page.indirect_reference
+            number = self.writer._allocate()
+            if ref is not None:
+                self._numbers[(ref.idnum, ref.generation)] = number
+            page_numbers.append(number)
+
+        for page, number in zip(pages, page_numbers):
+            self._write(number, page, is_page=True)
+            self._drain()
+            self.writer._page_numbers.append(number)
+
+    def _ref(self, indirect):
+        from PyPDF2.generic import IndirectObject
+
+        key = (indirect.idnum, indirect.generation)
+        number = self._numbers.get(key)
+        if number is None:
+            number = self.writer._allocate()
+            self._numbers[key] = number
+            self._pending.append((indirect, number))
+        return IndirectObject(number, 0, None)
+
+    def _drain(self):
+        while self._pending:
+            indirect, number = self._pending.popleft()
+            obj = self.replacements.get((indirect.idnum, indirect.generation))
+            self._write(number, obj if obj is not None else indirect.get_object())
+            # Soltar el objeto de la caché del lector: ya está en disco y su
+            # número nuevo queda registrado si otra página lo vuelve a usar
+            if self.release:
+                self.reader.resolved_objects.pop((indirect.generation, indirect.idnum), None)
+
+    def _write(self, number, obj, is_page=False):
+        from PyPDF2.generic import IndirectObject, NameObject, NullObject
+
+        if obj is None:
+            obj = NullObject()
+        copy = self._copy(obj, is_page)
+        if is_page:
+            copy[NameObject('/Parent')] = IndirectObject(_PAGES, 0, None)
+        self.writer._begin_object(number)
+        copy.write_to_stream(self.writer.stream, None)
+        self.writer._end_object()
+
+    def _copy(self, obj, is_page=False):
+        """
+        Copia superficial de `obj` con las referencias indirectas renumeradas.
+        Los objetos referenciados se encolan para escribirse después.
+        """
+        from PyPDF2.generic import (ArrayObject, DecodedStreamObject, DictionaryObject, EncodedStreamObject,
+                                    IndirectObject, NameObject, StreamObject)
+
+        if isinstance(obj, IndirectObject):
+            return self._ref(obj)
+        if isinstance(obj, StreamObject):
+            # ContentStream (páginas ya modificadas) también es un DecodedStreamObject
+            copy = DecodedStreamObject() if isinstance(obj, DecodedStreamObject) else EncodedStreamObject()
+            copy._data = obj._data
+            for key, value in obj.items():
+                # /Length se recalcula al escribir; si es indirecto no hace falta copiarlo
+                if key != '/Length':
+                    copy[NameObject(key)] = self._copy(value)
+            return copy
+        if isinstance(obj, DictionaryObject):
+            copy = DictionaryObject()
+            for key, value in obj.items():
+                # El /Parent de las páginas se sustituye por el árbol de páginas nuevo
+                if key == '/Parent' and (is_page or obj.get('/Type') == '/Page'):
+                    continue
+                copy[NameObject(key)] = self._copy(value)
+            return copy
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(self._copy(item) for item in obj)
+        return obj
+
+
+def _child_refs(obj, is_page=False):
+    """
+    Referencias indirectas que `_SourceCopier._copy` renumeraría en `obj`.
+    """
+    from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+
+    stack = [(obj, is_page)]
+    while stack:
+        current, current_is_page = stack.pop()
+        if isinstance(current, IndirectObject):
+            yield current
+        elif isinstance(current, DictionaryObject):
+            for key, value in current.items():
+                if key == '/Parent' and (current_is_page or current.get('/Type') == '/Page'):
+                    continue
+                if key == '/Length' and isinstance(current, StreamObject):
+                    continue
+                stack.append((value, False))
+        elif isinstance(current, ArrayObject):
+            stack.extend((item, False) for item in current)
+
+
+class _Optimizer(_SourceCopier):
+    """
+    Copia las páginas en post-orden: cada objeto se serializa cuando todos los
+    que referencia ya tienen número, de modo que dos objetos con los mismos
+    bytes (referencias incluidas) son equivalentes y se escriben una sola vez.
+    Los objetos que forman ciclos (anotaciones que apuntan a su página, por
+    ejemplo) reciben el número por adelantado y no se fusionan.
+    """
+
+    def __init__(self, writer, reader, compress_level):
+        super().__init__(writer, reader)
+        self.compress_level = compress_level
+        self._digests = {}  # sha256 de la serialización -> número nuevo
+        self._reserved = set()  # claves con número asignado antes de escribirse
+        self.deduplicated = 0
+        self.compressed = 0
+
+    def _ref(self, indirect):
+        from PyPDF2.generic import IndirectObject
+
+        return IndirectObject(self._numbers[(indirect.idnum, indirect.generation)], 0, None)
+
+    def copy_pages(self, pages):
+        roots = []
+        for page in pages:
+            ref = page.indirect_reference
+            number = self.writer._allocate()
+            if ref is not None:
+                key = (ref.idnum, ref.generation)
+                self._numbers[key] = number
+                self._reserved.add(key)
+            roots.append((number, page))
+
+        for number, page in roots:
+            self._visit(page, is_page=True, number=number)
+            self.writer._page_numbers.append(number)
+
+    def _visit(self, root, is_page, number):
+        in_progress = set()
+        # Cada marco: [clave, objeto, es_página, número fijo, hijos pendientes]
+        stack = [[None, root, is_page, number, list(_child_refs(root, is_page))]]
+        while stack:
+            frame = stack[-1]
+            key, obj, frame_is_page, fixed_number, children = frame
+            while children:
+                child = children.pop()
+                child_key = (child.idnum, child.generation)
+                if child_key in self._numbers and child_key not in in_progress:
+                    continue
+                if child_key in in_progress:
+                    # Ciclo: el objeto aún no está escrito, reservar su número
+                    if child_key not in self._numbers:
+                        self._numbers[child_key] = self.writer._allocate()
+                        self._reserved.add(child_key)
+                    continue
+                child_obj = child.get_object()
+                in_progress.add(child_key)
+                stack.append([child_key, child_obj, False, None, list(_child_refs(child_obj))])
+                break
+            else:
+                stack.pop()
+                self._emit(key, obj, frame_is_page, fixed_number)
+                if key is not None:
+                    in_progress.discard(key)
+                    self.reader.resolved_objects.pop((key[1], key[0]), None)
+
+    def _emit(self, key, obj, is_page, number):
+        from io import BytesIO
+        from PyPDF2.generic import (EncodedStreamObject, IndirectObject, NameObject, NullObject,
+                                    StreamObject)
+
+        if obj is None:
+            obj = NullObject()
+        copy = self._copy(obj, is_page)
+        if is_page:
+            copy[NameObject('/Parent')] = IndirectObject(_PAGES, 0, None)
+        if isinstance(copy, StreamObject) and '/Filter' not in copy and self.compress_level:
+            compressed = zlib.compress(copy._data, self.compress_level)
+            if len(compressed) < len(copy._data):
+                flate = EncodedStreamObject()
+                flate.update(copy)
+                flate[NameObject('/Filter')] = NameObject('/FlateDecode')
+                flate._data = compressed
+                copy = flate
+                self.compressed += 1
+
+        buffer = BytesIO()
+        copy.write_to_stream(buffer, None)
+        data = buffer.getvalue()
+
+        if number is None and key in self._reserved:
+            number = self._numbers[key]
+        if number is None and not (isinstance(obj, dict) and obj.get('/Type') == '/Page'):
+            digest = hashlib.sha256(data).digest()
+            existing = self._digests.get(digest)
+            if existing is not None:
+                self._numbers[key] = existing
+                self.deduplicated += 1
+                return
+            number = self.writer._allocate()
+            self._digests[digest] = number
+        elif number is None:
+            number = self.writer._allocate()
+        if key is not None:
+            self._numbers[key] = number
+        self.writer._write_serialized(number, data)
+
+
+def optimize(input_path, output_path, compress_level=6):
+    """
+    Reescribe `input_path` en `output_path` sin objetos huérfanos, con los
+    objetos idénticos fusionados y los streams sin filtro comprimidos.
+    Devuelve un dict con las páginas, los objetos fusionados y los streams
+    comprimidos.
+    """
+    from PyPDF2 import PdfReader
+
+    with mapped.open_pdf(input_path) as pdf_file, open(output_path, 'wb') as output_file:
+        reader = PdfReader(pdf_file)
+        if reader.is_encrypted:
+            reader.decrypt('')
+        writer = StreamingPdfWriter(output_file)
+        optimizer = _Optimizer(writer, reader, compress_level)
+        optimizer.copy_pages(reader.pages)
+        writer.close()
+    return {
+        'pages': writer.page_count,
+        'deduplicated': optimizer.deduplicated,
+        'compressed': optimizer.compressed,
+    }
+
+
+def merge(pdf_paths, output_path, reader_for=None):
+    """
+    Combina `pdf_paths` en `output_path` con StreamingPdfWriter. Devuelve el
+    número de páginas escritas; los archivos ilegibles se registran y se omiten.
+    `reader_for(ruta)`, si se indica, es un gestor de contexto que entrega
+    `(lector, compartido)` (ver pdfcache).
+    """
+    with open(output_path, 'wb') as output_file:
+        writer = StreamingPdfWriter(output_file)
+        for pdf_path in pdf_paths:
+            try:
+                if reader_for is None:
+                    added = writer.append(pdf_path)
+                else:
+                    with reader_for(pdf_path) as (reader, shared):
+                        added = writer.append_reader(reader, release=not shared)
+            except Exception as e:
+                logger.error("Error al leer PDF %s: %s", pdf_path, e)
+                continue
+            if added == 0:
+                logger.warning("PDF vacío o corrupto: %s", pdf_path)
+                continue
+            logger.debug("PDF agregado exitosamente: %s (%s páginas)", pdf_path, added,
+                         extra={'sample_rate': LOG_SAMPLE_RATE})
+        if writer.page_count:
+            writer.close()
+    return writer.page_count
@@ -0,0 +1,227 @@
+"""
+Perfilado bajo demanda y captura de peticiones lentas.
+
+Dos modos, ambos opcionales:
+
+- Solicitado: si la petición trae la cabecera `X-Profile` (o el parámetro
+  `?_profile=`) con el valor de PROFILE_SECRET, la vista se ejecuta bajo
+  cProfile y el resultado se guarda como estadísticas pstats.
+- Automático: si PROFILE_SLOW_THRESHOLD > 0, las vistas decoradas se muestrean
+  con un muestreador de pilas de bajo coste y, si la petición supera el umbral,
+  se guardan las pilas agregadas (formato "collapsed" para flamegraphs).
+
+Los perfiles se guardan en un buffer circular en memoria (PROFILE_BUFFER_SIZE)
+y se descargan desde /debug/profiles.
+"""
+import collections
+import cProfile
+import functools
+import io
+import logging
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+
+from flask import request
+
+logger = logging.getLogger('backblaze_uploader.profiling')
+
+PROFILE_SECRET = os.getenv('PROFILE_SECRET')
+PROFILE_SLOW_THRESHOLD = float(os.getenv('PROFILE_SLOW_THRESHOLD', '0'))  # segundos, 0 = desactivado
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))  # segundos entre muestras
+PROFILE_BUFFER_SIZE = int(os.getenv('PROFILE_BUFFER_SIZE', '20'))
+
+SUMMARY_LINES = 15
+
+
+class ProfileStore:
+    """
+    Buffer circular de perfiles capturados. Al llenarse descarta el más antiguo.
+    """
+
+    def __init__(self, maxlen):
+        self._entries = collections.deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def add(self, entry):
+        with self._lock:
+            self._entries.append(entry)
+
+    def list(self):
+        with self._lock:
+            entries = list(self._entries)
+        return [{k: v for k, v in e.items() if k != 'data'} for e in reversed(entries)]
+
+    def get(self, profile_id):
+        with self._lock:
+            for entry in self._entries:
+                if entry['id'] == profile_id:
+                    return entry
+        return None
+
+
+store = ProfileStore(PROFILE_BUFFER_SIZE)
+
+
+class StackSampler:
+    """
+    Muestreador de pilas compartido. Un único hilo en segundo plano toma
+    `sys._current_frames()` cada PROFILE_SAMPLE_INTERVAL segundos y acumula las
+    pilas de los hilos registrados. El hilo solo está activo mientras haya
+    peticiones registradas.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._samples = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+
+    def register(self, thread_id):
+        with self._lock:
+            self._samples[thread_id] = collections.Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+                self._thread.start()
+            self._wakeup.notify()
+
+    def unregister(self, thread_id):
+        with self._lock:
+            return self._samples.pop(thread_id, collections.Counter())
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._samples:
+                    self._wakeup.wait()
+                thread_ids = list(self._samples)
+            frames = sys._current_frames()
+            stacks = {tid: _collapse(frames[tid]) for tid in thread_ids if tid in frames}
+            with self._lock:
+                for tid, stack in stacks.items():
+                    counter = self._samples.get(tid)
+                    if counter is not None:
+                        counter[stack] += 1
+            time.sleep(self.interval)
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _collapse(frame):
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+sampler = StackSampler(PROFILE_SAMPLE_INTERVAL)
+
+# cProfile solo admite un perfilador activo a la vez en Python 3.12+
+_cprofile_lock = threading.Lock()
+
+
+def _requested():
+    if not PROFILE_SECRET:
+        return False
+    token = request.headers.get('X-Profile') or request.args.get('_profile')
+    return token == PROFILE_SECRET
+
+
+def _cprofile_summary(profile):
+    out = io.StringIO()
+    stats = pstats.Stats(profile, stream=out)
+    stats.sort_stats('cumulative').print_stats(SUMMARY_LINES)
+    return out.getvalue()
+
+
+def _sampling_summary(samples):
+    leaves = collections.Counter()
+    for stack, count in samples.items():
+        leaves[stack.rsplit(';', 1)[-1]] += count
+    total = sum(samples.values()) or 1
+    return '\n'.join(f"{100.0 * count / total:5.1f}%  {leaf}" for leaf, count in leaves.most_common(SUMMARY_LINES))
+
+
+def _record(kind, trigger, duration, data, summary):
+    entry = {
+        'id': uuid.uuid4().hex[:12],
+        'kind': kind,
+        'trigger': trigger,
+        'endpoint': request.endpoint,
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'duration': round(duration, 4),
+        'timestamp': time.time(),
+        'size': len(data),
+        'summary': summary,
+        'data': data,
+    }
+    store.add(entry)
+    logger.info("Perfil %s capturado (%s, %s) para %s en %.3f s",
+                entry['id'], kind, trigger, entry['path'], duration)
+    return entry
+
+
+def profiled(view):
+    """
+    Decorador para vistas: aplica el perfilado solicitado o el muestreo de
+    peticiones lentas según la configuración.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if _requested() and _cprofile_lock.acquire(blocking=False):
+            profile = cProfile.Profile()
+            start = time.perf_counter()
+            try:
+                profile.enable()
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    profile.disable()
+                    duration = time.perf_counter() - start
+                    profile.create_stats()
+                    _record('cprofile', 'solicitado', duration, marshal.dumps(profile.stats),
+                            _cprofile_summary(profile))
+            finally:
+                _cprofile_lock.release()
+
+        if _requested() or PROFILE_SLOW_THRESHOLD > 0:
+            thread_id = threading.get_ident()
+            sampler.register(thread_id)
+            start = time.perf_counter()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                duration = time.perf_counter() - start
+                samples = sampler.unregister(thread_id)
+                trigger = 'solicitado' if _requested() else 'lento'
+                if samples and (trigger == 'solicitado' or duration >= PROFILE_SLOW_THRESHOLD):
+                    data = ''.join(f"{stack} {count}\n" for stack, count in samples.items()).encode('utf-8')
+                    _record('sampling', trigger, duration, data, _sampling_summary(samples))
+
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def authorized():
+    """
+    Comprueba el secreto para los endpoints de descarga de perfiles.
+    """
+    if not PROFILE_SECRET:
+        return False
+    token = request.headers.get('X-Profile-Secret') or request.args.get('secret')
+    return token == PROFILE_SECRET
+
+
+def filename_for(entry):
+    extension = 'prof' if entry['kind'] == 'cprofile' else 'collapsed.txt'
+    return f"perfil_{entry['endpoint']}_{entry['id']}.{extension}"
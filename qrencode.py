@@ -0,0 +1,145 @@
+"""
+Codificación de los códigos QR con backends intercambiables.
+
+Todos los QR de la aplicación (el estampado en el certificado, el PDF en blanco
+y el PNG de descarga) se generan con el mismo codificador, elegido con
+QR_BACKEND:
+
+- `qrcode`: el procedimiento original. `make_image` de la librería qrcode
+  dibuja cada módulo y la transparencia se aplica píxel a píxel en Python.
+- `matrix`: usa qrcode solo para calcular la matriz de módulos (versión,
+  corrección de errores y máscara son los mismos) y construye la imagen
+  directamente con Pillow a partir de ella, sin bucles en Python.
+- `memo`: `matrix` con memoria (LRU de QR_CACHE_SIZE entradas) por URL; una
+  subida codifica la misma URL para el certificado y para el PDF en blanco.
+
+`python benchmark.py --only qr` mide los tres con varias longitudes de URL y
+niveles de corrección, y comprueba que producen la misma matriz y los mismos
+píxeles que `qrcode`.
+"""
+import functools
+import os
+from io import BytesIO
+
+QR_BACKEND = os.getenv('QR_BACKEND', 'memo')
+QR_ERROR_CORRECTION = os.getenv('QR_ERROR_CORRECTION', 'L').upper()
+QR_CACHE_SIZE = int(os.getenv('QR_CACHE_SIZE', '256'))
+
+ERROR_CORRECTION_LEVELS = ('L', 'M', 'Q', 'H')
+BOX_SIZE = 10  # píxeles por módulo
+
+
+class QrcodeEncoder:
+    """
+    Backend de referencia: la librería qrcode de principio a fin.
+    """
+    name = 'qrcode'
+
+    def __init__(self, error_correction=QR_ERROR_CORRECTION):
+        if error_correction not in ERROR_CORRECTION_LEVELS:
+            raise ValueError(f"QR_ERROR_CORRECTION no válido: {error_correction} (use L, M, Q o H)")
+        self.error_correction = error_correction
+
+    def _qr(self, data):
+        import qrcode
+
+        qr = qrcode.QRCode(
+            version=1,
+            error_correction=getattr(qrcode.constants, f'ERROR_CORRECT_{self.error_correction}'),
+            box_size=BOX_SIZE,
+            border=0,
+        )
+        qr.add_data(data)
+        qr.make(fit=True)
+        return qr
+
+    def matrix(self, data):
+        """
+        Matriz de módulos (True = oscuro) como tupla de tuplas, sin borde.
+        """
+        return tuple(tuple(bool(module) for module in row) for row in self._qr(data).get_matrix())
+
+    def image(self, data, transparent=False):
+        """
+        Imagen PIL del QR en negro sobre blanco (modo "1"), o sobre fondo
+        transparente (RGBA) para estamparla encima del certificado.
+        """
+        qr_img = self._qr(data).make_image(fill_color="black", back_color="white").get_image()
+        if not transparent:
+            return qr_img
+        qr_img = qr_img.convert("RGBA")
+        # Hacer que el fondo sea transparente (convertir el blanco a transparente)
+        new_data = []
+        for item in qr_img.getdata():
+            if item[0] == 255 and item[1] == 255 and item[2] == 255:
+                new_data.append((255, 255, 255, 0))
+            else:
+                new_data.append(item)
+        qr_img.putdata(new_data)
+        return qr_img
+
+    def png(self, data, transparent=False):
+        """
+        Bytes del PNG de `image()`.
+        """
+        output = BytesIO()
+        self.image(data, transparent).save(output, format="PNG")
+        return output.getvalue()
+
+
+class MatrixEncoder(QrcodeEncoder):
+    """
+    Calcula la matriz con qrcode y dibuja la imagen con Pillow en bloque.
+    """
+    name = 'matrix'
+
+    def image(self, data, transparent=False):
+        from PIL import Image
+
+        modules = self.matrix(data)
+        size = len(modules)
+        # Un píxel por módulo (0 = oscuro) y después ampliado sin suavizar
+        pixels = bytes(0 if module else 255 for row in modules for module in row)
+        gray = Image.frombytes('L', (size, size), pixels).resize((size * BOX_SIZE, size * BOX_SIZE), Image.NEAREST)
+        if not transparent:
+            return gray.convert('1')
+        alpha = gray.point(lambda value: 255 - value)
+        return Image.merge('RGBA', (gray, gray, gray, alpha))
+
+
+class MemoizedEncoder:
+    """
+    Envuelve otro codificador y recuerda las últimas matrices y PNG por URL.
+    Las imágenes PIL no se guardan porque se pueden modificar: `image()`
+    abre de nuevo el PNG guardado.
+    """
+    name = 'memo'
+
+    def __init__(self, backend, size=QR_CACHE_SIZE):
+        self.backend = backend
+        self.error_correction = backend.error_correction
+        self.matrix = functools.lru_cache(maxsize=size)(backend.matrix)
+        self.png = functools.lru_cache(maxsize=size)(backend.png)
+
+    def image(self, data, transparent=False):
+        from PIL import Image
+
+        image = Image.open(BytesIO(self.png(data, transparent)))
+        image.load()
+        return image
+
+
+BACKENDS = {
+    'qrcode': QrcodeEncoder,
+    'matrix': MatrixEncoder,
+    'memo': lambda error_correction: MemoizedEncoder(MatrixEncoder(error_correction)),
+}
+
+
+def get_encoder(name=QR_BACKEND, error_correction=QR_ERROR_CORRECTION):
+    if name not in BACKENDS:
+        raise ValueError(f"QR_BACKEND no válido: {name} (use {', '.join(sorted(BACKENDS))})")
+    return BACKENDS[name](error_correction)
+
+
+encoder = get_encoder()
@@ -0,0 +1,404 @@
+"""
+Re-estampado masivo del QR de los PDF ya subidos al bucket.
+
+El QR se dibuja con la posición (`ex`, `ey`, `qr_size`) y la URL pública del
+momento de la subida. Si esas constantes cambian, o si `move_file` cambia la
+clave de un objeto, el QR del PDF queda desactualizado. Este script recorre un
+prefijo del bucket página a página y, para cada PDF:
+
+1. Consulta sus metadatos (head_object). Los subidos por la aplicación guardan
+   la URL del QR (`qr-url`) y su posición (`qr-stamp`); si coinciden con los
+   actuales, el objeto se omite.
+2. Lo descarga, quita de la primera página el QR anterior (el dibujo de una
+   imagen con la matriz `tamaño 0 0 tamaño x y cm` que deja add_qr_to_pdf) y
+   estampa el nuevo con `add_qr_to_pdf`. Como el QR tiene fondo transparente,
+   estampar encima del anterior sin quitarlo dejaría un código ilegible; si no
+   se encuentra el QR anterior el objeto se marca como `no_stamp` y no se toca.
+3. Lo vuelve a subir con la misma clave, tipo de contenido y metadatos. Con
+   IMMUTABLE_KEYS, una clave con hash de versión no se sobrescribe (se sirve
+   con caché inmutable): el resultado se sube a una clave con un hash nuevo,
+   a la que redirige el alias `/c/`, y la anterior se borra si los QR apuntan
+   al alias (si no, se conserva para que sigan valiendo los QR ya impresos).
+
+Las descargas, el estampado y las subidas se ejecutan en pools de hilos
+distintos encadenados, con un máximo de objetos en curso a la vez. Cada objeto
+terminado se apunta en el archivo de checkpoint (una línea JSON por objeto):
+al volver a lanzar el script se omiten los ya hechos y se reintentan los que
+fallaron. Con --dry-run solo se consultan los metadatos y se informa de lo que
+se re-estamparía, sin descargar, subir ni escribir el checkpoint.
+
+Ejemplos:
+    python restamp.py --prefix certificados/ --dry-run
+    python restamp.py --prefix certificados/ --checkpoint restamp.jsonl
+    python restamp.py --prefix tecnicos/ --old-stamp 490,667,53 --force
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import app
+import hashing
+import mapped
+import metrics
+
+logger = logging.getLogger('backblaze_uploader.restamp')
+
+LIST_PAGE_SIZE = 1000
+
+# Estados que no hace falta repetir al reanudar
+DONE_STATUSES = ('restamped', 'current')
+
+# Tolerancia al comparar la matriz de dibujo con la posición esperada (puntos)
+_GEOMETRY_TOLERANCE = 0.01
+
+
+def parse_geometry(value):
+    """
+    Convierte "x,y,tamaño" en una tupla de floats, o None si no es válido.
+    """
+    try:
+        x, y, size = (float(part) for part in value.split(','))
+    except (AttributeError, ValueError):
+        return None
+    return x, y, size
+
+
+def _is_stamp_matrix(operands, geometry):
+    if len(operands) != 6:
+        return False
+    x, y, size = geometry
+    expected = (size, 0, 0, size, x, y)
+    try:
+        return all(abs(float(value) - target) <= _GEOMETRY_TOLERANCE for value, target in zip(operands, expected))
+    except (TypeError, ValueError):
+        return False
+
+
+def _without_stamp(operations, geometry):
+    """
+    Devuelve (operaciones sin los QR, nombres de los XObject quitados). Un QR es
+    la secuencia `q <matriz> cm /Nombre Do Q` con la matriz de `geometry`.
+    """
+    kept = []
+    removed = []
+    index = 0
+    while index < len(operations):
+        window = operations[index:index + 4]
+        if (len(window) == 4 and [op for _, op in window] == [b'q', b'cm', b'Do', b'Q']
+                and _is_stamp_matrix(window[1][0], geometry)):
+            removed.append(window[2][0][0])
+            index += 4
+            continue
+        kept.append(operations[index])
+        index += 1
+    return kept, removed
+
+
+def remove_qr_stamp(input_pdf_path, output_pdf_path, geometry):
+    """
+    Escribe en `output_pdf_path` el PDF sin el QR de la primera página dibujado
+    en `geometry` (x, y, tamaño). Devuelve el número de QR quitados; si es 0 no
+    escribe el archivo de salida.
+    """
+    from PyPDF2 import PdfReader, PdfWriter
+    from PyPDF2.generic import ContentStream, NameObject
+
+    with mapped.open_pdf(input_pdf_path) as pdf_file:
+        reader = PdfReader(pdf_file)
+        if reader.is_encrypted:
+            reader.decrypt('')
+        if len(reader.pages) == 0 or reader.pages[0].get_contents() is None:
+            return 0
+        content = ContentStream(reader.pages[0].get_contents(), reader)
+        operations, removed = _without_stamp(content.operations, geometry)
+        if not removed:
+            return 0
+
+        writer = PdfWriter()
+        for page in reader.pages:
+            writer.add_page(page)
+        first_page = writer.pages[0]
+        content.operations = operations
+        first_page[NameObject('/Contents')] = writer._add_object(content)
+        # La imagen del QR anterior ya no se dibuja: no hace falta copiarla
+        resources = first_page.get('/Resources')
+        resources = resources.get_object() if resources is not None else {}
+        xobjects = resources.get('/XObject')
+        if xobjects is not None:
+            xobjects = xobjects.get_object()
+            for name in removed:
+                xobjects.pop(name, None)
+        with open(output_pdf_path, 'wb') as output_file:
+            writer.write(output_file)
+    return len(removed)
+
+
+class Checkpoint:
+    """
+    Archivo JSON lines con el resultado de cada objeto procesado. Se escribe y
+    se vacía a disco línea a línea para que un corte no pierda lo ya hecho.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self._lock = threading.Lock()
+        self._file = None
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Línea cortada por una interrupción
+                    if entry.get('status') in DONE_STATUSES:
+                        self.done.add(entry['key'])
+                    else:
+                        self.done.discard(entry.get('key'))
+
+    def record(self, key, status, **extra):
+        if not self.path:
+            return
+        line = json.dumps(dict(extra, key=key, status=status, time=time.time()), ensure_ascii=False)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def iter_pdf_keys(s3_client, bucket, prefix):
+    """
+    Recorre el prefijo con list_objects_v2 paginado y devuelve las claves de los
+    PDF, sin los marcadores de carpeta ni el prefijo de staging.
+    """
+    params = {'Bucket': bucket, 'Prefix': prefix or '', 'MaxKeys': LIST_PAGE_SIZE}
+    while True:
+        response = s3_client.list_objects_v2(**params)
+        for obj in response.get('Contents', []):
+            key = obj['Key']
+            if key.startswith(app.STAGING_PREFIX) or not key.lower().endswith('.pdf'):
+                continue
+            yield key
+        if not response.get('IsTruncated'):
+            return
+        params['ContinuationToken'] = response['NextContinuationToken']
+
+
+class Restamper:
+    """
+    Pipeline descarga -> estampado -> subida. Cada etapa tiene su propio pool y
+    un semáforo limita los objetos en curso (y los temporales en disco).
+    """
+
+    def __init__(self, s3_client, bucket, old_geometry, checkpoint, work_dir,
+                 download_workers=4, stamp_workers=2, upload_workers=4, max_in_flight=16,
+                 dry_run=False, force=False, optimize=app.PDF_OPTIMIZE):
+        self.s3 = s3_client
+        self.bucket = bucket
+        self.old_geometry = old_geometry
+        self.checkpoint = checkpoint
+        self.work_dir = work_dir
+        self.dry_run = dry_run
+        self.force = force
+        self.optimize = optimize
+        self.max_in_flight = max_in_flight
+        self.geometry = app.qr_stamp_geometry()
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        # Claves nuevas creadas en esta ejecución: el listado puede encontrarlas
+        self._created = set()
+        self._downloads = ThreadPoolExecutor(download_workers, thread_name_prefix='restamp-download')
+        self._stamps = ThreadPoolExecutor(stamp_workers, thread_name_prefix='restamp-stamp')
+        self._uploads = ThreadPoolExecutor(upload_workers, thread_name_prefix='restamp-upload')
+
+    def run(self, keys):
+        for key in keys:
+            if key in self.checkpoint.done:
+                self._count('resumed')
+                continue
+            if key in self._created:
+                continue
+            self._slots.acquire()
+            self._downloads.submit(self._guarded, self._download, {'key': key})
+        # Esperar a que terminen todos los objetos en curso
+        for _ in range(self.max_in_flight):
+            self._slots.acquire()
+        for executor in (self._downloads, self._stamps, self._uploads):
+            executor.shutdown()
+        return self.stats
+
+    def _guarded(self, stage, item):
+        """
+        Ejecuta una etapa; si falla o es la última del objeto, registra el
+        resultado, borra sus temporales y libera el hueco.
+        """
+        try:
+            next_stage = stage(item)
+        except Exception as e:
+            logger.exception("Error al re-estampar %s", item['key'])
+            item['status'], item['error'] = 'error', str(e)
+            next_stage = None
+        if next_stage is None:
+            self._finish(item)
+            return
+        executor, function = next_stage
+        executor.submit(self._guarded, function, item)
+
+    def _finish(self, item):
+        status = item['status']
+        self._count(status)
+        if status == 'pending':
+            logger.info("[dry-run] %s: se re-estamparía (%s)", item['key'], item['reason'])
+        elif status != 'current':
+            logger.info("%s: %s", item['key'], status)
+        if not self.dry_run:
+            extra = {k: item[k] for k in ('reason', 'error', 'size', 'new_key') if k in item}
+            self.checkpoint.record(item['key'], status, **extra)
+        for path in item.get('paths', ()):
+            if os.path.exists(path):
+                mapped.release(path)
+                os.remove(path)
+        self._slots.release()
+
+    def _count(self, status):
+        with self._stats_lock:
+            self.stats[status] += 1
+
+    def _download(self, item):
+        key = item['key']
+        head = self.s3.head_object(Bucket=self.bucket, Key=key)
+        metadata = head.get('Metadata', {})
+        item['url'] = app.qr_url_for(key)
+        item['content_type'] = head.get('ContentType') or 'application/pdf'
+        item['metadata'] = metadata
+
+        if app.QR_URL_METADATA not in metadata:
+            item['reason'] = 'no_metadata'
+        elif metadata[app.QR_URL_METADATA] != item['url']:
+            item['reason'] = 'url'
+        elif metadata.get(app.QR_STAMP_METADATA) != self.geometry:
+            item['reason'] = 'position'
+        elif self.force:
+            item['reason'] = 'force'
+        else:
+            item['status'] = 'current'
+            return None
+        if self.dry_run:
+            item['status'] = 'pending'
+            return None
+
+        base = os.path.join(self.work_dir, os.urandom(8).hex())
+        item['paths'] = [base + '.pdf', base + '_clean.pdf', base + '_qr.pdf', base + '_opt.pdf']
+        with metrics.timer('s3_download'):
+            self.s3.download_file(self.bucket, key, item['paths'][0])
+        metrics.B2_BYTES.inc(os.path.getsize(item['paths'][0]), direction='download')
+        return self._stamps, self._stamp
+
+    def _stamp(self, item):
+        original, clean, stamped, optimized = item['paths']
+        # Posición del QR anterior: la guardada al subirlo o la indicada a mano
+        old_geometry = parse_geometry(item['metadata'].get(app.QR_STAMP_METADATA)) or self.old_geometry
+        if not remove_qr_stamp(original, clean, old_geometry):
+            item['status'] = 'no_stamp'
+            return None
+        item['target_key'] = item['key']
+        if app.IMMUTABLE_KEYS and app.VERSIONED_KEY_RE.match(item['key']):
+            # Versión nueva: el hash se calcula antes de estampar porque la URL
+            # del QR puede depender de la clave
+            version = hashlib.sha256((hashing.path_sha256(clean) + item['key']).encode()).hexdigest()
+            item['target_key'] = app.versioned_key(item['key'], version)
+            item['url'] = app.qr_url_for(item['target_key'])
+            self._created.add(item['target_key'])
+        if not app.add_qr_to_pdf(clean, stamped, item['url']):
+            item['status'], item['error'] = 'error', 'add_qr_to_pdf'
+            return None
+        item['upload_path'] = stamped
+        if self.optimize and app.optimize_pdf(stamped, optimized):
+            item['upload_path'] = optimized
+        return self._uploads, self._upload
+
+    def _upload(self, item):
+        key, target_key = item['key'], item['target_key']
+        metadata = dict(item['metadata'])
+        metadata[app.QR_URL_METADATA] = item['url']
+        metadata[app.QR_STAMP_METADATA] = self.geometry
+        size = os.path.getsize(item['upload_path'])
+        with metrics.timer('s3_upload'), open(item['upload_path'], 'rb') as data:
+            response = self.s3.put_object(Body=data, Bucket=self.bucket, Key=target_key,
+                                          ContentType=item['content_type'], Metadata=metadata,
+                                          **app.object_cache_args(target_key))
+        metrics.B2_BYTES.inc(size, direction='upload')
+        if app.bucket_mirror is not None:
+            app.bucket_mirror.put(target_key, size, response.get('ETag', '').strip('"'))
+        if target_key != key:
+            item['new_key'] = target_key
+            if app.ALIAS_BASE_URL:
+                self.s3.delete_object(Bucket=self.bucket, Key=key)
+                if app.bucket_mirror is not None:
+                    app.bucket_mirror.delete([key])
+        item['status'], item['size'] = 'restamped', size
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-estampa el QR de los PDF de un prefijo del bucket')
+    parser.add_argument('--prefix', default='', help='Prefijo de las claves a recorrer (por defecto, todo el bucket)')
+    parser.add_argument('--checkpoint', default='restamp_checkpoint.jsonl',
+                        help='Archivo de checkpoint para reanudar (vacío = sin checkpoint)')
+    parser.add_argument('--dry-run', action='store_true', help='Solo informar de lo que se re-estamparía')
+    parser.add_argument('--force', action='store_true', help='Re-estampar también los objetos que parecen al día')
+    parser.add_argument('--old-stamp', default=app.qr_stamp_geometry(), metavar='X,Y,TAMAÑO',
+                        help='Posición del QR anterior en los objetos sin metadato qr-stamp '
+                             '(por defecto, la actual: %(default)s)')
+    parser.add_argument('--download-workers', type=int, default=4)
+    parser.add_argument('--stamp-workers', type=int, default=2)
+    parser.add_argument('--upload-workers', type=int, default=4)
+    parser.add_argument('--max-in-flight', type=int, default=16,
+                        help='Objetos en curso a la vez entre todas las etapas')
+    parser.add_argument('--no-optimize', action='store_true', help='No optimizar el PDF antes de subirlo')
+    args = parser.parse_args()
+
+    old_geometry = parse_geometry(args.old_stamp)
+    if old_geometry is None:
+        parser.error('--old-stamp debe tener el formato x,y,tamaño')
+
+    s3_client = app.get_s3_client()
+    if not s3_client:
+        raise SystemExit("Error al conectar con Backblaze B2")
+
+    checkpoint = Checkpoint(None if args.dry_run else args.checkpoint)
+    work_dir = tempfile.mkdtemp(prefix='restamp_', dir=app.UPLOAD_FOLDER)
+    start = time.perf_counter()
+    try:
+        restamper = Restamper(s3_client, app.B2_BUCKET_NAME, old_geometry, checkpoint, work_dir,
+                              download_workers=args.download_workers, stamp_workers=args.stamp_workers,
+                              upload_workers=args.upload_workers, max_in_flight=args.max_in_flight,
+                              dry_run=args.dry_run, force=args.force, optimize=not args.no_optimize)
+        stats = restamper.run(iter_pdf_keys(s3_client, app.B2_BUCKET_NAME, args.prefix))
+    finally:
+        checkpoint.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    app.invalidate_bucket_index()
+
+    elapsed = time.perf_counter() - start
+    summary = ', '.join(f"{status}={count}" for status, count in sorted(stats.items())) or 'sin objetos'
+    logger.info("Re-estampado terminado en %.1f s: %s", elapsed, summary)
+    print(f"{summary} ({elapsed:.1f} s)")
+
+
+if __name__ == '__main__':
+    main()
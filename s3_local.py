@@ -0,0 +1,393 @@
+"""
+Servidor S3 local en memoria para pruebas de carga y desarrollo.
+
+Implementa el subconjunto de la API S3 que usa la aplicación (PUT/GET/HEAD/DELETE
+de objetos, copia, ListObjectsV2, DeleteObjects y subidas multiparte) de forma
+suficiente para que boto3 lo trate como si fuera Backblaze B2. No valida firmas:
+solo debe usarse en local.
+
+Uso:
+    python s3_local.py --port 9000
+"""
+import argparse
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.sax.saxutils import escape
+import xml.etree.ElementTree as ET
+
+logger = logging.getLogger('s3_local')
+
+S3_NS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+# Cabeceras que se guardan con el objeto y se devuelven en GET/HEAD
+STORED_HEADERS = ('content-type', 'cache-control', 'content-disposition', 'content-encoding')
+
+
+class _Object:
+    __slots__ = ('data', 'etag', 'last_modified', 'headers', 'metadata')
+
+    def __init__(self, data, headers=None, metadata=None):
+        self.data = data
+        self.etag = hashlib.md5(data).hexdigest()
+        self.last_modified = time.time()
+        self.headers = headers or {}
+        self.metadata = metadata or {}
+
+
+class LocalS3Store:
+    """
+    Almacén en memoria de buckets y objetos, protegido por un lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.multipart = {}
+
+    def bucket(self, name):
+        with self.lock:
+            return self.buckets.setdefault(name, {})
+
+
+def _decode_aws_chunked(body):
+    """
+    Decodifica un cuerpo con codificación aws-chunked (usada por botocore para
+    enviar checksums al final del stream).
+    """
+    out = bytearray()
+    pos = 0
+    while True:
+        line_end = body.index(b'\r\n', pos)
+        size = int(body[pos:line_end].split(b';')[0], 16)
+        pos = line_end + 2
+        if size == 0:
+            break
+        out += body[pos:pos + size]
+        pos += size + 2
+    return bytes(out)
+
+
+def _http_date(timestamp):
+    return formatdate(timestamp, usegmt=True)
+
+
+def _iso_date(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+class S3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'LocalS3/1.0'
+
+    @property
+    def store(self):
+        return self.server.store
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    # --- Utilidades de petición/respuesta ---
+
+    def _parse_path(self):
+        parts = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(parts.query, keep_blank_values=True).items()}
+        path = unquote(parts.path).lstrip('/')
+        host = self.headers.get('Host', '').split(':')[0]
+        # Soportar direccionamiento virtual-hosted (bucket.host) además de path-style
+        host_bucket = host.split('.')[0] if host.count('.') >= 1 and not host.replace('.', '').isdigit() else None
+        if host_bucket and host_bucket != 'localhost':
+            return host_bucket, path, query
+        if '/' in path:
+            bucket, key = path.split('/', 1)
+        else:
+            bucket, key = path, ''
+        return bucket, key, query
+
+    def _read_body(self):
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    # Consumir trailers hasta la línea vacía
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                body += self.rfile.read(size)
+                self.rfile.readline()
+            body = bytes(body)
+        else:
+            length = int(self.headers.get('Content-Length', 0) or 0)
+            body = self.rfile.read(length) if length else b''
+        content_sha = self.headers.get('x-amz-content-sha256', '')
+        if 'aws-chunked' in self.headers.get('Content-Encoding', '') or content_sha.startswith('STREAMING-'):
+            body = _decode_aws_chunked(body)
+        return body
+
+    def _send(self, status, body=b'', headers=None, content_type='application/xml'):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Expose-Headers', 'ETag')
+        if body or content_type:
+            self.send_header('Content-Type', content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _error(self, status, code, message=''):
+        body = (f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code>'
+                f'<Message>{escape(message)}</Message></Error>')
+        self._send(status, body)
+
+    # --- Verbos HTTP ---
+
+    def do_OPTIONS(self):
+        # Preflight CORS para subidas directas desde el navegador
+        self.send_response(200)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'GET, PUT, POST, HEAD, DELETE')
+        self.send_header('Access-Control-Allow-Headers', self.headers.get('Access-Control-Request-Headers', '*'))
+        self.send_header('Access-Control-Expose-Headers', 'ETag')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_PUT(self):
+        bucket_name, key, query = self._parse_path()
+        body = self._read_body()
+        bucket = self.store.bucket(bucket_name)
+        if not key:
+            self._send(200, content_type=None)
+            return
+
+        if 'uploadId' in query:
+            upload = self.store.multipart.get(query['uploadId'])
+            if upload is None:
+                self._error(404, 'NoSuchUpload')
+                return
+            upload['parts'][int(query['partNumber'])] = body
+            self._send(200, headers={'ETag': f'"{hashlib.md5(body).hexdigest()}"'}, content_type=None)
+            return
+
+        copy_source = self.headers.get('x-amz-copy-source')
+        if copy_source:
+            src_bucket, src_key = unquote(copy_source).lstrip('/').split('/', 1)
+            with self.store.lock:
+                src = self.store.buckets.get(src_bucket, {}).get(src_key)
+            if src is None:
+                self._error(404, 'NoSuchKey', src_key)
+                return
+            if self.headers.get('x-amz-metadata-directive', 'COPY').upper() == 'REPLACE':
+                headers, metadata = self._object_headers()
+            else:
+                headers, metadata = dict(src.headers), dict(src.metadata)
+            obj = _Object(src.data, headers, metadata)
+            with self.store.lock:
+                bucket[key] = obj
+            body = (f'<?xml version="1.0" encoding="UTF-8"?><CopyObjectResult>'
+                    f'<LastModified>{_iso_date(obj.last_modified)}</LastModified>'
+                    f'<ETag>"{obj.etag}"</ETag></CopyObjectResult>')
+            self._send(200, body)
+            return
+
+        headers, metadata = self._object_headers()
+        obj = _Object(body, headers, metadata)
+        with self.store.lock:
+            bucket[key] = obj
+        self._send(200, headers={'ETag': f'"{obj.etag}"'}, content_type=None)
+
+    def _object_headers(self):
+        headers = {}
+        metadata = {}
+        for name, value in self.headers.items():
+            lower = name.lower()
+            if lower in STORED_HEADERS:
+                headers[lower] = value
+            elif lower.startswith('x-amz-meta-'):
+                metadata[lower[len('x-amz-meta-'):]] = value
+        # aws-chunked es una codificación de transporte, no del objeto
+        if 'aws-chunked' in headers.get('content-encoding', ''):
+            headers.pop('content-encoding')
+        return headers, metadata
+
+    def do_POST(self):
+        bucket_name, key, query = self._parse_path()
+        body = self._read_body()
+        bucket = self.store.bucket(bucket_name)
+
+        if 'delete' in query:
+            root = ET.fromstring(body)
+            deleted = []
+            with self.store.lock:
+                for obj_el in root.iter(f'{{{S3_NS}}}Object'):
+                    obj_key = obj_el.find(f'{{{S3_NS}}}Key').text
+                    bucket.pop(obj_key, None)
+                    deleted.append(obj_key)
+                # Sin namespace (algunos clientes no lo envían)
+                for obj_el in root.iter('Object'):
+                    obj_key = obj_el.find('Key').text
+                    bucket.pop(obj_key, None)
+                    deleted.append(obj_key)
+            items = ''.join(f'<Deleted><Key>{escape(k)}</Key></Deleted>' for k in deleted)
+            self._send(200, f'<?xml version="1.0" encoding="UTF-8"?><DeleteResult>{items}</DeleteResult>')
+            return
+
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            headers, metadata = self._object_headers()
+            self.store.multipart[upload_id] = {'parts': {}, 'headers': headers, 'metadata': metadata}
+            body = (f'<?xml version="1.0" encoding="UTF-8"?><InitiateMultipartUploadResult>'
+                    f'<Bucket>{escape(bucket_name)}</Bucket><Key>{escape(key)}</Key>'
+                    f'<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>')
+            self._send(200, body)
+            return
+
+        if 'uploadId' in query:
+            upload = self.store.multipart.pop(query['uploadId'], None)
+            if upload is None:
+                self._error(404, 'NoSuchUpload')
+                return
+            data = b''.join(upload['parts'][n] for n in sorted(upload['parts']))
+            obj = _Object(data, upload['headers'], upload['metadata'])
+            with self.store.lock:
+                bucket[key] = obj
+            body = (f'<?xml version="1.0" encoding="UTF-8"?><CompleteMultipartUploadResult>'
+                    f'<Bucket>{escape(bucket_name)}</Bucket><Key>{escape(key)}</Key>'
+                    f'<ETag>"{obj.etag}"</ETag></CompleteMultipartUploadResult>')
+            self._send(200, body)
+            return
+
+        self._error(400, 'InvalidRequest', 'Operación POST no soportada')
+
+    def do_GET(self):
+        bucket_name, key, query = self._parse_path()
+        bucket = self.store.bucket(bucket_name)
+        if not key:
+            self._list_objects(bucket_name, bucket, query)
+            return
+        with self.store.lock:
+            obj = bucket.get(key)
+        if obj is None:
+            self._error(404, 'NoSuchKey', key)
+            return
+        data = obj.data
+        status = 200
+        headers = self._response_headers(obj)
+        range_header = self.headers.get('Range')
+        if range_header and range_header.startswith('bytes='):
+            start, _, end = range_header[6:].partition('-')
+            start = int(start) if start else 0
+            end = int(end) if end else len(data) - 1
+            headers['Content-Range'] = f'bytes {start}-{end}/{len(data)}'
+            data = data[start:end + 1]
+            status = 206
+        self._send(status, data, headers, obj.headers.get('content-type', 'binary/octet-stream'))
+
+    def do_HEAD(self):
+        bucket_name, key, query = self._parse_path()
+        with self.store.lock:
+            obj = self.store.buckets.get(bucket_name, {}).get(key)
+        if obj is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        headers = self._response_headers(obj)
+        headers['Content-Type'] = obj.headers.get('content-type', 'binary/octet-stream')
+        headers['Content-Length'] = str(len(obj.data))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def do_DELETE(self):
+        bucket_name, key, query = self._parse_path()
+        if 'uploadId' in query:
+            self.store.multipart.pop(query['uploadId'], None)
+        else:
+            with self.store.lock:
+                self.store.buckets.get(bucket_name, {}).pop(key, None)
+        self.send_response(204)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+
+    def _response_headers(self, obj):
+        headers = {
+            'ETag': f'"{obj.etag}"',
+            'Last-Modified': _http_date(obj.last_modified),
+            'Accept-Ranges': 'bytes',
+        }
+        for name in STORED_HEADERS:
+            if name in obj.headers and name != 'content-type':
+                headers[name.title()] = obj.headers[name]
+        for name, value in obj.metadata.items():
+            headers[f'x-amz-meta-{name}'] = value
+        return headers
+
+    def _list_objects(self, bucket_name, bucket, query):
+        prefix = query.get('prefix', '')
+        max_keys = int(query.get('max-keys', 1000) or 1000)
+        start_after = query.get('continuation-token') or query.get('start-after') or ''
+        with self.store.lock:
+            keys = sorted(k for k in bucket if k.startswith(prefix) and k > start_after)
+            page = [(k, bucket[k]) for k in keys[:max_keys]]
+        truncated = len(keys) > max_keys
+        contents = ''.join(
+            f'<Contents><Key>{escape(k)}</Key><LastModified>{_iso_date(o.last_modified)}</LastModified>'
+            f'<ETag>"{o.etag}"</ETag><Size>{len(o.data)}</Size><StorageClass>STANDARD</StorageClass></Contents>'
+            for k, o in page
+        )
+        next_token = f'<NextContinuationToken>{escape(page[-1][0])}</NextContinuationToken>' if truncated else ''
+        body = (f'<?xml version="1.0" encoding="UTF-8"?><ListBucketResult xmlns="{S3_NS}">'
+                f'<Name>{escape(bucket_name)}</Name><Prefix>{escape(prefix)}</Prefix>'
+                f'<KeyCount>{len(page)}</KeyCount><MaxKeys>{max_keys}</MaxKeys>'
+                f'<IsTruncated>{"true" if truncated else "false"}</IsTruncated>'
+                f'{contents}{next_token}</ListBucketResult>')
+        self._send(200, body)
+
+
+def start_server(host='127.0.0.1', port=0):
+    """
+    Arranca el servidor en un hilo en segundo plano y devuelve (server, endpoint_url).
+    Con port=0 se elige un puerto libre.
+    """
+    server = ThreadingHTTPServer((host, port), S3Handler)
+    server.daemon_threads = True
+    server.store = LocalS3Store()
+    thread = threading.Thread(target=server.serve_forever, name='s3-local', daemon=True)
+    thread.start()
+    endpoint = f"http://{host}:{server.server_address[1]}"
+    logger.info("Servidor S3 local escuchando en %s", endpoint)
+    return server, endpoint
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Servidor S3 local en memoria')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    server = ThreadingHTTPServer((args.host, args.port), S3Handler)
+    server.daemon_threads = True
+    server.store = LocalS3Store()
+    logger.info("Servidor S3 local escuchando en http://%s:%s", args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()